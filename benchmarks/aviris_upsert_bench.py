@@ -0,0 +1,197 @@
+"""
+Times the aviris_plumes insert and update as the plume writer used to send
+them (an existence check, then the full SQL text of an insert or update with
+ST_GeomFromText on WKT each time) against the prepared upsert it uses now
+(one EXECUTE of insert ... on conflict (candidate_id) do update, with a WKB
+footprint and ST_MakePoint).
+
+Needs a PostGIS database, configured like the ingest scripts through the
+MSF_DB_* environment variables. Everything runs against a temporary
+aviris_plumes table that shadows the real one for this session and is
+rolled back at the end.
+
+    MSF_DB_NAME=msf python benchmarks/aviris_upsert_bench.py -n 2000
+"""
+import os
+import sys
+import time
+import argparse
+import psycopg2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from ingestutils import db, geometry
+from ingest_plumes_to_sql_permian import AVIRIS_PLUME_COLUMNS, UPSERT_AVIRIS_PLUME_SQL, aviris_plume_values
+
+
+BENCH_TABLE_SQL = """
+    create temp table aviris_plumes (
+        plume_id serial primary key,
+        name text,
+        json_url text,
+        png_url text,
+        plume_url text,
+        rgbqlctr_url text,
+        png_url_thumb text,
+        plume_url_thumb text,
+        rgbqlctr_url_thumb text,
+        plume_tiff_url text,
+        rgb_tiff_url text,
+        thumbnails jsonb,
+        tiles_url text,
+        tiles_min_zoom integer,
+        tiles_max_zoom integer,
+        ul_pixel_coordinate_row integer,
+        ul_pixel_coordinate_col integer,
+        mergedist double precision,
+        source_id text,
+        ime_20 double precision,
+        ime_10 double precision,
+        ime_5 double precision,
+        candidate_id text unique,
+        aviris_plume_id text,
+        detid5 integer,
+        detid10 integer,
+        detid20 integer,
+        fetch5 double precision,
+        fetch10 double precision,
+        fetch20 double precision,
+        plume_longitude double precision,
+        plume_latitude double precision,
+        plume_location geometry(Point, 4326),
+        plume_shape geometry(Polygon, 4326),
+        data_date timestamp
+    ) on commit drop
+"""
+
+# The statements as they were sent before, one SQL text per plume
+TEXT_INSERT_SQL = """
+    insert into aviris_plumes
+      (
+        %s,
+        plume_location,
+        plume_shape,
+        data_date
+      ) values (
+        %s,
+        ST_GeomFromText('POINT(%%s %%s)', 4326),
+        ST_GeomFromText(%%s, 4326),
+        to_timestamp(%%s, 'yyyy-mm-dd hh24:mi:ss')
+      )
+    """ % (",\n        ".join(AVIRIS_PLUME_COLUMNS), ", ".join(["%s"] * len(AVIRIS_PLUME_COLUMNS)))
+
+TEXT_UPDATE_SQL = """
+    update aviris_plumes
+    set
+        %s,
+        plume_location=ST_GeomFromText('POINT(%%s %%s)', 4326),
+        plume_shape=ST_GeomFromText(%%s, 4326),
+        data_date=to_timestamp(%%s, 'yyyy-mm-dd hh24:mi:ss')
+    where
+      plume_id = %%s
+    """ % ",\n        ".join("%s = %%s" % c for c in AVIRIS_PLUME_COLUMNS)
+
+
+def synthetic_plume(i):
+    lon = -103.5 + (i % 1000) * 0.001
+    lat = 31.5 + (i // 1000) * 0.001
+    shape = [(lon - 0.01, lat + 0.01), (lon - 0.01, lat - 0.01), (lon + 0.01, lat - 0.01), (lon + 0.01, lat + 0.01)]
+    candidate_id = "ang20190922t%06d-%d" % (i % 1000000, i)
+    metadata = {
+        "rgb_png_s3_url": "https://bucket.s3.amazonaws.com/AVIRIS/%s_rgb.png" % candidate_id,
+        "plume_png_s3_url": "https://bucket.s3.amazonaws.com/AVIRIS/%s_ctr.png" % candidate_id,
+        "rgbqlctr_png_s3_url": "https://bucket.s3.amazonaws.com/AVIRIS/%s_rgbqlctr.png" % candidate_id,
+        "rgb_png_s3_url_thumb": "https://bucket.s3.amazonaws.com/AVIRIS/%s_rgb_thumbnail.jpg" % candidate_id,
+        "plume_png_s3_url_thumb": "https://bucket.s3.amazonaws.com/AVIRIS/%s_ctr_thumbnail.jpg" % candidate_id,
+        "rgbqlctr_png_s3_url_thumb": "https://bucket.s3.amazonaws.com/AVIRIS/%s_rgbqlctr_thumbnail.jpg" % candidate_id,
+        "plume_tiff_s3_url": "https://bucket.s3.amazonaws.com/AVIRIS/%s_ctr.tif" % candidate_id,
+        "rgb_tiff_s3_url": "https://bucket.s3.amazonaws.com/AVIRIS/%s_rgb.tif" % candidate_id,
+        "thumbnails": {"100": "https://bucket.s3.amazonaws.com/AVIRIS/%s_rgb_thumbnail.jpg" % candidate_id},
+        "ul_pixel_coordinate_row": 100,
+        "ul_pixel_coordinate_col": 200,
+        "mergedist": 200.0,
+        "date": "2019-09-22 19:26:42",
+        "shape": shape
+    }
+    # get_plume_data_from_candidate_id's row: lat at 7, lon at 8, source at 10
+    plume_data = [None] * 7 + [lat, lon, None, "P%05d" % i]
+    return candidate_id, metadata, plume_data
+
+
+def text_values(i, plume_id=None):
+    candidate_id, metadata, plume_data = synthetic_plume(i)
+    shape = metadata["shape"] + [metadata["shape"][0]]
+    poly = "POLYGON((" + ",".join([" ".join(map(str, p)) for p in shape]) + "))"
+    values = aviris_plume_values(poly, candidate_id, metadata, candidate_id, plume_data)
+    return values if plume_id is None else values + (plume_id,)
+
+
+def prepared_values(i):
+    candidate_id, metadata, plume_data = synthetic_plume(i)
+    poly = psycopg2.Binary(geometry.polygon_wkb(metadata["shape"]))
+    return aviris_plume_values(poly, candidate_id, metadata, candidate_id, plume_data)
+
+
+def run(cur, count, insert, update):
+    cur.execute(BENCH_TABLE_SQL)
+
+    t0 = time.time()
+    for i in range(count):
+        insert(cur, i)
+    t1 = time.time()
+    cur.execute("select plume_id from aviris_plumes order by plume_id")
+    ids = [row[0] for row in cur.fetchall()]
+    t2 = time.time()
+    for i, plume_id in enumerate(ids):
+        update(cur, i, plume_id)
+    t3 = time.time()
+
+    cur.connection.rollback()
+    return t1 - t0, t3 - t2
+
+
+def text_exists(cur, i):
+    candidate_id = synthetic_plume(i)[0]
+    cur.execute("select count(*) from aviris_plumes where candidate_id = %s", (candidate_id,))
+    return cur.fetchone()[0] >= 1
+
+
+def text_insert(cur, i):
+    text_exists(cur, i)
+    cur.execute(TEXT_INSERT_SQL, text_values(i))
+
+
+def text_update(cur, i, plume_id):
+    text_exists(cur, i)
+    cur.execute(TEXT_UPDATE_SQL, text_values(i, plume_id))
+
+
+def prepared_upsert(cur, i, plume_id=None):
+    db.execute_prepared(cur, "bench_upsert_aviris_plume", UPSERT_AVIRIS_PLUME_SQL, prepared_values(i))
+    cur.fetchone()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--count", help="Plumes to insert and then update", type=int, default=2000)
+    parser.add_argument("-r", "--repeat", help="Runs of each variant; the best is reported", type=int, default=3)
+    args = parser.parse_args()
+
+    conn = db.connect()
+    cur = conn.cursor()
+    try:
+        results = {}
+        for label, insert, update in [("text SQL", text_insert, text_update), ("upsert", prepared_upsert, prepared_upsert)]:
+            runs = [run(cur, args.count, insert, update) for _ in range(args.repeat)]
+            results[label] = (min(r[0] for r in runs), min(r[1] for r in runs))
+
+        print("%d plumes, best of %d" % (args.count, args.repeat))
+        print("    %-10s %12s %12s %14s %14s" % ("", "insert (s)", "update (s)", "insert (ms/row)", "update (ms/row)"))
+        for label in ["text SQL", "upsert"]:
+            insert_time, update_time = results[label]
+            print("    %-10s %12.3f %12.3f %14.3f %14.3f" % (label, insert_time, update_time,
+                                                          1000.0 * insert_time / args.count, 1000.0 * update_time / args.count))
+    finally:
+        conn.rollback()
+        cur.close()
+        db.release(conn)
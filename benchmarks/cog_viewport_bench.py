@@ -0,0 +1,111 @@
+"""
+Estimates the bytes a map client has to fetch to draw one viewport of a
+plume raster, for the plain GeoTIFF gdal.Warp used to write and for the
+Cloud-Optimized GeoTIFF it writes now.
+
+A plain GeoTIFF has no overviews and is usually strip-organised, so the
+client downloads the whole file. For the COG, the client reads the header
+and then only the tiles of the overview level closest to the screen
+resolution that intersect the viewport; their sizes are taken from the TIFF
+tile index.
+
+    python benchmarks/cog_viewport_bench.py ang20190922t192642_rgb.tif -s 1024 768 -z 1.0 0.25 0.05
+"""
+import os
+import sys
+import math
+import argparse
+from osgeo import gdal
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from ingestutils import raster
+
+# What GDAL reads in one request when opening a remote TIFF
+HEADER_BYTES = 16384
+
+
+def memory_file_size(path):
+    return gdal.VSIStatL(path).size
+
+
+def block_bytes(band, block_x, block_y):
+    size = band.GetMetadataItem("BLOCK_SIZE_%d_%d" % (block_x, block_y), "TIFF")
+    return int(size) if size is not None else 0
+
+
+def pick_level(ds, scale):
+    """
+    The band (full resolution or overview) with the coarsest resolution that
+    is still at least as fine as scale source pixels per screen pixel,
+    along with its downsampling factor.
+    """
+    band = ds.GetRasterBand(1)
+    best, best_factor = band, 1.0
+    for i in range(band.GetOverviewCount()):
+        overview = band.GetOverview(i)
+        factor = float(ds.RasterXSize) / overview.XSize
+        if best_factor < factor <= scale:
+            best, best_factor = overview, factor
+    return best, best_factor
+
+
+def viewport_window(ds, fraction):
+    # A window centred on the raster covering fraction of its width and height
+    width = max(1, int(ds.RasterXSize * fraction))
+    height = max(1, int(ds.RasterYSize * fraction))
+    x0 = (ds.RasterXSize - width) // 2
+    y0 = (ds.RasterYSize - height) // 2
+    return x0, y0, width, height
+
+
+def cog_viewport_bytes(ds, window, screen_size):
+    x0, y0, width, height = window
+    scale = max(float(width) / screen_size[0], float(height) / screen_size[1])
+    band, factor = pick_level(ds, scale)
+
+    block_w, block_h = band.GetBlockSize()
+    bx0 = int(x0 / factor) // block_w
+    by0 = int(y0 / factor) // block_h
+    bx1 = int(math.ceil((x0 + width) / factor - 1)) // block_w
+    by1 = int(math.ceil((y0 + height) / factor - 1)) // block_h
+
+    total = HEADER_BYTES
+    tiles = 0
+    for by in range(by0, by1 + 1):
+        for bx in range(bx0, bx1 + 1):
+            total += block_bytes(band, bx, by)
+            tiles += 1
+    return total, tiles, factor
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input", help="Source raster, e.g. a plume _rgb.tif or _ctr.tif", type=str)
+    parser.add_argument("-s", "--screen", help="Viewport size in screen pixels", type=int, nargs=2, default=[1024, 768])
+    parser.add_argument("-z", "--zoom", help="Fractions of the raster extent shown in the viewport", type=float, nargs='+', default=[1.0, 0.25, 0.05])
+    args = parser.parse_args()
+
+    name = os.path.basename(args.input)
+    plain_ds, plain_path = raster.warp_to_memory(args.input, name)
+    plain_ds = None
+    cog_ds, cog_path = raster.warp_to_memory(args.input, name, cog=True)
+
+    try:
+        plain_size = memory_file_size(plain_path)
+        cog_size = memory_file_size(cog_path)
+
+        print("%s: %dx%d pixels in EPSG:3857" % (name, cog_ds.RasterXSize, cog_ds.RasterYSize))
+        print("    plain GeoTIFF  %12d bytes" % plain_size)
+        print("    COG            %12d bytes" % cog_size)
+        print("")
+        print("    %-8s %-10s %8s %16s %16s %8s" % ("extent", "level", "tiles", "plain (bytes)", "COG (bytes)", "ratio"))
+        for fraction in args.zoom:
+            window = viewport_window(cog_ds, fraction)
+            fetched, tiles, factor = cog_viewport_bytes(cog_ds, window, args.screen)
+            print("    %-8s %-10s %8d %16d %16d %7.1f%%" % ("%g" % fraction, "1/%g" % factor, tiles,
+                                                           plain_size, fetched, 100.0 * fetched / plain_size))
+    finally:
+        cog_ds = None
+        raster.free_memory_file(plain_path)
+        raster.free_memory_file(cog_path)
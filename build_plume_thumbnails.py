@@ -0,0 +1,109 @@
+import argparse
+import ingestutils.s3util as s3util
+from ingestutils.progress import StageTimer
+from ingest_plumes_to_sql_permian import connect_to_db
+from ingestutils import db
+from psycopg2.extras import Json
+
+
+# aviris_plumes image column for each key of the thumbnails column
+THUMBNAIL_SOURCES = [
+    ("rgb_png", "png_url"),
+    ("plume_png", "plume_url"),
+    ("rgbqlctr_png", "rgbqlctr_url")
+]
+
+
+def get_s3_key_from_url(url, s3_bucket):
+    prefix = s3util.get_s3_url(s3_bucket, "")
+    if url is None or not url.startswith(prefix):
+        return None
+    return url[len(prefix):]
+
+
+def fetch_plume_images(cur, candidate_ids=None):
+    sql = "select plume_id, candidate_id, %s, thumbnails from aviris_plumes" % ", ".join(c for k, c in THUMBNAIL_SOURCES)
+    if candidate_ids:
+        cur.execute(sql + " where candidate_id = any(%s) order by plume_id", (list(candidate_ids),))
+    else:
+        cur.execute(sql + " order by plume_id")
+    return cur.fetchall()
+
+
+def add_missing_thumbnails(client, uploader, row, sizes, s3_bucket, verbose=False, timer=None):
+    """
+    Makes the thumbnail sizes a plume record doesn't have yet from its
+    uploaded PNGs, each PNG downloaded and decoded once. Returns the updated
+    thumbnails value (with URL futures), or None if nothing was missing.
+    """
+    if timer is None:
+        timer = StageTimer()
+
+    plume_id, candidate_id = row[0], row[1]
+    urls = row[2:2 + len(THUMBNAIL_SOURCES)]
+    thumbnails = dict(row[-1] or {})
+
+    changed = False
+    for (kind, column), url in zip(THUMBNAIL_SOURCES, urls):
+        existing = thumbnails.get(kind) or {}
+        missing = [size for size in sizes if str(size) not in existing]
+        key = get_s3_key_from_url(url, s3_bucket)
+        if len(missing) == 0 or key is None:
+            continue
+
+        if verbose:
+            print("Candidate %s: making %s thumbnails %s" % (candidate_id, kind, ", ".join(map(str, missing))))
+
+        with timer.stage("download"):
+            data = client.get_object(Bucket=s3_bucket, Key=key)["Body"].read()
+        with timer.stage("thumbnails"):
+            futures = uploader.upload_thumbnails(key, data=data, sizes=missing)
+
+        merged = dict(existing)
+        merged.update(futures)
+        thumbnails[kind] = merged
+        changed = True
+
+    return thumbnails if changed else None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Adds any missing thumbnail sizes to already ingested AVIRIS plumes")
+    parser.add_argument("-s", "--sizes", help="Thumbnail sizes (longest side, pixels)", type=int, nargs='+', default=s3util.THUMBNAIL_SIZES, required=False)
+    parser.add_argument("-c", "--candidates", help="Only these candidate IDs", type=str, nargs='+', default=None, required=False)
+    parser.add_argument("-b", "--bucket", help="Target S3 Bucket", type=str, default="bucket", required=False)
+    parser.add_argument("-v", "--verbose",
+                        help="Extra output",
+                        required=False, action="store_true")
+    parser.add_argument("-t", "--test",
+                        help="Test. Don't actually upload to S3 or PostgreSQL.",
+                        required=False, action="store_true")
+    args = parser.parse_args()
+
+    s3_bucket = args.bucket
+    test_only = args.test
+    verbose = args.verbose
+
+    timer = StageTimer()
+    client = s3util.get_s3_client()
+    conn = connect_to_db()
+    cur = conn.cursor()
+
+    with s3util.S3Uploader(s3_bucket=s3_bucket, test_only=test_only, client=client) as uploader:
+        for row in fetch_plume_images(cur, args.candidates):
+            thumbnails = add_missing_thumbnails(client, uploader, row, args.sizes, s3_bucket, verbose=verbose, timer=timer)
+            if thumbnails is None:
+                continue
+            with timer.stage("upload-wait"):
+                thumbnails = s3util.resolve_futures(thumbnails)
+            with timer.stage("db"):
+                cur.execute("update aviris_plumes set thumbnails = %s where plume_id = %s", (Json(thumbnails), row[0]))
+
+    if test_only:
+        conn.rollback()
+    else:
+        conn.commit()
+    cur.close()
+    db.release(conn)
+
+    timer.report()
@@ -0,0 +1,188 @@
+import os
+import time
+import argparse
+from ingestutils import db
+from ingestutils import export
+
+# For each exported table: its (name, expression, Parquet type) columns, the
+# expression of its primary geometry (exported as WKB in a "geometry"
+# column), its GeoParquet geometry types, and its (name, expression)
+# partition keys. Tables are partitioned by whichever of detection/flight
+# date and sector_level_1 they have; sources have neither and are written
+# as a single partition.
+EXPORT_TABLES = {
+    "plumes": {
+        "columns": [
+            ("candidate_id", "candidate_id", "string"),
+            ("plume_id", "plume_id::text", "string"),
+            ("source_id", "source_id::text", "string"),
+            ("line_name", "line_name::text", "string"),
+            ("vista_id", "vista_id::text", "string"),
+            ("plume_latitude_deg", "plume_latitude_deg::double precision", "float64"),
+            ("plume_longitude_deg", "plume_longitude_deg::double precision", "float64"),
+            ("source_latitude_deg", "source_latitude_deg::double precision", "float64"),
+            ("source_longitude_deg", "source_longitude_deg::double precision", "float64"),
+            ("flux", "flux::double precision", "float64"),
+            ("flux_uncertainty", "flux_uncertainty::double precision", "float64"),
+            ("detection_timestamp", "detection_timestamp::timestamp", "timestamp")
+        ],
+        "geometry": "coalesce(plume_location, ST_SetSRID(ST_MakePoint(plume_longitude_deg, plume_latitude_deg), 4326))",
+        "geometry_types": ["Point"],
+        "partitions": [("date", "to_char(detection_timestamp, 'YYYY-MM-DD')")]
+    },
+    "sources": {
+        "columns": [
+            ("source_id", "source_id::text", "string"),
+            ("vista_id", "vista_id::text", "string"),
+            ("source_latitude_deg", "source_latitude_deg::double precision", "float64"),
+            ("source_longitude_deg", "source_longitude_deg::double precision", "float64"),
+            ("total_overflights", "total_overflights::double precision", "float64"),
+            ("source_persistence", "source_persistence::double precision", "float64"),
+            ("q_source_final", "q_source_final::double precision", "float64"),
+            ("q_source_final_sigma", "q_source_final_sigma::double precision", "float64"),
+            ("confidence_in_persistence", "confidence_in_persistence::double precision", "float64"),
+            ("is_active", "is_active", "bool")
+        ],
+        "geometry": "coalesce(source_location, ST_SetSRID(ST_MakePoint(source_longitude_deg, source_latitude_deg), 4326))",
+        "geometry_types": ["Point"],
+        "partitions": []
+    },
+    "aviris_plumes": {
+        "columns": [
+            ("plume_id", "plume_id::bigint", "int64"),
+            ("candidate_id", "candidate_id::text", "string"),
+            ("name", "name", "string"),
+            ("source_id", "source_id::text", "string"),
+            ("aviris_plume_id", "aviris_plume_id::text", "string"),
+            ("plume_latitude", "plume_latitude::double precision", "float64"),
+            ("plume_longitude", "plume_longitude::double precision", "float64"),
+            ("mergedist", "mergedist::double precision", "float64"),
+            ("ime_5", "ime_5::double precision", "float64"),
+            ("ime_10", "ime_10::double precision", "float64"),
+            ("ime_20", "ime_20::double precision", "float64"),
+            ("fetch5", "fetch5::double precision", "float64"),
+            ("fetch10", "fetch10::double precision", "float64"),
+            ("fetch20", "fetch20::double precision", "float64"),
+            ("detid5", "detid5::text", "string"),
+            ("detid10", "detid10::text", "string"),
+            ("detid20", "detid20::text", "string"),
+            ("ul_pixel_coordinate_row", "ul_pixel_coordinate_row::integer", "int32"),
+            ("ul_pixel_coordinate_col", "ul_pixel_coordinate_col::integer", "int32"),
+            ("json_url", "json_url", "string"),
+            ("png_url", "png_url", "string"),
+            ("plume_url", "plume_url", "string"),
+            ("rgbqlctr_url", "rgbqlctr_url", "string"),
+            ("png_url_thumb", "png_url_thumb", "string"),
+            ("plume_url_thumb", "plume_url_thumb", "string"),
+            ("rgbqlctr_url_thumb", "rgbqlctr_url_thumb", "string"),
+            ("plume_tiff_url", "plume_tiff_url", "string"),
+            ("rgb_tiff_url", "rgb_tiff_url", "string"),
+            ("thumbnails", "thumbnails::text", "string"),
+            ("tiles_url", "tiles_url", "string"),
+            ("tiles_min_zoom", "tiles_min_zoom::integer", "int32"),
+            ("tiles_max_zoom", "tiles_max_zoom::integer", "int32"),
+            ("data_date", "data_date::timestamp", "timestamp")
+        ],
+        "geometry": "plume_shape",
+        "geometry_types": ["Polygon"],
+        "partitions": [("date", "to_char(data_date, 'YYYY-MM-DD')")]
+    },
+    "flightlines": {
+        "columns": [
+            ("flight_name", "flight_name", "string"),
+            ("image_url", "image_url", "string"),
+            ("flight_timestamp", "flight_timestamp::timestamp", "timestamp")
+        ],
+        "geometry": "flightline_shape",
+        "geometry_types": ["Polygon"],
+        "partitions": [("date", "to_char(flight_timestamp, 'YYYY-MM-DD')")]
+    },
+    "vista": {
+        "columns": [
+            ("id", "id::bigint", "int64"),
+            ("vista_id", "vista_id::text", "string"),
+            ("category", "category", "string"),
+            ("category_id", "category_id::integer", "int32"),
+            ("name", "name", "string"),
+            ("description", "description", "string"),
+            ("shape_type", "shape_type", "string"),
+            ("longitude", "longitude::double precision", "float64"),
+            ("latitude", "latitude::double precision", "float64"),
+            ("operator", "operator", "string"),
+            ("site_name", "site_name", "string"),
+            ("state", "state", "string"),
+            ("address", "address", "string"),
+            ("sector", "sector", "string"),
+            ("city", "city", "string"),
+            ("sector_level_2", "sector_level_2", "string"),
+            ("sector_level_3", "sector_level_3", "string"),
+            ("is_active", "is_active", "bool")
+        ],
+        "geometry": "coalesce(facility_shape, facility_shape_line, facility_location)",
+        "geometry_types": ["MultiPolygon", "MultiLineString", "Point"],
+        "partitions": [("sector_level_1", "sector_level_1")]
+    }
+}
+
+EXPORT_TABLE_ORDER = ["plumes", "sources", "aviris_plumes", "flightlines", "vista"]
+
+COMPRESSION_CODECS = ["snappy", "zstd", "gzip", "none"]
+
+
+def table_select_sql(table_name, table):
+    """
+    Selects the partition keys, then the columns, then the geometry as WKB,
+    ordered by the partition keys so each partition is written in one run.
+    """
+    columns = list(table["partitions"]) + [(name, expression) for name, expression, _ in table["columns"]]
+    columns.append(("geometry", "ST_AsBinary(%s)" % table["geometry"]))
+    sql = export.select_sql(table_name, columns)
+    if len(table["partitions"]) > 0:
+        sql += " order by " + ", ".join(str(i + 1) for i in range(len(table["partitions"])))
+    return sql
+
+
+def table_schema(table):
+    schema = export.arrow_schema([(name, type_name) for name, _, type_name in table["columns"]] + [("geometry", "binary")])
+    return export.geoparquet_schema(schema, "geometry", table["geometry_types"])
+
+
+def export_table(conn, table_name, output_dir, compression="snappy", batch_size=export.DEFAULT_BATCH_SIZE, verbose=False):
+    table = EXPORT_TABLES[table_name]
+    start = time.time()
+    batches = export.iter_batches(conn, table_select_sql(table_name, table), batch_size=batch_size)
+    rows, files = export.write_partitioned_parquet(os.path.join(output_dir, table_name), table_schema(table),
+                                                   [name for name, _ in table["partitions"]], batches, compression)
+    if verbose:
+        print("Exported %d %s rows to %d files in %.1fs" % (rows, table_name, files, time.time() - start))
+    return rows
+
+
+def export_tables(output_dir, table_names=EXPORT_TABLE_ORDER, compression="snappy", batch_size=export.DEFAULT_BATCH_SIZE, verbose=False):
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    conn = db.connect()
+    try:
+        # One repeatable read snapshot, so rows referenced across tables
+        # are consistent in the export
+        conn.set_session(isolation_level="REPEATABLE READ", readonly=True)
+        for table_name in table_names:
+            export_table(conn, table_name, output_dir, compression, batch_size, verbose)
+    finally:
+        conn.rollback()
+        conn.set_session(isolation_level="DEFAULT", readonly="DEFAULT")
+        db.release(conn)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-o", "--output", help="Output directory, one GeoParquet dataset per table", required=True, type=str)
+    parser.add_argument("-t", "--tables", help="Tables to export", nargs="+", choices=EXPORT_TABLE_ORDER, default=EXPORT_TABLE_ORDER, required=False)
+    parser.add_argument("-c", "--compression", help="Parquet compression codec", choices=COMPRESSION_CODECS, default="snappy", required=False)
+    parser.add_argument("-b", "--batch", help="Rows fetched and written per batch", type=int, default=export.DEFAULT_BATCH_SIZE, required=False)
+    parser.add_argument("-v", "--verbose", help="Verbose output", action="store_true")
+
+    args = parser.parse_args()
+
+    export_tables(args.output, args.tables, args.compression, args.batch, args.verbose)
@@ -6,15 +6,10 @@ import requests
 import json
 from osgeo import gdal,ogr,osr
 import argparse
-import psycopg2
+from ingestutils.features import iter_layers, iter_features
+from ingestutils import db
 
 
-DB_ENDPOINT = "localhost"
-DB_PORT = 5432
-DB_USER = ""
-DB_PASSWD = ""
-DB_NAME = ""
-
 
 
 def ingest_counties_shapefile(shpfile_path,  solr_host=None, test_only=False, verbose=False):
@@ -22,27 +17,24 @@ def ingest_counties_shapefile(shpfile_path,  solr_host=None, test_only=False, ve
         print "Processing input file:", shpfile_path
 
     if verbose is True:
-        print "Loading file into memory..."
+        print "Opening file..."
 
     file = ogr.Open(shpfile_path)
 
     targetSpatialRef = osr.SpatialReference()
     targetSpatialRef.ImportFromEPSG(4326)
 
-    conn = psycopg2.connect(dbname=DB_NAME, user=DB_USER, password=DB_PASSWD, host=DB_ENDPOINT, port=DB_PORT)
+    conn = db.connect()
     cur = conn.cursor()
 
-    for layer_num in range(0, file.GetLayerCount()):
-        layer = file.GetLayer(layer_num)
+    for layer in iter_layers(file):
 
         layerDefinition = layer.GetLayerDefn()
 
         spatialRef = layer.GetSpatialRef()
         transform = osr.CoordinateTransformation(spatialRef, targetSpatialRef)
 
-        for feature_num in range(0, layer.GetFeatureCount()):
-
-            feature = layer.GetFeature(feature_num)
+        for feature in iter_features(layer):
 
             geom = feature.GetGeometryRef()
             geom.Transform(transform)
@@ -104,7 +96,7 @@ def ingest_counties_shapefile(shpfile_path,  solr_host=None, test_only=False, ve
 
     conn.commit()
     cur.close()
-    conn.close()
+    db.release(conn)
 
 
 def gdal_error_handler(err_class, err_num, err_msg):
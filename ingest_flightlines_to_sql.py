@@ -1,84 +1,43 @@
-import utm
-import numpy as np
 import os
 import os.path
+import sys
+import traceback
 import requests
 import json
 import argparse
 import ingestutils.s3util as s3util
+from ingestutils import envi, geometry
+from ingestutils import db
 
-import psycopg2
 
 
-DB_ENDPOINT = "localhost"
-DB_PORT = 5432
-DB_USER = ""
-DB_PASSWD = ""
-DB_NAME = ""
+# Header fields needed for the footprint; parsing stops once they are read
+HDR_KEYS = ["samples", "lines", "map info"]
 
+# The parsed "map info" values compute_bounds uses
+MAP_INFO_KEYS = ["easting", "northing", "easting_scale", "northing_scale", "rotation", "zone", "northern"]
 
 
-def compute_bounds(easting, northing, samples, lines, easting_scale, northing_scale, zone, rotation):
-    tl_m = [0.0, 0.0]
-    tr_m = [(samples * easting_scale), 0]
-    bl_m = [0, -(lines * northing_scale)]
-    br_m = [(samples * easting_scale), -(lines * northing_scale)]
 
-    theta = np.radians(rotation)
-    R = np.array([[np.cos(theta), -np.sin(theta)], [np.sin(theta), np.cos(theta)]])
-
-    tl_m = np.dot(R, tl_m)
-    tr_m = np.dot(R, tr_m)
-    bl_m = np.dot(R, bl_m)
-    br_m = np.dot(R, br_m)
-
-    tl_m += [easting, northing]
-    tr_m += [easting, northing]
-    bl_m += [easting, northing]
-    br_m += [easting, northing]
-
-    tl = utm.to_latlon(tl_m[0], tl_m[1], zone, 'U')
-    tr = utm.to_latlon(tr_m[0], tr_m[1], zone, 'U')
-    bl = utm.to_latlon(bl_m[0], bl_m[1], zone, 'U')
-    br = utm.to_latlon(br_m[0], br_m[1], zone, 'U')
-
-    return tl, tr, bl, br
-
-
-def hackish_utm_string_parse(s):
-    parts = s[2:-2].split(", ")
-    easting = float(parts[3])
-    northing = float(parts[4])
-    easting_scale = float(parts[5])
-    northing_scale = float(parts[6])
-    zone = parts[7]
-    northing_hemi = parts[8]
-    rotation = float(parts[11].split("=")[1])
-
-    return {
-        "easting": easting,
-        "northing": northing,
-        "easting_scale": easting_scale,
-        "northing_scale": northing_scale,
-        "zone": int(zone),
-        "northing_hemi" : northing_hemi,
-        "rotation": rotation
-    }
-
-
-def read_hdr_file(image_path):
-    hdr_file_path = image_path[:-4] + ".hdr"
-    f = open(hdr_file_path, "r")
-    d = f.readlines()
-    f.close()
+def compute_bounds(projections, samples, lines):
+    """
+    Lon/lat corners of many flightlines at once. projections is a list of
+    parsed ENVI "map info" values and samples/lines the matching image
+    sizes. Returns an (N, 4, 2) array of (lon, lat) corners in the order
+    top-left, top-right, bottom-left, bottom-right.
+    """
+    corners_m = geometry.rotated_grid_corners([p["easting"] for p in projections],
+                                              [p["northing"] for p in projections],
+                                              samples,
+                                              lines,
+                                              [p["easting_scale"] for p in projections],
+                                              [p["northing_scale"] for p in projections],
+                                              [p["rotation"] for p in projections])
 
-    hdr_props = {}
+    zones = [p["zone"] for p in projections]
+    northern = [p["northern"] for p in projections]
+    return geometry.utm_to_lonlat(corners_m, zones, northern)
 
-    for line in d:
-        parts = line.split(" = ")
-        if len(parts) == 2:
-            hdr_props[parts[0]] = parts[1].strip()
-    return hdr_props
 
 def parse_flight_date_from_filename(image_path):
     bn = os.path.basename(image_path)
@@ -95,58 +54,51 @@ def parse_flight_date_from_filename(image_path):
 
 
 
-def compute_bounds_from_hdr_props(image_path):
-    hdr_props = read_hdr_file(image_path)
-
-    lines = int(hdr_props["lines"])
-    samples = int(hdr_props["samples"])
-    map_info_string = hdr_props["map info"]
-
-    projection = hackish_utm_string_parse(map_info_string)
-
-    easting = projection["easting"]
-    northing = projection["northing"]
-    easting_scale = projection["easting_scale"]
-    northing_scale = projection["northing_scale"]
-    zone = projection["zone"]
-    rotation = projection["rotation"]
-
-    tl, tr, bl, br = compute_bounds(easting, northing, samples, lines, easting_scale, northing_scale, zone, rotation)
-
-    return tl, tr, bl, br
-
-
-
-def does_flightline_exist_in_db(cur, flight_name):
-    sql = """
-    select count(1) from flightlines where flight_name = %s;
+def compute_footprints_from_hdr_props(image_paths):
     """
-    cur.execute(sql, (flight_name,))
-    row = cur.fetchone()
-    return row[0] >= 1
-
-
-
-def update_in_db(cur, flight_name, data_date, image_url, poly):
-    sql = """
-    update flightlines
-        set image_url=%s, 
-          flightline_shape=ST_GeomFromText(%s, 4326),
-          flight_timestamp=to_timestamp(%s, 'yyyy-mm-dd hh24:mi:ss')
-    where
-      flight_name = %s
+    Reads the ENVI header next to each image and returns the flightline
+    footprints as WKT polygons, in the order of image_paths. An image whose
+    header can't be read or lacks a field is reported and gets None, and
+    the rest are computed without it.
     """
-
-    cur.execute(sql,
-                (
-                    image_url,
-                    poly,
-                    data_date,
-                    flight_name
-                )
-            )
-
-def insert_to_db(cur, flight_name, data_date, image_url, poly):
+    polys = [None] * len(image_paths)
+
+    readable = []
+    projections = []
+    samples = []
+    lines = []
+    for i, image_path in enumerate(image_paths):
+        try:
+            hdr_props = envi.read_header(image_path, keys=HDR_KEYS)
+            projection = hdr_props["map info"]
+            missing = [key for key in MAP_INFO_KEYS if key not in projection]
+            if missing:
+                raise ValueError("map info is missing %s" % ", ".join(missing))
+            image_samples = hdr_props["samples"]
+            image_lines = hdr_props["lines"]
+        except Exception:
+            print("Failed to read the header of %s:" % image_path)
+            traceback.print_exc()
+            continue
+        readable.append(i)
+        projections.append(projection)
+        samples.append(image_samples)
+        lines.append(image_lines)
+
+    if len(readable) == 0:
+        return polys
+
+    corners = compute_bounds(projections, samples, lines)
+
+    for i, (tl, tr, bl, br) in zip(readable, corners):
+        polys[i] = geometry.polygon_wkt([tl, bl, br, tr])
+    return polys
+
+
+
+def upsert_in_db(cur, flight_name, data_date, image_url, poly):
+    # flight_name is unique (sql/005_loader_upsert_keys.sql), so a reprocessed
+    # flightline updates its row in the same statement that would insert it
     sql = """
     insert into flightlines
         (
@@ -163,9 +115,13 @@ def insert_to_db(cur, flight_name, data_date, image_url, poly):
            to_timestamp(%s, 'yyyy-mm-dd hh24:mi:ss')
 
         )
+    on conflict (flight_name) do update
+        set image_url=excluded.image_url,
+          flightline_shape=excluded.flightline_shape,
+          flight_timestamp=excluded.flight_timestamp
     """
 
-    cur.execute(sql,
+    db.execute_prepared(cur, "upsert_flightline", sql,
                 (
                     flight_name,
                     image_url,
@@ -175,33 +131,23 @@ def insert_to_db(cur, flight_name, data_date, image_url, poly):
             )
 
 def insert_flightline_to_db(cur, flight_name, data_date, image_url, poly):
-    exists = does_flightline_exist_in_db(cur, flight_name)
-
-    if exists:
-        update_in_db(cur, flight_name, data_date, image_url, poly)
-    else:
-        insert_to_db(cur, flight_name, data_date, image_url, poly)
+    upsert_in_db(cur, flight_name, data_date, image_url, poly)
 
 
 
 
-def ingest_flightline_image(image_path, s3_bucket="bucket", test_only=False, verbose=False):
-    tl, tr, bl, br = compute_bounds_from_hdr_props(image_path)
-
-    tl = [tl[1], tl[0]]
-    tr = [tr[1], tr[0]]
-    bl = [bl[1], bl[0]]
-    br = [br[1], br[0]]
+def ingest_flightline_image(image_path, s3_bucket="bucket", test_only=False, verbose=False, poly=None):
+    if poly is None:
+        poly = compute_footprints_from_hdr_props([image_path])[0]
+        if poly is None:
+            raise Exception("No footprint for %s" % image_path)
 
     flight_name = os.path.basename(image_path)[:18]
     data_date = parse_flight_date_from_filename(image_path)
     image_url = s3util.upload_file_to_s3(image_path, s3_bucket=s3_bucket, test_only=test_only)
 
-    shape = [tl, bl, br, tr, tl]
-    poly = "POLYGON((" + ",".join([" ".join(map(str, p)) for p in shape]) + "))"
-
     # Create cursor
-    conn = psycopg2.connect(dbname=DB_NAME, user=DB_USER, password=DB_PASSWD, host=DB_ENDPOINT, port=DB_PORT)
+    conn = db.connect()
     cur = conn.cursor()
 
     insert_flightline_to_db(cur, flight_name, data_date, image_url, poly)
@@ -211,7 +157,7 @@ def ingest_flightline_image(image_path, s3_bucket="bucket", test_only=False, ver
     else:
         conn.commit()
     cur.close()
-    conn.close()
+    db.release(conn)
 
 
 
@@ -237,5 +183,17 @@ if __name__ == "__main__":
     test_only = args.test
     verbose = args.verbose
 
-    for input_file in input_files:
-        ingest_flightline_image(input_file, s3_bucket=s3_bucket, test_only=test_only, verbose=verbose)
\ No newline at end of file
+    # Footprints for every input are computed up front in one batch; a
+    # flightline whose header couldn't be read is left out
+    polys = compute_footprints_from_hdr_props(input_files)
+
+    failed = []
+    for input_file, poly in zip(input_files, polys):
+        if poly is None:
+            failed.append(input_file)
+            continue
+        ingest_flightline_image(input_file, s3_bucket=s3_bucket, test_only=test_only, verbose=verbose, poly=poly)
+
+    if failed:
+        print("Skipped %d flightline(s) with unreadable headers: %s" % (len(failed), ", ".join(failed)))
+        sys.exit(1)
\ No newline at end of file
@@ -1,13 +1,8 @@
 import argparse
-import psycopg2
-import csv
 import traceback
-
-DB_ENDPOINT = "localhost"
-DB_PORT = 5432
-DB_USER = ""
-DB_PASSWD = ""
-DB_NAME = ""
+from ingestutils import bulk
+from ingestutils.csvrecords import CsvRecordReader
+from ingestutils import db
 
 class PlumeHeaders:
     SOURCE_ID = "source_id"
@@ -20,56 +15,48 @@ class PlumeHeaders:
     IPCC = "ipcc"
     Q_PLUME = "qplume"
     SIGMA_QPLUME = "sigma_qplume"
-    
-def process_row(headers, row):
-    datamap = {}
-
-    for i in range(0, len(headers)):
-        header = headers[i].strip()
-        value = row[i]
-        datamap[header] = value
-
-    return datamap
-
-
-def parse_csv(input_file, verbose=False):
-    datamap = []
-    with open(input_file) as csvfile:
-        data = csv.reader(csvfile, delimiter=',', quotechar='\"')
-        row_num = 0
-        headers = []
-        for row in data:
-            if row_num == 0:
-                headers = row
-            else:
-                row_data = process_row(headers, row)
-                datamap.append(row_data)
-            row_num += 1
-    return datamap
-
-
-def str_to_float(s):
-    if s == "TBD":
-        return -9999.0
-    elif s != "TBD" and s is not None and len(s) > 0:
-        return float(s)
-    else:
-        return None
 
-def upload_plume(plume, cur, verbose=False, test_only=False):
 
+PLUME_COLUMNS = [
+    PlumeHeaders.SOURCE_ID,
+    PlumeHeaders.PLUME_LATITUDE,
+    PlumeHeaders.PLUME_LONGITUDE,
+    PlumeHeaders.CANDIDATE_ID,
+    PlumeHeaders.DATE_OF_DETECTION,
+    PlumeHeaders.TIME_OF_DETECTION,
+    PlumeHeaders.Q_PLUME,
+    PlumeHeaders.SIGMA_QPLUME
+]
 
-    if does_plume_exist(plume[PlumeHeaders.CANDIDATE_ID], cur) is True:
-        if verbose:
-            print("Plume already exists, updating: ", plume[PlumeHeaders.CANDIDATE_ID])
-        update_plume(plume, cur, verbose, test_only)
-    elif verbose:
+PLUME_FLOAT_COLUMNS = [
+    PlumeHeaders.PLUME_LATITUDE,
+    PlumeHeaders.PLUME_LONGITUDE,
+    PlumeHeaders.Q_PLUME,
+    PlumeHeaders.SIGMA_QPLUME
+]
+
+# A TBD plume location is unknown, not a point at -9999, -9999
+PLUME_COORDINATE_COLUMNS = [
+    PlumeHeaders.PLUME_LATITUDE,
+    PlumeHeaders.PLUME_LONGITUDE
+]
+
+
+def read_plumes(input_file):
+    return CsvRecordReader(input_file, PLUME_COLUMNS, PLUME_FLOAT_COLUMNS, name="PlumeRecord",
+                           null_tbd_columns=PLUME_COORDINATE_COLUMNS)
+
+
+def upload_plume(plume, cur, verbose=False, test_only=False):
+    if verbose:
         print("Ingesting plume", plume[PlumeHeaders.CANDIDATE_ID])
-        insert_plume(plume, cur, verbose, test_only)
+    upsert_plume(plume, cur, verbose, test_only)
 
 
-def insert_plume(plume, cur, verbose=False, test_only=False):
+def upsert_plume(plume, cur, verbose=False, test_only=False):
     # this simplified version is not making geom points atm, will revisit later, refer to ingest_plume_csv_to_sql.py
+    # candidate_id is unique (sql/001_plumes_sources_natural_keys.sql), so an
+    # existing plume is updated by the same statement that would insert it
     sql = """
         INSERT INTO plumes
           (
@@ -89,12 +76,26 @@ def insert_plume(plume, cur, verbose=False, test_only=False):
     	    detection_timestamp
             )
     	VALUES (
-    	  %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s,
+    	  %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s,
     	   to_timestamp(%s, 'yyyy-mm-dd hh24:mi:ss')
-    	  );
+    	  )
+        ON CONFLICT (candidate_id) DO UPDATE SET
+            plume_id = excluded.plume_id,
+            plume_latitude_deg = excluded.plume_latitude_deg,
+            plume_longitude_deg = excluded.plume_longitude_deg,
+            source_id = excluded.source_id,
+            source_latitude_deg = excluded.source_latitude_deg,
+            source_longitude_deg = excluded.source_longitude_deg,
+            line_name = excluded.line_name,
+            vista_id = excluded.vista_id,
+            source_location = excluded.source_location,
+            plume_location = excluded.plume_location,
+            flux = excluded.flux,
+            flux_uncertainty = excluded.flux_uncertainty,
+            detection_timestamp = excluded.detection_timestamp
         """
 
-    cur.execute(sql,
+    db.execute_prepared(cur, "upsert_plume", sql,
                 (
                     plume[PlumeHeaders.CANDIDATE_ID],
                     plume[PlumeHeaders.PLUME_LATITUDE],
@@ -121,63 +122,8 @@ def insert_plume(plume, cur, verbose=False, test_only=False):
                 ))
 
 
-def update_plume(plume, cur, verbose=False, test_only=False):
-    # this simplified version is not making geom points atm, will revisit later, refer to ingest_plume_csv_to_sql.py
-    sql = """update plumes set 
-            plume_id=%s, 
-    	    plume_latitude_deg=%s, 
-    	    plume_longitude_deg=%s, 
-    	    source_id=%s, 
-    	    source_latitude_deg=%s, 
-    	    source_longitude_deg=%s, 
-    	    candidate_id=%s, 
-    	    line_name=%s, 
-            vista_id=%s,
-    	    source_location=%s, 
-    	    plume_location=%s,
-            flux=%s,
-            flux_uncertainty=%s,
-    	    detection_timestamp=to_timestamp(%s, 'yyyy-mm-dd hh24:mi:ss')
-    	where 
-    	plume_id = %s
-    """
-
-    cur.execute(sql,
-                (
-                    plume[PlumeHeaders.CANDIDATE_ID],
-                    plume[PlumeHeaders.PLUME_LATITUDE],
-                    plume[PlumeHeaders.PLUME_LONGITUDE],
-                    plume[PlumeHeaders.SOURCE_ID],
-                    # plume[PlumeHeaders.SOURCE_LATITUDE],
-                    # plume[PlumeHeaders.SOURCE_LONGITUDE],
-                    plume[PlumeHeaders.PLUME_LATITUDE],
-                    plume[PlumeHeaders.PLUME_LONGITUDE],
-                    plume[PlumeHeaders.CANDIDATE_ID],
-                    #plume[PlumeHeaders.LINE_NAME],
-                    # plume[PlumeHeaders.VISTA_ID],
-                    plume[PlumeHeaders.CANDIDATE_ID].split("-")[0],
-                    None,
-                    # str_to_float(plume[PlumeHeaders.SOURCE_LONGITUDE]),
-                    # str_to_float(plume[PlumeHeaders.SOURCE_LATITUDE]),
-                    # str_to_float(plume[PlumeHeaders.PLUME_LONGITUDE]),
-                    # str_to_float(plume[PlumeHeaders.PLUME_LATITUDE]),
-                    None,
-                    None,
-                    plume[PlumeHeaders.Q_PLUME],
-                    plume[PlumeHeaders.SIGMA_QPLUME],
-                    "%s %s" % (plume[PlumeHeaders.DATE_OF_DETECTION], plume[PlumeHeaders.TIME_OF_DETECTION]),
-                    plume[PlumeHeaders.CANDIDATE_ID]
-                ))
-
-def does_plume_exist(candidate_id, cur):
-    cur.execute("select count(candidate_id) as plume_count from plumes where candidate_id=%s",
-                (candidate_id,))
-    row = cur.fetchone()
-    return row[0] >= 1
-
-
 def upload_plumes(plumes, verbose=False, test_only=False):
-    conn = psycopg2.connect(dbname=DB_NAME, user=DB_USER, password=DB_PASSWD, host=DB_ENDPOINT, port=DB_PORT)
+    conn = db.connect()
     cur = conn.cursor()
 
     try:
@@ -192,12 +138,127 @@ def upload_plumes(plumes, verbose=False, test_only=False):
         conn.commit()
 
     cur.close()
-    conn.close()
+    db.release(conn)
+
+
+PLUME_STAGING_COLUMNS = [
+    ("row_num", "integer"),
+    ("candidate_id", "text"),
+    ("plume_latitude_deg", "double precision"),
+    ("plume_longitude_deg", "double precision"),
+    ("source_id", "text"),
+    ("line_name", "text"),
+    ("flux", "numeric"),
+    ("flux_uncertainty", "numeric"),
+    ("detection_timestamp", "text")
+]
+
+
+def plume_to_staging_row(row_num, plume):
+    return (
+        row_num,
+        plume[PlumeHeaders.CANDIDATE_ID],
+        plume[PlumeHeaders.PLUME_LATITUDE],
+        plume[PlumeHeaders.PLUME_LONGITUDE],
+        plume[PlumeHeaders.SOURCE_ID],
+        plume[PlumeHeaders.CANDIDATE_ID].split("-")[0],
+        plume[PlumeHeaders.Q_PLUME],
+        plume[PlumeHeaders.SIGMA_QPLUME],
+        "%s %s" % (plume[PlumeHeaders.DATE_OF_DETECTION], plume[PlumeHeaders.TIME_OF_DETECTION])
+    )
+
+
+def merge_staged_plumes(cur):
+    # Later rows win when a candidate id is repeated in the file, matching
+    # the row-by-row update behaviour.
+    sql = """
+        insert into plumes
+          (
+            plume_id,
+            plume_latitude_deg,
+            plume_longitude_deg,
+            source_id,
+            source_latitude_deg,
+            source_longitude_deg,
+            candidate_id,
+            line_name,
+            vista_id,
+            source_location,
+            plume_location,
+            flux,
+            flux_uncertainty,
+            detection_timestamp
+          )
+        select distinct on (s.candidate_id)
+            s.candidate_id,
+            s.plume_latitude_deg,
+            s.plume_longitude_deg,
+            s.source_id,
+            s.plume_latitude_deg,
+            s.plume_longitude_deg,
+            s.candidate_id,
+            s.line_name,
+            null,
+            ST_SetSRID(ST_MakePoint(s.plume_longitude_deg, s.plume_latitude_deg), 4326),
+            ST_SetSRID(ST_MakePoint(s.plume_longitude_deg, s.plume_latitude_deg), 4326),
+            s.flux,
+            s.flux_uncertainty,
+            to_timestamp(s.detection_timestamp, 'yyyy-mm-dd hh24:mi:ss')
+        from plumes_staging s
+        order by s.candidate_id, s.row_num desc
+        on conflict (candidate_id) do update set
+            plume_id = excluded.plume_id,
+            plume_latitude_deg = excluded.plume_latitude_deg,
+            plume_longitude_deg = excluded.plume_longitude_deg,
+            source_id = excluded.source_id,
+            source_latitude_deg = excluded.source_latitude_deg,
+            source_longitude_deg = excluded.source_longitude_deg,
+            line_name = excluded.line_name,
+            vista_id = excluded.vista_id,
+            source_location = excluded.source_location,
+            plume_location = excluded.plume_location,
+            flux = excluded.flux,
+            flux_uncertainty = excluded.flux_uncertainty,
+            detection_timestamp = excluded.detection_timestamp
+    """
+    cur.execute(sql)
+    return cur.rowcount
+
+
+def bulk_upload_plumes(plumes, verbose=False, test_only=False):
+    """
+    Loads all plumes with one COPY into a staging table and one set-based
+    upsert. Needs the unique index from sql/001_plumes_sources_natural_keys.sql.
+    """
+    conn = db.connect()
+    cur = conn.cursor()
+
+    try:
+        bulk.create_staging_table(cur, "plumes_staging", PLUME_STAGING_COLUMNS)
+        staged = bulk.copy_rows(cur, "plumes_staging", [c[0] for c in PLUME_STAGING_COLUMNS],
+                                (plume_to_staging_row(i, plume) for i, plume in enumerate(plumes)))
+        merged = merge_staged_plumes(cur)
+        if verbose:
+            print("Staged %s plume rows, merged %s into plumes" % (staged, merged))
+    except:
+        conn.rollback()
+        raise
+
+    if test_only:
+        conn.rollback()
+    else:
+        conn.commit()
+
+    cur.close()
+    db.release(conn)
 
 
-def process_csv(input_file, verbose=False, test_only=False):
-    data = parse_csv(input_file, verbose)
-    upload_plumes(data, verbose, test_only)
+def process_csv(input_file, verbose=False, test_only=False, bulk_load=False):
+    data = read_plumes(input_file)
+    if bulk_load:
+        bulk_upload_plumes(data, verbose, test_only)
+    else:
+        upload_plumes(data, verbose, test_only)
 
 
 
@@ -214,11 +275,15 @@ if __name__ == "__main__":
     parser.add_argument("-t", "--test",
                         help="Test. Don't actually upload to PostgreSQL.",
                         required=False, action="store_true")
+    parser.add_argument("-B", "--bulk",
+                        help="Load with COPY into a staging table and a single upsert instead of row-by-row statements",
+                        required=False, action="store_true")
 
     args = parser.parse_args()
     input_files = args.data
     verbose = args.verbose
     test_only = args.test
+    bulk_load = args.bulk
 
     for input_file in input_files:
-        process_csv(input_file, verbose=verbose, test_only=test_only)
+        process_csv(input_file, verbose=verbose, test_only=test_only, bulk_load=bulk_load)
@@ -7,16 +7,11 @@ import openpyxl
 import types
 import os
 import uuid
-import psycopg2
-import csv
+from ingestutils import bulk
+from ingestutils.csvrecords import CsvRecordReader
+from ingestutils import db
 
 
-DB_ENDPOINT = "localhost"
-DB_PORT = 5432
-DB_USER = ""
-DB_PASSWD = ""
-DB_NAME = ""
-
 VISTA_NA_FILL_VALUE = "NA"
 
 class ColumnHeaders:
@@ -32,6 +27,32 @@ class ColumnHeaders:
     SIGMA_QSOURCE = "sigma_qsource"
 
 
+SOURCE_COLUMNS = [
+    ColumnHeaders.SOURCE_ID,
+    ColumnHeaders.SOURCE_LATITUDE,
+    ColumnHeaders.SOURCE_LONGITUDE,
+    ColumnHeaders.NUMBER_OVERFLIGHTS,
+    ColumnHeaders.SOURCE_PERSISTENCE,
+    ColumnHeaders.CONFIDENCE_IN_PERSISTENCE,
+    ColumnHeaders.Q_SOURCE,
+    ColumnHeaders.SIGMA_QSOURCE
+]
+
+# "#DIV/0!" and empty cells become None, "TBD" becomes -9999 except in the
+# coordinates, where it becomes None
+SOURCE_FLOAT_COLUMNS = SOURCE_COLUMNS[1:]
+
+SOURCE_COORDINATE_COLUMNS = [
+    ColumnHeaders.SOURCE_LATITUDE,
+    ColumnHeaders.SOURCE_LONGITUDE
+]
+
+
+def read_sources(input_file):
+    return CsvRecordReader(input_file, SOURCE_COLUMNS, SOURCE_FLOAT_COLUMNS, name="SourceRecord",
+                           null_tbd_columns=SOURCE_COORDINATE_COLUMNS)
+
+
 # ColumnLettersSources = {
 #     ColumnHeaders.SOURCE_IDENTIFIER : "A",
 #     ColumnHeaders.SOURCE_LATITUDE : "B",
@@ -44,41 +65,6 @@ class ColumnHeaders:
 #     ColumnHeaders.CONFIDENCE_IN_PERSISTENCE: "I"
 # }
 
-def process_row(headers, row):
-    datamap = {}
-
-    for i in range(0, len(headers)):
-        header = headers[i].strip()
-        value = row[i]
-        datamap[header] = value
-
-    return datamap
-
-
-def parse_csv(input_file, verbose=False):
-    datamap = []
-    with open(input_file) as csvfile:
-        data = csv.reader(csvfile, delimiter=',', quotechar='\"')
-        row_num = 0
-        headers = []
-        for row in data:
-            if row_num == 0:
-                headers = row
-            else:
-                row_data = process_row(headers, row)
-                datamap.append(row_data)
-            row_num += 1
-    return datamap
-
-
-def str_to_float(s):
-    if s == "TBD":
-        return -9999.0
-    elif s != "TBD" and s is not None and len(s) > 0:
-        return float(s)
-    else:
-        return None
-
 # Sources:
 def read_source_record(ws, row_num):
     record_map = {}
@@ -105,48 +91,9 @@ def read_sources_sheet(ws):
     return sources
 
 
-def __check_if_divbyzero(value):
-    if value == "#DIV/0!" or value == '':
-        return None
-    else:
-        return value
-
-
-def update_source(source, cur, verbose=False):
-    sql = """
-        update sources set
-            source_latitude_deg = %s,
-            source_longitude_deg = %s,
-            total_overflights = %s,
-            Source_persistence = %s,
-            q_source_final = %s,
-            q_source_final_sigma = %s,
-            vista_id = %s,
-            source_location = ST_GeomFromText('POINT(%s %s)', 4326),
-            confidence_in_persistence = %s,
-            is_active = true
-          where 
-            source_id = %s;
-    """
-
-    
-    cur.execute(sql,
-                (
-                    source[ColumnHeaders.SOURCE_LATITUDE],
-                    source[ColumnHeaders.SOURCE_LONGITUDE],
-                    source[ColumnHeaders.NUMBER_OVERFLIGHTS],
-                    source[ColumnHeaders.SOURCE_PERSISTENCE],
-                    source[ColumnHeaders.Q_SOURCE],
-                    source[ColumnHeaders.SIGMA_QSOURCE],
-                    None, # source[ColumnHeaders.VISTA_ID] if source[ColumnHeaders.VISTA_ID] != VISTA_NA_FILL_VALUE else None,
-                    float(source[ColumnHeaders.SOURCE_LONGITUDE]),
-                    float(source[ColumnHeaders.SOURCE_LATITUDE]),
-                    source[ColumnHeaders.CONFIDENCE_IN_PERSISTENCE],
-                    source[ColumnHeaders.SOURCE_ID]
-                ))
-
-
-def insert_source(source, cur, verbose=False):
+def upsert_source(source, cur, verbose=False):
+    # source_id is unique (sql/001_plumes_sources_natural_keys.sql), so an
+    # existing source is updated and reactivated by the same statement
     sql = """
         INSERT INTO sources
           (
@@ -170,13 +117,24 @@ def insert_source(source, cur, verbose=False):
             %s,
             %s,
             %s,
-            ST_GeomFromText('POINT(%s %s)', 4326),
+            ST_SetSRID(ST_MakePoint(%s, %s), 4326),
             %s,
             true
           )
+        ON CONFLICT (source_id) DO UPDATE SET
+            source_latitude_deg = excluded.source_latitude_deg,
+            source_longitude_deg = excluded.source_longitude_deg,
+            total_overflights = excluded.total_overflights,
+            Source_persistence = excluded.Source_persistence,
+            q_source_final = excluded.q_source_final,
+            q_source_final_sigma = excluded.q_source_final_sigma,
+            vista_id = excluded.vista_id,
+            source_location = excluded.source_location,
+            confidence_in_persistence = excluded.confidence_in_persistence,
+            is_active = true
     """
 
-    cur.execute(sql,
+    db.execute_prepared(cur, "upsert_source", sql,
                 (
                     source[ColumnHeaders.SOURCE_ID],
                     source[ColumnHeaders.SOURCE_LATITUDE],
@@ -186,8 +144,8 @@ def insert_source(source, cur, verbose=False):
                     source[ColumnHeaders.Q_SOURCE],
                     source[ColumnHeaders.SIGMA_QSOURCE],
                     None, # source[ColumnHeaders.VISTA_ID] if source[ColumnHeaders.VISTA_ID] != VISTA_NA_FILL_VALUE else None,
-                    float(source[ColumnHeaders.SOURCE_LONGITUDE]),
-                    float(source[ColumnHeaders.SOURCE_LATITUDE]),
+                    source[ColumnHeaders.SOURCE_LONGITUDE],
+                    source[ColumnHeaders.SOURCE_LATITUDE],
                     source[ColumnHeaders.CONFIDENCE_IN_PERSISTENCE]
                 ))
 
@@ -197,22 +155,9 @@ def upload_source(source, cur, verbose=False, test_only=False):
 
     if verbose:
         print (source)
+        print("Writing source '%s'"%source[ColumnHeaders.SOURCE_ID])
 
-    if does_source_exist(source[ColumnHeaders.SOURCE_ID], cur) is True:
-        if verbose:
-            print("Source '%s' already in database. Updating"%source[ColumnHeaders.SOURCE_ID])
-        update_source(source, cur, verbose)
-    else:
-        if verbose:
-            print("Source '%s' not yet in database. Inserting"%source[ColumnHeaders.SOURCE_ID])
-        insert_source(source, cur, verbose)
-
-
-def does_source_exist(source_id, cur):
-    cur.execute("select count(source_id) as source_count from sources where source_id=%s",
-                (source_id,))
-    row = cur.fetchone()
-    return row[0] >= 1
+    upsert_source(source, cur, verbose)
 
 
 def set_all_in_db_inactive(cur):
@@ -221,7 +166,7 @@ def set_all_in_db_inactive(cur):
 
 
 def upload_sources(sources, verbose=False, test_only=False):
-    conn = psycopg2.connect(dbname=DB_NAME, user=DB_USER, password=DB_PASSWD, host=DB_ENDPOINT, port=DB_PORT)
+    conn = db.connect()
     cur = conn.cursor()
 
     set_all_in_db_inactive(cur)
@@ -234,7 +179,108 @@ def upload_sources(sources, verbose=False, test_only=False):
     else:
         conn.commit()
     cur.close()
-    conn.close()
+    db.release(conn)
+
+
+SOURCE_STAGING_COLUMNS = [
+    ("row_num", "integer"),
+    ("source_id", "text"),
+    ("source_latitude_deg", "double precision"),
+    ("source_longitude_deg", "double precision"),
+    ("total_overflights", "numeric"),
+    ("source_persistence", "numeric"),
+    ("q_source_final", "numeric"),
+    ("q_source_final_sigma", "numeric"),
+    ("confidence_in_persistence", "numeric")
+]
+
+
+def source_to_staging_row(row_num, source):
+    return (
+        row_num,
+        source[ColumnHeaders.SOURCE_ID],
+        source[ColumnHeaders.SOURCE_LATITUDE],
+        source[ColumnHeaders.SOURCE_LONGITUDE],
+        source[ColumnHeaders.NUMBER_OVERFLIGHTS],
+        source[ColumnHeaders.SOURCE_PERSISTENCE],
+        source[ColumnHeaders.Q_SOURCE],
+        source[ColumnHeaders.SIGMA_QSOURCE],
+        source[ColumnHeaders.CONFIDENCE_IN_PERSISTENCE]
+    )
+
+
+def merge_staged_sources(cur):
+    sql = """
+        insert into sources
+          (
+            source_id,
+            source_latitude_deg,
+            source_longitude_deg,
+            total_overflights,
+            Source_persistence,
+            q_source_final,
+            q_source_final_sigma,
+            vista_id,
+            source_location,
+            confidence_in_persistence,
+            is_active
+          )
+        select distinct on (s.source_id)
+            s.source_id,
+            s.source_latitude_deg,
+            s.source_longitude_deg,
+            s.total_overflights,
+            s.source_persistence,
+            s.q_source_final,
+            s.q_source_final_sigma,
+            null,
+            ST_SetSRID(ST_MakePoint(s.source_longitude_deg, s.source_latitude_deg), 4326),
+            s.confidence_in_persistence,
+            true
+        from sources_staging s
+        order by s.source_id, s.row_num desc
+        on conflict (source_id) do update set
+            source_latitude_deg = excluded.source_latitude_deg,
+            source_longitude_deg = excluded.source_longitude_deg,
+            total_overflights = excluded.total_overflights,
+            Source_persistence = excluded.Source_persistence,
+            q_source_final = excluded.q_source_final,
+            q_source_final_sigma = excluded.q_source_final_sigma,
+            vista_id = excluded.vista_id,
+            source_location = excluded.source_location,
+            confidence_in_persistence = excluded.confidence_in_persistence,
+            is_active = true
+    """
+    cur.execute(sql)
+    return cur.rowcount
+
+
+def bulk_upload_sources(sources, verbose=False, test_only=False):
+    """
+    Loads all sources with one COPY into a staging table and one set-based
+    upsert. Needs the unique index from sql/001_plumes_sources_natural_keys.sql.
+    """
+    conn = db.connect()
+    cur = conn.cursor()
+
+    try:
+        set_all_in_db_inactive(cur)
+        bulk.create_staging_table(cur, "sources_staging", SOURCE_STAGING_COLUMNS)
+        staged = bulk.copy_rows(cur, "sources_staging", [c[0] for c in SOURCE_STAGING_COLUMNS],
+                                (source_to_staging_row(i, source) for i, source in enumerate(sources)))
+        merged = merge_staged_sources(cur)
+        if verbose:
+            print("Staged %s source rows, merged %s into sources" % (staged, merged))
+    except:
+        conn.rollback()
+        raise
+
+    if test_only:
+        conn.rollback()
+    else:
+        conn.commit()
+    cur.close()
+    db.release(conn)
 
 
 # def process_workbook(input_file, worksheet_name, test_only=False, verbose=False):
@@ -247,9 +293,12 @@ def upload_sources(sources, verbose=False, test_only=False):
 
 #     upload_sources(sources, test_only=test_only, verbose=verbose)
 
-def process_csv(input_file, verbose=False, test_only=False):
-    data = parse_csv(input_file, verbose)
-    upload_sources(data, verbose, test_only)
+def process_csv(input_file, verbose=False, test_only=False, bulk_load=False):
+    data = read_sources(input_file)
+    if bulk_load:
+        bulk_upload_sources(data, verbose, test_only)
+    else:
+        upload_sources(data, verbose, test_only)
 
 
 if __name__ == "__main__":
@@ -264,13 +313,17 @@ if __name__ == "__main__":
     parser.add_argument("-t", "--test",
                         help="Test. Don't actually upload to PostgreSQL.",
                         required=False, action="store_true")
+    parser.add_argument("-B", "--bulk",
+                        help="Load with COPY into a staging table and a single upsert instead of row-by-row statements",
+                        required=False, action="store_true")
 
     args = parser.parse_args()
     input_files = args.data
     verbose = args.verbose
     test_only = args.test
+    bulk_load = args.bulk
     # worksheet_name = args.sheet
 
     for input_file in input_files:
-        process_csv(input_file, verbose=verbose, test_only=test_only)
+        process_csv(input_file, verbose=verbose, test_only=test_only, bulk_load=bulk_load)
 
@@ -1,13 +1,7 @@
 import argparse
-import psycopg2
-import csv
 import traceback
-
-DB_ENDPOINT = "localhost"
-DB_PORT = 5432
-DB_USER = ""
-DB_PASSWD = ""
-DB_NAME = ""
+from ingestutils.csvrecords import CsvRecordReader
+from ingestutils import db
 
 class PlumeHeaders:
     SOURCE_IDENTIFIER = "\xef\xbb\xbfNew source"
@@ -25,41 +19,34 @@ class PlumeHeaders:
     DATE_OF_DETECTION = "Date of detection"
 
 
+PLUME_COLUMNS = [
+    PlumeHeaders.SOURCE_IDENTIFIER,
+    PlumeHeaders.SOURCE_LATITUDE,
+    PlumeHeaders.SOURCE_LONGITUDE,
+    PlumeHeaders.PLUME_LATITUDE,
+    PlumeHeaders.PLUME_LONGITUDE,
+    PlumeHeaders.CANDIDATE_ID,
+    PlumeHeaders.LINE_NAME,
+    PlumeHeaders.VISTA_ID,
+    PlumeHeaders.FILTERED_EMISSIONS,
+    PlumeHeaders.FILTERED_UNCERTAINTY,
+    PlumeHeaders.TIME_OF_DETECTION,
+    PlumeHeaders.DATE_OF_DETECTION
+]
 
-def process_row(headers, row):
-    datamap = {}
-
-    for i in range(0, len(headers)):
-        header = headers[i].strip()
-        value = row[i]
-        datamap[header] = value
+PLUME_FLOAT_COLUMNS = [
+    PlumeHeaders.SOURCE_LATITUDE,
+    PlumeHeaders.SOURCE_LONGITUDE,
+    PlumeHeaders.PLUME_LATITUDE,
+    PlumeHeaders.PLUME_LONGITUDE,
+    PlumeHeaders.FILTERED_EMISSIONS,
+    PlumeHeaders.FILTERED_UNCERTAINTY
+]
 
-    return datamap
 
+def read_plumes(input_file):
+    return CsvRecordReader(input_file, PLUME_COLUMNS, PLUME_FLOAT_COLUMNS, name="PlumeRecord")
 
-def parse_csv(input_file, verbose=False):
-    datamap = []
-    with open(input_file) as csvfile:
-        data = csv.reader(csvfile, delimiter=',', quotechar='\"')
-        row_num = 0
-        headers = []
-        for row in data:
-            if row_num == 0:
-                headers = row
-            else:
-                row_data = process_row(headers, row)
-                datamap.append(row_data)
-            row_num += 1
-    return datamap
-
-
-def str_to_float(s):
-    if s == "TBD":
-        return -9999.0
-    elif s != "TBD" and s is not None and len(s) > 0:
-        return float(s)
-    else:
-        return None
 
 def upload_plume(plume, cur, verbose=False, test_only=False):
 
@@ -111,13 +98,13 @@ def insert_plume(plume, cur, verbose=False, test_only=False):
                     plume[PlumeHeaders.SOURCE_LONGITUDE],
                     plume[PlumeHeaders.CANDIDATE_ID],
                     plume[PlumeHeaders.LINE_NAME],
-                    str_to_float(plume[PlumeHeaders.FILTERED_EMISSIONS]),
-                    str_to_float(plume[PlumeHeaders.FILTERED_UNCERTAINTY]),
+                    plume[PlumeHeaders.FILTERED_EMISSIONS],
+                    plume[PlumeHeaders.FILTERED_UNCERTAINTY],
                     plume[PlumeHeaders.VISTA_ID],
-                    str_to_float(plume[PlumeHeaders.SOURCE_LONGITUDE]),
-                    str_to_float(plume[PlumeHeaders.SOURCE_LATITUDE]),
-                    str_to_float(plume[PlumeHeaders.PLUME_LONGITUDE]),
-                    str_to_float(plume[PlumeHeaders.PLUME_LATITUDE]),
+                    plume[PlumeHeaders.SOURCE_LONGITUDE],
+                    plume[PlumeHeaders.SOURCE_LATITUDE],
+                    plume[PlumeHeaders.PLUME_LONGITUDE],
+                    plume[PlumeHeaders.PLUME_LATITUDE],
                     "%s %s" % (detection_date, plume[PlumeHeaders.TIME_OF_DETECTION])
                 ))
 
@@ -155,13 +142,13 @@ def update_plume(plume, cur, verbose=False, test_only=False):
                     plume[PlumeHeaders.SOURCE_LONGITUDE],
                     plume[PlumeHeaders.CANDIDATE_ID],
                     plume[PlumeHeaders.LINE_NAME],
-                    str_to_float(plume[PlumeHeaders.FILTERED_EMISSIONS]),
-                    str_to_float(plume[PlumeHeaders.FILTERED_UNCERTAINTY]),
+                    plume[PlumeHeaders.FILTERED_EMISSIONS],
+                    plume[PlumeHeaders.FILTERED_UNCERTAINTY],
                     plume[PlumeHeaders.VISTA_ID],
-                    str_to_float(plume[PlumeHeaders.SOURCE_LONGITUDE]),
-                    str_to_float(plume[PlumeHeaders.SOURCE_LATITUDE]),
-                    str_to_float(plume[PlumeHeaders.PLUME_LONGITUDE]),
-                    str_to_float(plume[PlumeHeaders.PLUME_LATITUDE]),
+                    plume[PlumeHeaders.SOURCE_LONGITUDE],
+                    plume[PlumeHeaders.SOURCE_LATITUDE],
+                    plume[PlumeHeaders.PLUME_LONGITUDE],
+                    plume[PlumeHeaders.PLUME_LATITUDE],
                     "%s %s" % (detection_date, plume[PlumeHeaders.TIME_OF_DETECTION]),
                     plume[PlumeHeaders.PLUME_ID]
                 ))
@@ -175,7 +162,7 @@ def does_plume_exist(plume_id, cur):
 
 
 def upload_plumes(plumes, verbose=False, test_only=False):
-    conn = psycopg2.connect(dbname=DB_NAME, user=DB_USER, password=DB_PASSWD, host=DB_ENDPOINT, port=DB_PORT)
+    conn = db.connect()
     cur = conn.cursor()
 
     try:
@@ -190,11 +177,11 @@ def upload_plumes(plumes, verbose=False, test_only=False):
         conn.commit()
 
     cur.close()
-    conn.close()
+    db.release(conn)
 
 
 def process_csv(input_file, verbose=False, test_only=False):
-    data = parse_csv(input_file, verbose)
+    data = read_plumes(input_file)
     upload_plumes(data, verbose, test_only)
 
 
@@ -1,13 +1,7 @@
 import argparse
-import psycopg2
-import csv
 import traceback
-
-DB_ENDPOINT = "localhost"
-DB_PORT = 5432
-DB_USER = ""
-DB_PASSWD = ""
-DB_NAME = ""
+from ingestutils.csvrecords import CsvRecordReader
+from ingestutils import db
 
 class PlumeHeaders:
     LINE_NAME = "# Line name"
@@ -70,41 +64,26 @@ class PlumeHeaders:
     STATION_SEARCH_RADIUS = "Station search radius (km)"
     STATION_SEARCH_TIME_DELTA = "Station search time delta (+/- minutes)"
 
-def process_row(headers, row):
-    datamap = {}
-
-    for i in range(0, len(headers)):
-        header = headers[i].strip()
-        value = row[i]
-        datamap[header] = value
+PLUME_COLUMNS = [
+    PlumeHeaders.LINE_NAME,
+    PlumeHeaders.CANDIDATE_ID,
+    PlumeHeaders.SOURCE_ID,
+    PlumeHeaders.PLUME_LATITUDE,
+    PlumeHeaders.PLUME_LONGITUDE,
+    PlumeHeaders.EMISSION_RATE_HRRR_10M,
+    PlumeHeaders.EMISSION_UNCERTAINTY_HRRR_10M
+]
 
-    return datamap
+PLUME_FLOAT_COLUMNS = [
+    PlumeHeaders.EMISSION_RATE_HRRR_10M,
+    PlumeHeaders.EMISSION_UNCERTAINTY_HRRR_10M
+]
 
 
-def parse_csv(input_file, verbose=False):
-    datamap = []
-    with open(input_file) as csvfile:
-        data = csv.reader(csvfile, delimiter=',', quotechar='\"')
-        row_num = 0
-        headers = []
-        for row in data:
-            if row_num == 0:
-                headers = row
-            else:
-                row_data = process_row(headers, row)
-                datamap.append(row_data)
-            row_num += 1
-    return datamap
+def read_plumes(input_file):
+    return CsvRecordReader(input_file, PLUME_COLUMNS, PLUME_FLOAT_COLUMNS, name="PlumeRecord")
 
 
-def str_to_float(s):
-    if s == "TBD":
-        return -9999.0
-    elif s != "TBD" and s is not None and len(s) > 0:
-        return float(s)
-    else:
-        return None
-
 def upload_plume(plume, cur, verbose=False, test_only=False):
 
 
@@ -160,8 +139,8 @@ def insert_plume(plume, cur, verbose=False, test_only=False):
                     plume[PlumeHeaders.PLUME_LONGITUDE],
                     plume[PlumeHeaders.CANDIDATE_ID],
                     plume[PlumeHeaders.LINE_NAME],
-                    str_to_float(plume[PlumeHeaders.EMISSION_RATE_HRRR_10M]),
-                    str_to_float(plume[PlumeHeaders.EMISSION_UNCERTAINTY_HRRR_10M]),
+                    plume[PlumeHeaders.EMISSION_RATE_HRRR_10M],
+                    plume[PlumeHeaders.EMISSION_UNCERTAINTY_HRRR_10M],
                     # plume[PlumeHeaders.VISTA_ID],
                     None,
                     # str_to_float(plume[PlumeHeaders.SOURCE_LONGITUDE]),
@@ -210,8 +189,8 @@ def update_plume(plume, cur, verbose=False, test_only=False):
                     plume[PlumeHeaders.PLUME_LONGITUDE],
                     plume[PlumeHeaders.CANDIDATE_ID],
                     plume[PlumeHeaders.LINE_NAME],
-                    str_to_float(plume[PlumeHeaders.EMISSION_RATE_HRRR_10M]),
-                    str_to_float(plume[PlumeHeaders.EMISSION_UNCERTAINTY_HRRR_10M]),
+                    plume[PlumeHeaders.EMISSION_RATE_HRRR_10M],
+                    plume[PlumeHeaders.EMISSION_UNCERTAINTY_HRRR_10M],
                     # plume[PlumeHeaders.VISTA_ID],
                     None,
                     # str_to_float(plume[PlumeHeaders.SOURCE_LONGITUDE]),
@@ -232,7 +211,7 @@ def does_plume_exist(candidate_id, cur):
 
 
 def upload_plumes(plumes, verbose=False, test_only=False):
-    conn = psycopg2.connect(dbname=DB_NAME, user=DB_USER, password=DB_PASSWD, host=DB_ENDPOINT, port=DB_PORT)
+    conn = db.connect()
     cur = conn.cursor()
 
     try:
@@ -247,11 +226,11 @@ def upload_plumes(plumes, verbose=False, test_only=False):
         conn.commit()
 
     cur.close()
-    conn.close()
+    db.release(conn)
 
 
 def process_csv(input_file, verbose=False, test_only=False):
-    data = parse_csv(input_file, verbose)
+    data = read_plumes(input_file)
     upload_plumes(data, verbose, test_only)
 
 
@@ -0,0 +1,45 @@
+import sys
+import argparse
+import ingestutils.s3util as s3util
+from ingestutils import raster
+import ingest_plumes_to_sql_permian
+from ingest_plumes_to_sql_permian import read_plume_list, ingest_plume_batch
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-l", "--list", help="Text file(s) listing the plume TIFFs to ingest, one per line", required=True, type=str, nargs='+')
+    parser.add_argument("-b", "--bucket", help="Target S3 Bucket", type=str, default="bucket", required=False)
+    parser.add_argument("-v", "--verbose",
+                        help="Extra output",
+                        required=False, action="store_true")
+    parser.add_argument("-t", "--test",
+                        help="Test by parsing and assembling upload document. Don't actually upload to PostgreSQL.",
+                        required=False, action="store_true")
+    parser.add_argument("-i", "--imagesonly",
+                        help="Only upload images to S3. Don't actually upload to PostgreSQL.",
+                        required=False, action="store_true")
+    parser.add_argument("-w", "--workers", help="Number of processes for the raster/upload stages", type=int, default=1, required=False)
+    parser.add_argument("-m", "--manifest", help="SQLite job manifest used to skip or resume plumes from an earlier run", type=str, default=None, required=False)
+    parser.add_argument("-T", "--tiles", help="Also upload an XYZ tile pyramid of each plume overlay",
+                        required=False, action="store_true")
+    parser.add_argument("-f", "--force-upload", help="Upload to S3 even when the stored object already has the same content",
+                        required=False, action="store_true")
+    parser.add_argument("-C", "--colorize", help="Colour single-band CH4 plume images with the CH4 colour map instead of greyscale",
+                        required=False, action="store_true")
+
+    args = parser.parse_args()
+
+    if args.force_upload:
+        s3util.S3_SKIP_UNCHANGED = False
+    if args.tiles:
+        ingest_plumes_to_sql_permian.PLUME_TILES = True
+    if args.colorize:
+        ingest_plumes_to_sql_permian.PLUME_COLORMAP = raster.CH4_COLORMAP
+
+    input_files = []
+    for list_file in args.list:
+        input_files += read_plume_list(list_file)
+
+    failed = ingest_plume_batch(input_files, s3_bucket=args.bucket, test_only=args.test, images_only=args.imagesonly, verbose=args.verbose, workers=args.workers, manifest_path=args.manifest)
+    sys.exit(1 if failed else 0)
@@ -1,6 +1,4 @@
 #!/bin/bash
 plumefilelist=$1
-for f in `cat $plumefilelist`; do
-	echo $f
-	python ingest_plumes_to_sql_permian.py -d $f -v
-done
\ No newline at end of file
+shift
+python ingest_plume_list_to_sql.py -l "$plumefilelist" -v "$@"
@@ -10,16 +10,12 @@ import glob
 import argparse
 from PIL import Image
 import tempfile
+import psycopg2
 import ingestutils.s3util as s3util
+from ingestutils import geometry
+from ingestutils import db
 import math
-import psycopg2
-
 
-DB_ENDPOINT = "localhost"
-DB_PORT = 5432
-DB_USER = ""
-DB_PASSWD = ""
-DB_NAME = ""
 
 
 
@@ -37,17 +33,7 @@ def GetExtent(gt,cols,rows):
         @rtype:    C{[float,...,float]}
         @return:   coordinates of each corner
     '''
-    ext=[]
-    xarr=[0,cols]
-    yarr=[0,rows]
-
-    for px in xarr:
-        for py in yarr:
-            x=gt[0]+(px*gt[1])+(py*gt[2])
-            y=gt[3]+(px*gt[4])+(py*gt[5])
-            ext.append([x,y])
-        yarr.reverse()
-    return ext
+    return geometry.geotransform_corners(gt, cols, rows)[0].tolist()
 
 #https://gis.stackexchange.com/questions/57834/how-to-get-raster-corner-coordinates-using-python-gdal-bindings
 def ReprojectCoords(coords,src_srs,tgt_srs):
@@ -62,62 +48,12 @@ def ReprojectCoords(coords,src_srs,tgt_srs):
         @rtype:         C{tuple/list}
         @return:        List of transformed [[x,y],...[x,y]] coordinates
     '''
-    trans_coords=[]
-    transform = osr.CoordinateTransformation( src_srs, tgt_srs)
-    for x,y in coords:
-        x,y,z = transform.TransformPoint(x,y)
-        trans_coords.append([x,y])
-    return trans_coords
+    return geometry.transform_points(src_srs.ExportToWkt(), tgt_srs.ExportToWkt(), coords).tolist()
 
 
 #https://gis.stackexchange.com/questions/57834/how-to-get-raster-corner-coordinates-using-python-gdal-bindings
 def geotiff_spatial(tiffpath):
-
-
-    ds = gdal.Open(tiffpath)
-    gt = ds.GetGeoTransform()
-    cols = ds.RasterXSize
-    rows = ds.RasterYSize
-
-    extent = GetExtent(gt, cols, rows)
-
-    src_srs = osr.SpatialReference()
-    src_srs.ImportFromWkt(ds.GetProjection())
-
-    tgt_srs = src_srs.CloneGeogCS()
-    geo_ext = ReprojectCoords(extent, src_srs, tgt_srs)
-
-    a0 = geo_ext[1]
-    a1 = geo_ext[0]
-    slope = (a1[0] - a0[0]) / (a1[1] - a0[1])
-
-    rotation_angle = np.arctan(slope)
-
-    if (a1[0] - a0[0]) < 0.0:
-        rotation_angle *= -1.0
-
-    lats = [e[1] for e in geo_ext]
-    lons = [e[0] for e in geo_ext]
-
-    uy = np.max(lats)
-    ly = np.min(lats)
-
-    lx = np.min(lons)
-    rx = np.max(lons)
-
-    ul = (lx, uy)
-    ll = (lx, ly)
-    lr = (rx, ly)
-    ur = (rx, uy)
-
-    shape_extents = [
-        ul,
-        ll,
-        lr,
-        ur
-    ]
-
-    return shape_extents, math.degrees(rotation_angle)
+    return geometry.dataset_footprint(gdal.Open(tiffpath))
 
 
 
@@ -140,39 +76,13 @@ def geotiff_spatial(tiffpath):
 
 
 
-def does_plume_exist_in_db(cur, candidate_id):
-    sql = """
-    select count(1) from aviris_plumes where candidate_id = %s;
-    """
-    cur.execute(sql, (candidate_id,))
-    row = cur.fetchone()
-    return row[0] >= 1
-
-
-def get_plume_db_id_from_candidate_id(cur, candidate_id):
-    sql = """
-    select plume_id from aviris_plumes where candidate_id = %s
-    """
-    cur.execute(sql, (candidate_id,))
-    row = cur.fetchone()
-    return row[0]
-
 def upload_to_db(name, metadata, test_only=False, verbose=False):
-    conn = psycopg2.connect(dbname=DB_NAME, user=DB_USER, password=DB_PASSWD, host=DB_ENDPOINT, port=DB_PORT)
+    conn = db.connect()
     cur = conn.cursor()
 
-    shape = metadata["shape"]
-    shape.append(shape[0])
-    poly = "POLYGON((" + ",".join([" ".join(map(str, p)) for p in shape]) + "))"
-
-    candidate_id = str(metadata["ime_properties"]["# Candidate id"])
-
-    exists = does_plume_exist_in_db(cur, candidate_id)
+    poly = psycopg2.Binary(geometry.polygon_wkb(metadata["shape"]))
 
-    if exists:
-        update_in_db(cur, poly, name, metadata, verbose)
-    else:
-        insert_to_db(cur, poly, name, metadata, verbose)
+    upsert_in_db(cur, poly, name, metadata, verbose)
 
     if test_only:
         if verbose:
@@ -183,178 +93,115 @@ def upload_to_db(name, metadata, test_only=False, verbose=False):
             print("Committing changes")
         conn.commit()
     cur.close()
-    conn.close()
-
-
-
-
-def update_in_db(cur, poly, name, metadata, verbose=False):
-    candidate_id = str(metadata["ime_properties"]["# Candidate id"])
-    if verbose:
-        print("     Updating vista plume %s" % candidate_id)
-
-    plume_db_id = get_plume_db_id_from_candidate_id(cur, candidate_id)
-    if verbose:
-        print("     Internal db identifier: %s"%plume_db_id)
-
-    sql = """
-    update aviris_plumes
-    set
-        name = %s,
-        json_url = %s,
-        png_url = %s, 
-        plume_url = %s,
-        rgbqlctr_url = %s,
-        png_url_thumb = %s,
-        plume_url_thumb = %s,
-        rgbqlctr_url_thumb = %s,
-        plume_tiff_url = %s,
-        rgb_tiff_url = %s,
-        ul_pixel_coordinate_row = %s,
-        ul_pixel_coordinate_col = %s,
-        mergedist = %s,
-        source_id = %s,
-        ime_20 = %s,
-        ime_10 = %s,
-        ime_5 = %s,
-        candidate_id = %s,
-        
-        aviris_plume_id = %s,
-        detid5 = %s,
-        detid10 = %s,
-        detid20 = %s,
-        fetch5 = %s,
-        fetch10 = %s,
-        fetch20 = %s,
-        
-        plume_longitude = %s,
-        plume_latitude = %s,
-        plume_location=ST_GeomFromText('POINT(%s %s)', 4326),
-        plume_shape=ST_GeomFromText(%s, 4326),
-        data_date=to_timestamp(%s, 'yyyy-mm-dd hh24:mi:ss')
-    where 
-      plume_id = %s
-    """
-    cur.execute(sql,
-                (
-                    name,
-                    metadata["json_s3_url"],
-                    metadata["rgb_png_s3_url"],
-                    metadata["plume_png_s3_url"],
-                    metadata["rgbqlctr_png_s3_url"],
-                    metadata["rgb_png_s3_url_thumb"],
-                    metadata["plume_png_s3_url_thumb"],
-                    metadata["rgbqlctr_png_s3_url_thumb"],
-                    metadata["plume_tiff_s3_url"],
-                    metadata["rgb_tiff_s3_url"],
-                    metadata["ul_pixel_coordinate_row"],
-                    metadata["ul_pixel_coordinate_col"],
-                    metadata["mergedist"],
-                    metadata["ime_properties"]["Source id"] if "Source id" in metadata["ime_properties"] else None,
-                    float(metadata["ime_properties"]["IME20 (kg)"]) if "IME20 (kg)" in metadata["ime_properties"] else None,
-                    float(metadata["ime_properties"]["IME10 (kg)"]) if "IME10 (kg)" in metadata["ime_properties"] else None,
-                    float(metadata["ime_properties"]["IME5 (kg)"]) if "IME5 (kg)" in metadata["ime_properties"] else None,
-                    str(metadata["ime_properties"]["# Candidate id"]) if "# Candidate id" in metadata["ime_properties"] else None,
-                    str(metadata["ime_properties"]["Plume id"]) if "Plume id" in metadata["ime_properties"] else None,
-                    int(metadata["ime_properties"]["DetId5"]) if "DetId5" in metadata["ime_properties"] else None,
-                    int(metadata["ime_properties"]["DetId10"]) if "DetId10" in metadata["ime_properties"] else None,
-                    int(metadata["ime_properties"]["DetId20"]) if "DetId20" in metadata["ime_properties"] else None,
-                    float(metadata["ime_properties"]["Fetch5 (m)"]) if "Fetch5 (m)" in metadata["ime_properties"] else None,
-                    float(metadata["ime_properties"]["Fetch10 (m)"]) if "Fetch10 (m)" in metadata["ime_properties"] else None,
-                    float(metadata["ime_properties"]["Fetch20 (m)"]) if "Fetch20 (m)" in metadata["ime_properties"] else None,
-                    metadata["mid_lon"],
-                    metadata["mid_lat"],
-                    metadata["mid_lon"],
-                    metadata["mid_lat"],
-                    poly,
-                    metadata["date"],
-                    plume_db_id
-                )
-            )
-
-
-def insert_to_db(cur, poly, name, metadata, verbose=False):
-    candidate_id = str(metadata["ime_properties"]["# Candidate id"])
-    if verbose:
-        print("     Inserting vista plume %s" % candidate_id)
-
-    sql = """
+    db.release(conn)
+
+
+# Plain value columns of aviris_plumes, in the order of aviris_plume_values.
+# plume_location, plume_shape and data_date follow them.
+AVIRIS_PLUME_COLUMNS = [
+    "name",
+    "json_url",
+    "png_url",
+    "plume_url",
+    "rgbqlctr_url",
+    "png_url_thumb",
+    "plume_url_thumb",
+    "rgbqlctr_url_thumb",
+    "plume_tiff_url",
+    "rgb_tiff_url",
+    "ul_pixel_coordinate_row",
+    "ul_pixel_coordinate_col",
+    "mergedist",
+    "source_id",
+    "ime_20",
+    "ime_10",
+    "ime_5",
+    "candidate_id",
+    "aviris_plume_id",
+    "detid5",
+    "detid10",
+    "detid20",
+    "fetch5",
+    "fetch10",
+    "fetch20",
+    "plume_longitude",
+    "plume_latitude"
+]
+
+# Same statement as the Permian loader's: inserts the plume or updates the
+# row with its candidate_id (unique index from sql/005_loader_upsert_keys.sql),
+# prepared once per connection through ingestutils.db.
+UPSERT_AVIRIS_PLUME_SQL = """
     insert into aviris_plumes
       (
-        name,
-        json_url,
-        png_url, 
-        plume_url,
-        rgbqlctr_url,
-        png_url_thumb,
-        plume_url_thumb,
-        rgbqlctr_url_thumb,
-        plume_tiff_url,
-        rgb_tiff_url,
-        ul_pixel_coordinate_row,
-        ul_pixel_coordinate_col,
-        mergedist,
-        source_id,
-        ime_20,
-        ime_10,
-        ime_5,
-        candidate_id,
-        
-        aviris_plume_id,
-        detid5,
-        detid10,
-        detid20,
-        fetch5,
-        fetch10,
-        fetch20,
-        
-        plume_longitude,
-        plume_latitude,
+        %s,
         plume_location,
         plume_shape,
         data_date
       ) values (
-        %s, %s, %s,  %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s,
-        ST_GeomFromText('POINT(%s %s)', 4326),
-        ST_GeomFromText(%s, 4326),
-        to_timestamp(%s, 'yyyy-mm-dd hh24:mi:ss')
+        %s,
+        ST_SetSRID(ST_MakePoint(%%s, %%s), 4326),
+        ST_GeomFromWKB(%%s, 4326),
+        to_timestamp(%%s, 'yyyy-mm-dd hh24:mi:ss')
       )
-    """
-    cur.execute(sql,
-                (
-                    name,
-                    metadata["json_s3_url"],
-                    metadata["rgb_png_s3_url"],
-                    metadata["plume_png_s3_url"],
-                    metadata["rgbqlctr_png_s3_url"],
-                    metadata["rgb_png_s3_url_thumb"],
-                    metadata["plume_png_s3_url_thumb"],
-                    metadata["rgbqlctr_png_s3_url_thumb"],
-                    metadata["plume_tiff_s3_url"],
-                    metadata["rgb_tiff_s3_url"],
-                    metadata["ul_pixel_coordinate_row"],
-                    metadata["ul_pixel_coordinate_col"],
-                    metadata["mergedist"],
-                    metadata["ime_properties"]["Source id"] if "Source id" in metadata["ime_properties"] else None,
-                    float(metadata["ime_properties"]["IME20 (kg)"]) if "IME20 (kg)" in metadata["ime_properties"] else None,
-                    float(metadata["ime_properties"]["IME10 (kg)"]) if "IME10 (kg)" in metadata["ime_properties"] else None,
-                    float(metadata["ime_properties"]["IME5 (kg)"]) if "IME5 (kg)" in metadata["ime_properties"] else None,
-                    str(metadata["ime_properties"]["# Candidate id"]) if "# Candidate id" in metadata["ime_properties"] else None,
-                    str(metadata["ime_properties"]["Plume id"]) if "Plume id" in metadata["ime_properties"] else None,
-                    int(metadata["ime_properties"]["DetId5"]) if "DetId5" in metadata["ime_properties"] else None,
-                    int(metadata["ime_properties"]["DetId10"]) if "DetId10" in metadata["ime_properties"] else None,
-                    int(metadata["ime_properties"]["DetId20"]) if "DetId20" in metadata["ime_properties"] else None,
-                    float(metadata["ime_properties"]["Fetch5 (m)"]) if "Fetch5 (m)" in metadata["ime_properties"] else None,
-                    float(metadata["ime_properties"]["Fetch10 (m)"]) if "Fetch10 (m)" in metadata["ime_properties"] else None,
-                    float(metadata["ime_properties"]["Fetch20 (m)"]) if "Fetch20 (m)" in metadata["ime_properties"] else None,
-                    metadata["mid_lon"],
-                    metadata["mid_lat"],
-                    metadata["mid_lon"],
-                    metadata["mid_lat"],
-                    poly,
-                    metadata["date"]
-                )
-            )
+    on conflict (candidate_id) do update set
+        %s,
+        plume_location = excluded.plume_location,
+        plume_shape = excluded.plume_shape,
+        data_date = excluded.data_date
+    returning plume_id
+    """ % (",\n        ".join(AVIRIS_PLUME_COLUMNS),
+           ", ".join(["%s"] * len(AVIRIS_PLUME_COLUMNS)),
+           ",\n        ".join("%s = excluded.%s" % (c, c) for c in AVIRIS_PLUME_COLUMNS if c != "candidate_id"))
+
+
+def aviris_plume_values(poly, name, metadata):
+    return (
+        name,
+        metadata["json_s3_url"],
+        metadata["rgb_png_s3_url"],
+        metadata["plume_png_s3_url"],
+        metadata["rgbqlctr_png_s3_url"],
+        metadata["rgb_png_s3_url_thumb"],
+        metadata["plume_png_s3_url_thumb"],
+        metadata["rgbqlctr_png_s3_url_thumb"],
+        metadata["plume_tiff_s3_url"],
+        metadata["rgb_tiff_s3_url"],
+        metadata["ul_pixel_coordinate_row"],
+        metadata["ul_pixel_coordinate_col"],
+        metadata["mergedist"],
+        metadata["ime_properties"]["Source id"] if "Source id" in metadata["ime_properties"] else None,
+        float(metadata["ime_properties"]["IME20 (kg)"]) if "IME20 (kg)" in metadata["ime_properties"] else None,
+        float(metadata["ime_properties"]["IME10 (kg)"]) if "IME10 (kg)" in metadata["ime_properties"] else None,
+        float(metadata["ime_properties"]["IME5 (kg)"]) if "IME5 (kg)" in metadata["ime_properties"] else None,
+        str(metadata["ime_properties"]["# Candidate id"]) if "# Candidate id" in metadata["ime_properties"] else None,
+        str(metadata["ime_properties"]["Plume id"]) if "Plume id" in metadata["ime_properties"] else None,
+        int(metadata["ime_properties"]["DetId5"]) if "DetId5" in metadata["ime_properties"] else None,
+        int(metadata["ime_properties"]["DetId10"]) if "DetId10" in metadata["ime_properties"] else None,
+        int(metadata["ime_properties"]["DetId20"]) if "DetId20" in metadata["ime_properties"] else None,
+        float(metadata["ime_properties"]["Fetch5 (m)"]) if "Fetch5 (m)" in metadata["ime_properties"] else None,
+        float(metadata["ime_properties"]["Fetch10 (m)"]) if "Fetch10 (m)" in metadata["ime_properties"] else None,
+        float(metadata["ime_properties"]["Fetch20 (m)"]) if "Fetch20 (m)" in metadata["ime_properties"] else None,
+        metadata["mid_lon"],
+        metadata["mid_lat"],
+        metadata["mid_lon"],
+        metadata["mid_lat"],
+        poly,
+        metadata["date"]
+    )
+
+
+def upsert_in_db(cur, poly, name, metadata, verbose=False):
+    candidate_id = str(metadata["ime_properties"]["# Candidate id"])
+    if verbose:
+        print("     Writing vista plume %s" % candidate_id)
+
+    db.execute_prepared(cur, "upsert_aviris_plume", UPSERT_AVIRIS_PLUME_SQL,
+                        aviris_plume_values(poly, name, metadata))
+    plume_db_id = cur.fetchone()[0]
+    if verbose:
+        print("     Internal db identifier: %s"%plume_db_id)
+    return plume_db_id
 
 
 
@@ -11,16 +11,21 @@ import argparse
 from PIL import Image
 import tempfile
 import ingestutils.s3util as s3util
+from ingestutils import raster
+from ingestutils import tiles
+from ingestutils import geometry
+from ingestutils.progress import StageTimer
+from ingestutils.manifest import JobManifest, STAGE_UPLOADED, STAGE_DB_COMMITTED, stage_reached
+from ingestutils.manifest import content_hash as manifest_content_hash
+from ingestutils import db
 import math
 import psycopg2
+from psycopg2.extras import Json
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
 
-DB_ENDPOINT = "localhost"
-DB_PORT = 5432
-DB_USER = ""
-DB_PASSWD = ""
-DB_NAME = ""
-
 
 
 
@@ -37,17 +42,7 @@ def GetExtent(gt,cols,rows):
         @rtype:    C{[float,...,float]}
         @return:   coordinates of each corner
     '''
-    ext=[]
-    xarr=[0,cols]
-    yarr=[0,rows]
-
-    for px in xarr:
-        for py in yarr:
-            x=gt[0]+(px*gt[1])+(py*gt[2])
-            y=gt[3]+(px*gt[4])+(py*gt[5])
-            ext.append([x,y])
-        yarr.reverse()
-    return ext
+    return geometry.geotransform_corners(gt, cols, rows)[0].tolist()
 
 #https://gis.stackexchange.com/questions/57834/how-to-get-raster-corner-coordinates-using-python-gdal-bindings
 def ReprojectCoords(coords,src_srs,tgt_srs):
@@ -62,65 +57,16 @@ def ReprojectCoords(coords,src_srs,tgt_srs):
         @rtype:         C{tuple/list}
         @return:        List of transformed [[x,y],...[x,y]] coordinates
     '''
-    trans_coords=[]
-    transform = osr.CoordinateTransformation( src_srs, tgt_srs)
-    for x,y in coords:
-        x,y,z = transform.TransformPoint(x,y)
-        trans_coords.append([x,y])
-    return trans_coords
+    return geometry.transform_points(src_srs.ExportToWkt(), tgt_srs.ExportToWkt(), coords).tolist()
 
 
 #https://gis.stackexchange.com/questions/57834/how-to-get-raster-corner-coordinates-using-python-gdal-bindings
 def geotiff_spatial(tiffpath):
+    return dataset_spatial(gdal.Open(tiffpath))
 
 
-    ds = gdal.Open(tiffpath)
-    gt = ds.GetGeoTransform()
-    cols = ds.RasterXSize
-    rows = ds.RasterYSize
-
-    extent = GetExtent(gt, cols, rows)
-
-    src_srs = osr.SpatialReference()
-    src_srs.ImportFromWkt(ds.GetProjection())
-
-    tgt_srs = src_srs.CloneGeogCS()
-    geo_ext = ReprojectCoords(extent, src_srs, tgt_srs)
-
-    a0 = geo_ext[1]
-    a1 = geo_ext[0]
-    if (a1[1] - a0[1]) == 0:
-        slope = 0
-    else:
-        slope = (a1[0] - a0[0]) / (a1[1] - a0[1])
-
-    rotation_angle = np.arctan(slope)
-
-    if (a1[0] - a0[0]) < 0.0:
-        rotation_angle *= -1.0
-
-    lats = [e[0] for e in geo_ext]
-    lons = [e[1] for e in geo_ext]
-
-    uy = np.max(lats)
-    ly = np.min(lats)
-
-    lx = np.min(lons)
-    rx = np.max(lons)
-
-    ul = (lx, uy)
-    ll = (lx, ly)
-    lr = (rx, ly)
-    ur = (rx, uy)
-
-    shape_extents = [
-        ul,
-        ll,
-        lr,
-        ur
-    ]
-
-    return shape_extents, math.degrees(rotation_angle)
+def dataset_spatial(ds):
+    return geometry.dataset_footprint(ds)
 
 
 
@@ -156,23 +102,6 @@ def geotiff_spatial(tiffpath):
 
 
 
-def does_plume_exist_in_db(cur, candidate_id):
-    sql = """
-    select count(1) from aviris_plumes where candidate_id = %s;
-    """
-    cur.execute(sql, (candidate_id,))
-    row = cur.fetchone()
-    return row[0] >= 1
-
-
-def get_plume_db_id_from_candidate_id(cur, candidate_id):
-    sql = """
-    select plume_id from aviris_plumes where candidate_id = %s
-    """
-    cur.execute(sql, (candidate_id,))
-    row = cur.fetchone()
-    return row[0]
-
 def get_plume_data_from_candidate_id(cur, candidate_id):
     sql = """
     select * from plumes where plume_id = %s
@@ -181,22 +110,21 @@ def get_plume_data_from_candidate_id(cur, candidate_id):
     row = cur.fetchone()
     return row
 
-def upload_to_db(name, metadata, candidate_id, test_only=False, verbose=False):
-    conn = psycopg2.connect(dbname=DB_NAME, user=DB_USER, password=DB_PASSWD, host=DB_ENDPOINT, port=DB_PORT)
+def connect_to_db():
+    return db.connect()
+
+
+def upload_to_db(name, metadata, candidate_id, test_only=False, verbose=False, conn=None):
+    owns_conn = conn is None
+    if owns_conn:
+        conn = connect_to_db()
     cur = conn.cursor()
 
-    shape = metadata["shape"]
-    shape.append(shape[0])
-    poly = "POLYGON((" + ",".join([" ".join(map(str, p)) for p in shape]) + "))"
+    poly = psycopg2.Binary(geometry.polygon_wkb(metadata["shape"]))
 
     # candidate_id = str(metadata["ime_properties"]["# Candidate id"])
 
-    exists = does_plume_exist_in_db(cur, candidate_id)
-
-    if exists:
-        update_in_db(cur, poly, name, metadata, candidate_id, verbose)
-    else:
-        insert_to_db(cur, poly, name, metadata, candidate_id, verbose)
+    upsert_in_db(cur, poly, name, metadata, candidate_id, verbose)
 
     if test_only:
         if verbose:
@@ -207,182 +135,129 @@ def upload_to_db(name, metadata, candidate_id, test_only=False, verbose=False):
             print("Committing changes")
         conn.commit()
     cur.close()
-    conn.close()
-
-
-def update_in_db(cur, poly, name, metadata, candidate_id, verbose=False):
-    # candidate_id = str(metadata["ime_properties"]["# Candidate id"])
-    if verbose:
-        print("     Updating vista plume %s" % candidate_id)
-
-    plume_db_id = get_plume_db_id_from_candidate_id(cur, candidate_id)
-    if verbose:
-        print("     Internal db identifier: %s"%plume_db_id)
-
-    plume_data = get_plume_data_from_candidate_id(cur, candidate_id)
-
-    sql = """
-    update aviris_plumes
-    set
-        name = %s,
-        json_url = %s,
-        png_url = %s, 
-        plume_url = %s,
-        rgbqlctr_url = %s,
-        png_url_thumb = %s,
-        plume_url_thumb = %s,
-        rgbqlctr_url_thumb = %s,
-        plume_tiff_url = %s,
-        rgb_tiff_url = %s,
-        ul_pixel_coordinate_row = %s,
-        ul_pixel_coordinate_col = %s,
-        mergedist = %s,
-        source_id = %s,
-        ime_20 = %s,
-        ime_10 = %s,
-        ime_5 = %s,
-        candidate_id = %s,
-        
-        aviris_plume_id = %s,
-        detid5 = %s,
-        detid10 = %s,
-        detid20 = %s,
-        fetch5 = %s,
-        fetch10 = %s,
-        fetch20 = %s,
-        
-        plume_longitude = %s,
-        plume_latitude = %s,
-        plume_location=ST_GeomFromText('POINT(%s %s)', 4326),
-        plume_shape=ST_GeomFromText(%s, 4326),
-        data_date=to_timestamp(%s, 'yyyy-mm-dd hh24:mi:ss')
-    where 
-      plume_id = %s
-    """
-
-    cur.execute(sql,
-                (
-                    name,
-                    None,
-                    metadata["rgb_png_s3_url"],
-                    metadata["plume_png_s3_url"],
-                    metadata["rgbqlctr_png_s3_url"],
-                    metadata["rgb_png_s3_url_thumb"],
-                    metadata["plume_png_s3_url_thumb"],
-                    metadata["rgbqlctr_png_s3_url_thumb"],
-                    metadata["plume_tiff_s3_url"],
-                    metadata["rgb_tiff_s3_url"],
-                    metadata["ul_pixel_coordinate_row"],
-                    metadata["ul_pixel_coordinate_col"],
-                    metadata["mergedist"],
-                    plume_data[10], #source_id
-                    None, #ime_20
-                    None, #ime_10
-                    None, #ime_5
-                    candidate_id,
-                    None, #aviris_plume_id
-                    None, #det_id_5
-                    None, #det_id_10
-                    None, #det_id_20
-                    None, #fetch5
-                    None, #fetch10
-                    None, #fetch20
-                    plume_data[8], #plume_lon
-                    plume_data[7], #plume_lat
-                    plume_data[8], #plume_lon
-                    plume_data[7], #plume_lat
-                    poly,
-                    metadata["date"],
-                    plume_db_id
-                )
-            )
-
-
-def insert_to_db(cur, poly, name, metadata, candidate_id, verbose=False):
-    # candidate_id = str(metadata["ime_properties"]["# Candidate id"])
-    if verbose:
-        print("     Inserting vista plume %s" % candidate_id)
-
-    plume_data = get_plume_data_from_candidate_id(cur, candidate_id)
-
-    sql = """
+    if owns_conn:
+        db.release(conn)
+
+
+# Plain value columns of aviris_plumes, in the order of aviris_plume_values.
+# plume_location, plume_shape and data_date follow them.
+AVIRIS_PLUME_COLUMNS = [
+    "name",
+    "json_url",
+    "png_url",
+    "plume_url",
+    "rgbqlctr_url",
+    "png_url_thumb",
+    "plume_url_thumb",
+    "rgbqlctr_url_thumb",
+    "plume_tiff_url",
+    "rgb_tiff_url",
+    "thumbnails",
+    "tiles_url",
+    "tiles_min_zoom",
+    "tiles_max_zoom",
+    "ul_pixel_coordinate_row",
+    "ul_pixel_coordinate_col",
+    "mergedist",
+    "source_id",
+    "ime_20",
+    "ime_10",
+    "ime_5",
+    "candidate_id",
+    "aviris_plume_id",
+    "detid5",
+    "detid10",
+    "detid20",
+    "fetch5",
+    "fetch10",
+    "fetch20",
+    "plume_longitude",
+    "plume_latitude"
+]
+
+# One statement inserts a new plume or updates the row with the same
+# candidate_id (unique index from sql/005_loader_upsert_keys.sql). It is
+# prepared once per connection (see ingestutils.db), so only the parameters
+# travel with each plume. The point is built from its coordinates and the
+# footprint arrives as WKB, so no geometry text is parsed.
+UPSERT_AVIRIS_PLUME_SQL = """
     insert into aviris_plumes
       (
-        name,
-        json_url,
-        png_url, 
-        plume_url,
-        rgbqlctr_url,
-        png_url_thumb,
-        plume_url_thumb,
-        rgbqlctr_url_thumb,
-        plume_tiff_url,
-        rgb_tiff_url,
-        ul_pixel_coordinate_row,
-        ul_pixel_coordinate_col,
-        mergedist,
-        source_id,
-        ime_20,
-        ime_10,
-        ime_5,
-        candidate_id,
-        
-        aviris_plume_id,
-        detid5,
-        detid10,
-        detid20,
-        fetch5,
-        fetch10,
-        fetch20,
-        
-        plume_longitude,
-        plume_latitude,
+        %s,
         plume_location,
         plume_shape,
         data_date
       ) values (
-        %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s,
-        ST_GeomFromText('POINT(%s %s)', 4326),
-        ST_GeomFromText(%s, 4326),
-        to_timestamp(%s, 'yyyy-mm-dd hh24:mi:ss')
+        %s,
+        ST_SetSRID(ST_MakePoint(%%s, %%s), 4326),
+        ST_GeomFromWKB(%%s, 4326),
+        to_timestamp(%%s, 'yyyy-mm-dd hh24:mi:ss')
       )
-    """
-    cur.execute(sql,
-                (
-                    name,
-                    # metadata["json_s3_url"],
-                    None,
-                    metadata["rgb_png_s3_url"],
-                    metadata["plume_png_s3_url"],
-                    metadata["rgbqlctr_png_s3_url"],
-                    metadata["rgb_png_s3_url_thumb"],
-                    metadata["plume_png_s3_url_thumb"],
-                    metadata["rgbqlctr_png_s3_url_thumb"],
-                    metadata["plume_tiff_s3_url"],
-                    metadata["rgb_tiff_s3_url"],
-                    metadata["ul_pixel_coordinate_row"],
-                    metadata["ul_pixel_coordinate_col"],
-                    metadata["mergedist"],
-                    plume_data[10], #source id
-                    None, #plume_data[0], #ime_20
-                    None, #lume_data[20], #ime_10
-                    None, #plume_data[19], #ime_5
-                    candidate_id, #candidate_id
-                    None, #aviris_plume_id
-                    None, #plume_data[23], #detid5
-                    None, #plume_data[24], #detid10
-                    None, #plume_data[25], #detid20
-                    None, #plume[1], #fetch5
-                    None, #plume_data[21], #fetch10
-                    None, #plume_data[22], #fetch20
-                    plume_data[8], #plumelon
-                    plume_data[7], #plumelat
-                    plume_data[8], #plumelon
-                    plume_data[7], #plumelat
-                    poly,
-                    metadata["date"]
-                )
-            )
+    on conflict (candidate_id) do update set
+        %s,
+        plume_location = excluded.plume_location,
+        plume_shape = excluded.plume_shape,
+        data_date = excluded.data_date
+    returning plume_id
+    """ % (",\n        ".join(AVIRIS_PLUME_COLUMNS),
+           ", ".join(["%s"] * len(AVIRIS_PLUME_COLUMNS)),
+           ",\n        ".join("%s = excluded.%s" % (c, c) for c in AVIRIS_PLUME_COLUMNS if c != "candidate_id"))
+
+
+def aviris_plume_values(poly, name, metadata, candidate_id, plume_data):
+    return (
+        name,
+        # metadata["json_s3_url"],
+        None,
+        metadata["rgb_png_s3_url"],
+        metadata["plume_png_s3_url"],
+        metadata["rgbqlctr_png_s3_url"],
+        metadata["rgb_png_s3_url_thumb"],
+        metadata["plume_png_s3_url_thumb"],
+        metadata["rgbqlctr_png_s3_url_thumb"],
+        metadata["plume_tiff_s3_url"],
+        metadata["rgb_tiff_s3_url"],
+        Json(metadata.get("thumbnails")),
+        metadata.get("tiles_url"),
+        metadata.get("tiles_min_zoom"),
+        metadata.get("tiles_max_zoom"),
+        metadata["ul_pixel_coordinate_row"],
+        metadata["ul_pixel_coordinate_col"],
+        metadata["mergedist"],
+        plume_data[10], #source id
+        None, #plume_data[0], #ime_20
+        None, #lume_data[20], #ime_10
+        None, #plume_data[19], #ime_5
+        candidate_id, #candidate_id
+        None, #aviris_plume_id
+        None, #plume_data[23], #detid5
+        None, #plume_data[24], #detid10
+        None, #plume_data[25], #detid20
+        None, #plume[1], #fetch5
+        None, #plume_data[21], #fetch10
+        None, #plume_data[22], #fetch20
+        plume_data[8], #plumelon
+        plume_data[7], #plumelat
+        plume_data[8], #plume_location lon
+        plume_data[7], #plume_location lat
+        poly,
+        metadata["date"]
+    )
+
+
+def upsert_in_db(cur, poly, name, metadata, candidate_id, verbose=False):
+    # candidate_id = str(metadata["ime_properties"]["# Candidate id"])
+    if verbose:
+        print("     Writing vista plume %s" % candidate_id)
+
+    plume_data = get_plume_data_from_candidate_id(cur, candidate_id)
+
+    db.execute_prepared(cur, "upsert_aviris_plume", UPSERT_AVIRIS_PLUME_SQL,
+                        aviris_plume_values(poly, name, metadata, candidate_id, plume_data))
+    plume_db_id = cur.fetchone()[0]
+    if verbose:
+        print("     Internal db identifier: %s"%plume_db_id)
+    return plume_db_id
 
 
 
@@ -424,21 +299,29 @@ def get_ime_for_source_id(ime_rows, source_id):
     return None
 
 def overlay_image_over(bottom_image, top_image, dest_image):
-    top_img = Image.open(top_image)
-    bottom_img = Image.open(bottom_image)
+    bottom_ds = gdal.Open(bottom_image)
+    top_ds = gdal.Open(top_image)
+    composite = composite_datasets(bottom_ds, top_ds)
+    raster.array_to_image(composite).save(dest_image, format="PNG")
+
 
-    top_img = top_img.convert('RGBA')
-    bottom_img = bottom_img.convert('RGBA')
+def band_nodata(ds):
+    return ds.GetRasterBand(1).GetNoDataValue()
 
-    x_diff = (abs(bottom_img.width - top_img.width) // 2)
-    y_diff = (abs(bottom_img.height - top_img.height) // 2)
-    x = -x_diff
-    y = -y_diff
-    x2 = top_img.width - x_diff
-    y2 = top_img.height - y_diff
 
-    bottom_img.paste(top_img, (x, y, x2, y2), top_img)
-    bottom_img.save(dest_image, format="PNG")
+def composite_datasets(bottom_ds, top_ds, bottom_array=None, top_array=None):
+    """
+    Plume-over-RGB quicklook as an RGBA array on the RGB raster's grid. The
+    plume is registered by geotransform, so the two rasters don't need the
+    same extent or pixel size.
+    """
+    if bottom_array is None:
+        bottom_array = raster.dataset_to_array(bottom_ds)
+    if top_array is None:
+        top_array = raster.dataset_to_array(top_ds)
+    return raster.composite_over(bottom_array, bottom_ds.GetGeoTransform(),
+                                 top_array, top_ds.GetGeoTransform(),
+                                 colormap=PLUME_COLORMAP, nodata=band_nodata(top_ds))
 
 
 
@@ -483,39 +366,102 @@ def reproject(src_image, match_image, dest_image):
 
     del dst
 
-def ingest_aviris_plume_geojson(geojson, s3_bucket="bucket", test_only=False, images_only=False, verbose=False):
+PLUME_JOB = "aviris-plume"
 
+# Also cut each plume overlay into an XYZ tile pyramid. Read when a plume
+# is processed, so the scripts can switch it on before starting work.
+PLUME_TILES = False
+
+# Colour map applied to single-band CH4 plume rasters in the plume PNG,
+# quicklook and tiles. None keeps the band as greyscale, as it has always
+# been rendered; set to raster.CH4_COLORMAP to colour it instead.
+PLUME_COLORMAP = None
+
+
+def plume_source_files(geojson):
+    file_base = geojson[0:-8]
+    return ["%s_ctr.tif" % file_base, "%s_rgb.tif" % file_base]
+
+
+def process_plume_images(geojson, s3_bucket="bucket", test_only=False, verbose=False, timer=None, uploader=None, make_tiles=None):
+    """
+    Runs the raster stages for one plume and queues its uploads. When an
+    uploader is passed in, the URL values in the returned metadata are
+    futures; resolve them with s3util.resolve_futures before writing to the
+    database. make_tiles defaults to PLUME_TILES.
+    """
+    if timer is None:
+        timer = StageTimer()
+    if make_tiles is None:
+        make_tiles = PLUME_TILES
+
+    owns_uploader = uploader is None
+    if owns_uploader:
+        uploader = s3util.S3Uploader(s3_bucket=s3_bucket, test_only=test_only)
 
     if verbose:
         print ("Ingesting", geojson)
     file_base = geojson[0:-8]
 
 
-    plume_tiff_input = "%s_ctr.tif"%file_base
-    plume_tiff = "tmp/%s_rotated.tif"%os.path.basename(plume_tiff_input[:plume_tiff_input.rindex(".")])
-    plume_png = "%s/%s_ctr.png" % (tempfile.gettempdir(), os.path.basename(file_base))
+    # Everything between the source TIFFs and the uploads stays in memory:
+    # the warps go to /vsimem/ and the PNGs are encoded straight from the
+    # warped arrays. The names below are only used for the S3 keys.
+    plume_tiff_input, rgb_tiff_input = plume_source_files(geojson)
+    plume_tiff = "%s_rotated.tif" % os.path.basename(plume_tiff_input[:plume_tiff_input.rindex(".")])
+    plume_png = "%s_ctr.png" % os.path.basename(file_base)
     print(plume_tiff_input, plume_tiff, plume_png)
 
-    rgb_tiff_input = "%s_rgb.tif"%file_base
-    rgb_tiff = "tmp/%s_rotated.tif" % os.path.basename(rgb_tiff_input[:rgb_tiff_input.rindex(".")])
-    rgb_png = "%s/%s_rgb.png" % (tempfile.gettempdir(), os.path.basename(file_base))
+    rgb_tiff = "%s_rotated.tif" % os.path.basename(rgb_tiff_input[:rgb_tiff_input.rindex(".")])
+    rgb_png = "%s_rgb.png" % os.path.basename(file_base)
 
-    rgbqlctr_png = "%s/%s_rgbgl-ctr.png" % ("tmp", os.path.basename(file_base))
+    rgbqlctr_png = "%s_rgbgl-ctr.png" % os.path.basename(file_base)
 
     print(rgb_tiff_input, rgb_tiff, rgb_png)
 
     candidate_id = os.path.basename(plume_tiff_input[:plume_tiff_input.rindex(".")])
     candidate_id = candidate_id[0 : candidate_id.index("_")]
 
-    gdal.Warp(rgb_tiff, rgb_tiff_input, dstSRS="EPSG:3857")
-    gdal.Warp(plume_tiff, plume_tiff_input, dstSRS="EPSG:3857")
-
-    #reproject(rgb_tiff, plume_tiff,rgb_tiff)
-
-    overlay_image_over(rgb_tiff, plume_tiff, rgbqlctr_png)
-    convert_to_png(plume_tiff, plume_png)
-    convert_to_png(rgb_tiff, rgb_png)
-    #sys.exit(0)
+    rgb_ds = None
+    plume_ds = None
+    memory_files = []
+    try:
+        with timer.stage("warp"):
+            rgb_ds, rgb_tiff_path = raster.warp_to_memory(rgb_tiff_input, rgb_tiff, cog=True)
+            memory_files.append(rgb_tiff_path)
+            plume_ds, plume_tiff_path = raster.warp_to_memory(plume_tiff_input, plume_tiff, cog=True)
+            memory_files.append(plume_tiff_path)
+
+            rgb_tiff_data = raster.read_memory_file(rgb_tiff_path)
+            plume_tiff_data = raster.read_memory_file(plume_tiff_path)
+
+
+        with timer.stage("composite"):
+            rgb_array = raster.dataset_to_array(rgb_ds)
+            plume_array = raster.dataset_to_array(plume_ds)
+            rgbqlctr_array = composite_datasets(rgb_ds, plume_ds, rgb_array, plume_array)
+
+            plume_nodata = band_nodata(plume_ds)
+            plume_gt = plume_ds.GetGeoTransform()
+
+            rgb_img = raster.array_to_image(rgb_array)
+            if PLUME_COLORMAP is not None:
+                plume_img = raster.array_to_image(raster.to_rgba(plume_array, PLUME_COLORMAP, nodata=plume_nodata))
+            else:
+                plume_img = raster.array_to_image(plume_array)
+            rgbqlctr_img = raster.array_to_image(rgbqlctr_array)
+
+            rgb_png_data = raster.encode_image(rgb_img)
+            plume_png_data = raster.encode_image(plume_img)
+            rgbqlctr_png_data = raster.encode_image(rgbqlctr_img)
+
+        with timer.stage("spatial"):
+            extents, rotation_angle = dataset_spatial(plume_ds)
+    finally:
+        rgb_ds = None
+        plume_ds = None
+        for path in memory_files:
+            raster.free_memory_file(path)
 
     bn = os.path.basename(geojson)
     flight_id = bn[:bn.find("_")]
@@ -553,8 +499,6 @@ def ingest_aviris_plume_geojson(geojson, s3_bucket="bucket", test_only=False, im
     #     ime_headers, ime_rows = parse_ime_file(ime_file)
     #     ime_properties = get_ime_for_source_id(ime_rows, source_id)
 
-    extents, rotation_angle = geotiff_spatial(plume_tiff)
-
     plume_rotated_png = plume_png
     #plume_rotated_png = "%s/%s_ctr_rotated.png" % (tempfile.gettempdir(), os.path.basename(file_base))
     #rotate_image(plume_tiff, plume_rotated_png, rotation_angle)
@@ -586,13 +530,35 @@ def ingest_aviris_plume_geojson(geojson, s3_bucket="bucket", test_only=False, im
 
     # json_s3_url = s3util.upload_file_to_s3(geojson, s3_bucket=s3_bucket, test_only=test_only)
 
-    rgb_s3_url, rgb_s3_url_thumb = s3util.upload_image_to_s3(rgb_png, s3_bucket=s3_bucket, test_only=test_only)
-    plume_s3_url, plume_s3_url_thumb = s3util.upload_image_to_s3(plume_rotated_png, s3_bucket=s3_bucket, test_only=test_only)
-    rgbqlctr_s3_url, rgbqlctr_s3_url_thumb = s3util.upload_image_to_s3(rgbqlctr_png, s3_bucket=s3_bucket, test_only=test_only)
-
-    rgb_tiff_s3_url, rgb_tiff_s3_url_thumb = s3util.upload_image_to_s3(rgb_tiff, s3_bucket=s3_bucket, test_only=test_only, upload_thumbnail=False)
-    plume_tiff_s3_url, plume_tiff_s3_url_thumb = s3util.upload_image_to_s3(plume_tiff, s3_bucket=s3_bucket, test_only=test_only, upload_thumbnail=False)
-
+    with timer.stage("upload"):
+        rgb_s3_url = uploader.upload_data(rgb_png, rgb_png_data)
+        plume_s3_url = uploader.upload_data(plume_rotated_png, plume_png_data)
+        rgbqlctr_s3_url = uploader.upload_data(rgbqlctr_png, rgbqlctr_png_data)
+
+        rgb_tiff_s3_url, rgb_tiff_s3_url_thumb = uploader.upload_image_data(rgb_tiff, rgb_tiff_data, upload_thumbnail=False)
+        plume_tiff_s3_url, plume_tiff_s3_url_thumb = uploader.upload_image_data(plume_tiff, plume_tiff_data, upload_thumbnail=False)
+
+
+    # Every thumbnail size comes from the images already decoded above; the
+    # smallest also fills the original *_thumb columns.
+    with timer.stage("thumbnails"):
+        thumbnails = {
+            "rgb_png": uploader.upload_thumbnails(rgb_png, image=rgb_img),
+            "plume_png": uploader.upload_thumbnails(plume_rotated_png, image=plume_img),
+            "rgbqlctr_png": uploader.upload_thumbnails(rgbqlctr_png, image=rgbqlctr_img)
+        }
+    tiles_url, tiles_min_zoom, tiles_max_zoom = None, None, None
+    if make_tiles:
+        with timer.stage("tiles"):
+            # Transparent wherever there is no enhancement, so the tiles
+            # around the plume come out empty and are skipped
+            plume_rgba = raster.to_rgba(plume_array, PLUME_COLORMAP, nodata=plume_nodata, transparent_background=True)
+            tiles_url, tiles_min_zoom, tiles_max_zoom = tiles.upload_tile_pyramid(uploader, plume_rgba, plume_gt, os.path.basename(file_base))
+
+    default_size = str(s3util.DEFAULT_THUMBNAIL_SIZE)
+    rgb_s3_url_thumb = thumbnails["rgb_png"][default_size]
+    plume_s3_url_thumb = thumbnails["plume_png"][default_size]
+    rgbqlctr_s3_url_thumb = thumbnails["rgbqlctr_png"][default_size]
 
     data_date = "{YYYY}-{MM}-{DD} {HH}:{mm}:{ss}".format(YYYY=year, MM=month, DD=day, HH=hour, mm=minute,ss=second)
     metadata = {
@@ -613,6 +579,11 @@ def ingest_aviris_plume_geojson(geojson, s3_bucket="bucket", test_only=False, im
         "rgb_png_s3_url_thumb": rgb_s3_url_thumb,
         "plume_png_s3_url_thumb": plume_s3_url_thumb,
         "rgbqlctr_png_s3_url_thumb": rgbqlctr_s3_url_thumb,
+        "thumbnails": thumbnails,
+
+        "tiles_url": tiles_url,
+        "tiles_min_zoom": tiles_min_zoom,
+        "tiles_max_zoom": tiles_max_zoom,
 
         "rgb_tiff_s3_url": rgb_tiff_s3_url,
         "plume_tiff_s3_url": plume_tiff_s3_url,
@@ -623,27 +594,238 @@ def ingest_aviris_plume_geojson(geojson, s3_bucket="bucket", test_only=False, im
         # "ime_properties": ime_properties
     }
 
+    if owns_uploader:
+        with timer.stage("upload-wait"):
+            metadata = s3util.resolve_futures(metadata)
+        uploader.shutdown()
+
+    return os.path.basename(file_base), metadata, candidate_id
+
+
+def write_plume(name, metadata, candidate_id, test_only=False, images_only=False, verbose=False, conn=None, timer=None):
+    if timer is None:
+        timer = StageTimer()
+
     if verbose:
         print (json.dumps(metadata, indent=4))
 
     if not images_only:
-        upload_to_db(os.path.basename(file_base), metadata, candidate_id, test_only=test_only, verbose=verbose)
+        with timer.stage("db"):
+            upload_to_db(name, metadata, candidate_id, test_only=test_only, verbose=verbose, conn=conn)
+
+
+def ingest_aviris_plume_geojson(geojson, s3_bucket="bucket", test_only=False, images_only=False, verbose=False, conn=None, timer=None, uploader=None):
+
+    if timer is None:
+        timer = StageTimer()
+
+    name, metadata, candidate_id = process_plume_images(geojson, s3_bucket=s3_bucket, test_only=test_only, verbose=verbose, timer=timer, uploader=uploader)
+    with timer.stage("upload-wait"):
+        metadata = s3util.resolve_futures(metadata)
+    write_plume(name, metadata, candidate_id, test_only=test_only, images_only=images_only, verbose=verbose, conn=conn, timer=timer)
 
 
+_worker_uploader = None
+
+
+def cog_threads_per_worker(workers):
+    return max(1, multiprocessing.cpu_count() // workers)
+
+
+def process_plume_images_in_worker(geojson, s3_bucket="bucket", test_only=False, verbose=False, cog_threads=None):
+    # Runs in a pool process. Exceptions are returned rather than raised so
+    # the parent can keep writing the rest of the batch in order. Futures
+    # can't cross the process boundary, so uploads are resolved here.
+    global _worker_uploader
+    if cog_threads is not None:
+        raster.COG_NUM_THREADS = cog_threads
+    if _worker_uploader is None:
+        _worker_uploader = s3util.S3Uploader(s3_bucket=s3_bucket, test_only=test_only)
+
+    timer = StageTimer()
     try:
-        os.unlink(plume_tiff)
+        name, metadata, candidate_id = process_plume_images(geojson, s3_bucket=s3_bucket, test_only=test_only, verbose=verbose,
+                                                            timer=timer, uploader=_worker_uploader)
+        with timer.stage("upload-wait"):
+            metadata = s3util.resolve_futures(metadata)
+        return (name, metadata, candidate_id), timer.summary(), None
     except:
-        print ("Error deleting plume_tiff file ", plume_tiff) # TODO: Why, tho?
+        return None, timer.summary(), traceback.format_exc()
+
+
+def read_plume_list(list_file):
+    plume_files = []
+    with open(list_file, "r") as f:
+        for line in f:
+            line = line.strip()
+            if len(line) == 0 or line.startswith("#"):
+                continue
+            plume_files.append(line)
+    return plume_files
+
+
+def ingest_plume_batch(input_files, s3_bucket="bucket", test_only=False, images_only=False, verbose=False, workers=1, manifest_path=None):
+    """
+    Ingest many plumes in one process, sharing a single database connection
+    and S3 client. Failures are reported and skipped so one bad plume doesn't
+    abort the rest of the list.
+
+    With workers > 1 the raster and upload stages run in a process pool while
+    this process stays the only database writer, committing plumes in input
+    order.
+
+    With a manifest_path, progress is recorded in a JobManifest so a rerun
+    skips plumes already committed and goes straight to the database write
+    for plumes whose images were already uploaded.
+    """
+    timer = StageTimer()
+    manifest = JobManifest(manifest_path) if manifest_path is not None else None
+
+    journal = PlumeJournal(manifest, test_only, images_only)
+    input_files = journal.plan(input_files, verbose=verbose)
 
+    conn = None if images_only else connect_to_db()
+
+    failed = []
     try:
-        os.unlink(rgb_tiff)
-    except:
-        print ("Error deleting rgb_tiff file ", rgb_tiff) # TODO: Why, tho?
+        if workers > 1:
+            failed = _ingest_plume_batch_parallel(input_files, conn, timer, journal, s3_bucket, test_only, images_only, verbose, workers)
+        else:
+            failed = _ingest_plume_batch_serial(input_files, conn, timer, journal, s3_bucket, test_only, images_only, verbose)
+    finally:
+        if conn is not None:
+            db.release(conn)
+        if manifest is not None:
+            manifest.close()
+
+    timer.report()
+    print("Ingested %d of %d plumes (%d already complete)" % (len(input_files) - len(failed), len(input_files), journal.skipped))
+    for input_file in failed:
+        print("    Failed: %s" % input_file)
+    return failed
+
+
+class PlumeJournal:
+    """
+    Batch-side view of the job manifest. Does nothing without a manifest,
+    and never records test runs since nothing they do is kept.
+    """
 
+    def __init__(self, manifest, test_only=False, images_only=False):
+        self.manifest = manifest if not test_only else None
+        self.images_only = images_only
+        self.hashes = {}
+        self.resumed = {}
+        self.skipped = 0
+
+    def plan(self, input_files, verbose=False):
+        if self.manifest is None:
+            return input_files
+
+        done_stage = STAGE_UPLOADED if self.images_only else STAGE_DB_COMMITTED
+        remaining = []
+        for input_file in input_files:
+            content_hash = manifest_content_hash(plume_source_files(input_file))
+            stage, outputs = self.manifest.get(PLUME_JOB, input_file, content_hash)
+
+            if stage_reached(stage, done_stage):
+                if verbose:
+                    print("Skipping %s, already %s" % (input_file, stage))
+                self.skipped += 1
+                continue
+
+            if stage_reached(stage, STAGE_UPLOADED):
+                self.resumed[input_file] = (outputs["name"], outputs["metadata"], outputs["candidate_id"])
+
+            self.hashes[input_file] = content_hash
+            remaining.append(input_file)
+        return remaining
+
+    def resumed_result(self, input_file):
+        return self.resumed.get(input_file)
+
+    def mark(self, input_file, stage, result=None):
+        if self.manifest is None:
+            return
+        outputs = None
+        if result is not None:
+            name, metadata, candidate_id = result
+            outputs = {"name": name, "metadata": metadata, "candidate_id": candidate_id}
+        self.manifest.mark(PLUME_JOB, input_file, self.hashes[input_file], stage, outputs)
+
+
+def _write_batch_plume(input_file, result, conn, timer, journal, test_only, images_only, verbose):
+    name, metadata, candidate_id = result
     try:
-        os.unlink(rgbqlctr_png)
+        if s3util.has_futures(metadata):
+            with timer.stage("upload-wait"):
+                metadata = s3util.resolve_futures(metadata)
+        journal.mark(input_file, STAGE_UPLOADED, (name, metadata, candidate_id))
+
+        write_plume(name, metadata, candidate_id, test_only=test_only, images_only=images_only, verbose=verbose, conn=conn, timer=timer)
+
+        if not images_only:
+            journal.mark(input_file, STAGE_DB_COMMITTED)
+        return True
     except:
-        print ("Error deleting rgbqlctr_png file ", rgbqlctr_png) # TODO: Why, tho?
+        traceback.print_exc()
+        if conn is not None:
+            conn.rollback()
+        return False
+
+
+def _ingest_plume_batch_serial(input_files, conn, timer, journal, s3_bucket, test_only, images_only, verbose):
+    # Plume N is written to the database after plume N+1's raster stages
+    # have run, so its uploads proceed in the background meanwhile.
+    failed = []
+    pending = None
+    with s3util.S3Uploader(s3_bucket=s3_bucket, test_only=test_only) as uploader:
+        for input_file in input_files + [None]:
+            result = None
+            if input_file is not None:
+                result = journal.resumed_result(input_file)
+                if result is None:
+                    try:
+                        result = process_plume_images(input_file, s3_bucket=s3_bucket, test_only=test_only, verbose=verbose,
+                                                      timer=timer, uploader=uploader)
+                    except:
+                        traceback.print_exc()
+                        failed.append(input_file)
+
+            if pending is not None and not _write_batch_plume(pending[0], pending[1], conn, timer, journal, test_only, images_only, verbose):
+                failed.append(pending[0])
+
+            pending = (input_file, result) if result is not None else None
+    return failed
+
+
+def _ingest_plume_batch_parallel(input_files, conn, timer, journal, s3_bucket, test_only, images_only, verbose, workers):
+    failed = []
+    executor = ProcessPoolExecutor(max_workers=workers)
+    cog_threads = cog_threads_per_worker(workers)
+    try:
+        futures = {}
+        for input_file in input_files:
+            if journal.resumed_result(input_file) is None:
+                futures[input_file] = executor.submit(process_plume_images_in_worker, input_file, s3_bucket, test_only, verbose, cog_threads)
+
+        for input_file in input_files:
+            if input_file in futures:
+                result, stages, error = futures.pop(input_file).result()
+                timer.merge(stages)
+            else:
+                result, error = journal.resumed_result(input_file), None
+
+            if error is not None:
+                print("Error processing %s:\n%s" % (input_file, error))
+                failed.append(input_file)
+                continue
+
+            if not _write_batch_plume(input_file, result, conn, timer, journal, test_only, images_only, verbose):
+                failed.append(input_file)
+    finally:
+        executor.shutdown(wait=True)
+    return failed
 
 
 if __name__ == "__main__":
@@ -662,6 +844,14 @@ if __name__ == "__main__":
     parser.add_argument("-i", "--imagesonly",
                         help="Only upload images to S3. Don't actually upload to Solr.",
                         required=False, action="store_true")
+    parser.add_argument("-w", "--workers", help="Number of processes for the raster/upload stages", type=int, default=1, required=False)
+    parser.add_argument("-m", "--manifest", help="SQLite job manifest used to skip or resume plumes from an earlier run", type=str, default=None, required=False)
+    parser.add_argument("-T", "--tiles", help="Also upload an XYZ tile pyramid of each plume overlay",
+                        required=False, action="store_true")
+    parser.add_argument("-f", "--force-upload", help="Upload to S3 even when the stored object already has the same content",
+                        required=False, action="store_true")
+    parser.add_argument("-C", "--colorize", help="Colour single-band CH4 plume images with the CH4 colour map instead of greyscale",
+                        required=False, action="store_true")
 
     args = parser.parse_args()
     input_files = args.data
@@ -669,12 +859,17 @@ if __name__ == "__main__":
     test_only = args.test
     verbose = args.verbose
     images_only = args.imagesonly
+    workers = args.workers
+    manifest_path = args.manifest
 
-    if not os.path.exists("tmp"):
-        os.mkdir("tmp")
+    if args.force_upload:
+        s3util.S3_SKIP_UNCHANGED = False
+    if args.tiles:
+        PLUME_TILES = True
+    if args.colorize:
+        PLUME_COLORMAP = raster.CH4_COLORMAP
 
-    for input_file in input_files:
-        ingest_aviris_plume_geojson(geojson=input_file, s3_bucket=s3_bucket, test_only=test_only, images_only=images_only, verbose=verbose)
+    ingest_plume_batch(input_files, s3_bucket=s3_bucket, test_only=test_only, images_only=images_only, verbose=verbose, workers=workers, manifest_path=manifest_path)
 
     #geojson = sys.argv[1]
     #ingest_aviris_geojson(geojson)
@@ -8,16 +8,10 @@ import types
 import os
 import uuid
 from ingestutils import sectors
-import psycopg2
+from ingestutils import db
 import csv
 
 
-DB_ENDPOINT = "localhost"
-DB_PORT = 5432
-DB_USER = ""
-DB_PASSWD = ""
-DB_NAME = ""
-
 
 VISTA_NA_FILL_VALUE = "NA"
 
@@ -195,7 +189,7 @@ def set_all_in_db_inactive(cur):
 
 
 def upload_sources(sources, test_only=False, verbose=False):
-    conn = psycopg2.connect(dbname=DB_NAME, user=DB_USER, password=DB_PASSWD, host=DB_ENDPOINT, port=DB_PORT)
+    conn = db.connect()
     cur = conn.cursor()
 
     set_all_in_db_inactive(cur)
@@ -208,7 +202,7 @@ def upload_sources(sources, test_only=False, verbose=False):
     else:
         conn.commit()
     cur.close()
-    conn.close()
+    db.release(conn)
 
 
 def process_workbook(input_file, worksheet_name, test_only=False, verbose=False):
@@ -3,13 +3,13 @@ import os.path
 from osgeo import gdal,ogr,osr
 import argparse
 import psycopg2
+import psycopg2.extras
 from ingestutils import sectors
-
-DB_ENDPOINT = "localhost"
-DB_PORT = 5432
-DB_USER = ""
-DB_PASSWD = ""
-DB_NAME = ""
+from ingestutils import bulk
+from ingestutils.manifest import JobManifest, STAGE_DB_COMMITTED, stage_reached
+from ingestutils.manifest import content_hash as manifest_content_hash
+from ingestutils.features import iter_layers, iter_features, distinct_field_values, FieldSchema
+from ingestutils import db
 
 
 
@@ -46,15 +46,6 @@ CATEGORY_MAP = {
 
 
 
-def get_definition_field_value(layerDefinition, feature, reqd_field_name):
-    for i in range(layerDefinition.GetFieldCount()):
-        field_name = layerDefinition.GetFieldDefn(i).GetName()
-        field_value = feature.GetField(field_name)
-        if field_name == reqd_field_name:
-            return field_value
-
-    return None
-
 def envelope_to_polygon(envelope):
     ring = ogr.Geometry(ogr.wkbLinearRing)
 
@@ -69,32 +60,6 @@ def envelope_to_polygon(envelope):
     return poly
 
 
-def get_vista_table_sequence_value(cur):
-    sql = """
-    select currval('vista_id_seq');
-    """
-    cur.execute(sql)
-    row = cur.fetchone()
-    return row[0]
-
-
-def shape_exists_in_db(cur, vista_id):
-    sql = """
-    select count(1) from vista where vista_id = %s;
-    """
-    cur.execute(sql, (vista_id,))
-    row = cur.fetchone()
-    return row[0] >= 1
-
-
-def get_vista_db_id_from_vista_id(cur, vista_id):
-    sql = """
-    select id from vista where vista_id = %s;
-    """
-    cur.execute(sql, (vista_id, ))
-    row = cur.fetchone()
-    return row[0]
-
 def clear_shape_metadata_in_db(cur, vista_db_id):
     sql = """
     delete from vista_metadata where vista_id = %s
@@ -102,162 +67,31 @@ def clear_shape_metadata_in_db(cur, vista_db_id):
     cur.execute(sql, (vista_db_id,))
 
 
-def update_in_db(cur, category, category_id, site_name, feature_type, feature,
-                    site_center_lon, site_center_lat,
-                    loperator, lsitename, lstate, laddress, lsector, lcity,
-                    geom_poly, geom_line, envelope_wkt, sector_level_1, sector_level_2, sector_level_3, vista_id, layerDefinition, verbose=False):
+def upsert_in_db(cur, r, feature, schema, verbose=False):
     if verbose:
-        print("     Updating vista %s"%vista_id)
+        print("     Writing vista %s"%r["vista_id"])
 
-    vista_db_id = get_vista_db_id_from_vista_id(cur, vista_id)
+    cur.execute(VISTA_UPSERT_SQL % VISTA_BATCH_TEMPLATE + " returning id", vista_record_values(r))
+    vista_db_id = cur.fetchone()[0]
     if verbose:
         print("     Internal db identifier: %s"%vista_db_id)
 
-    sql = """
-    update vista set
-          category=%s,
-    	  category_id=%s, 
-    	  name=%s, 
-    	  description=%s,
-    	  shape_type=%s, 
-    	  geojson=%s, 
-    	  longitude=%s, 
-    	  latitude=%s, 
-    	  operator=%s, 
-    	  site_name=%s, 
-    	  state=%s, 
-    	  address=%s, 
-    	  sector=%s, 
-    	  city=%s, 
-    	  facility_location=ST_GeomFromText('POINT(%s %s)', 4326),
-    	  facility_shape=ST_GeomFromText(%s, 4326),
-    	  facility_shape_line=ST_GeomFromText(%s, 4326),
-    	  facility_envelope=ST_GeomFromText(%s, 4326),
-    	  sector_level_1=%s,
-    	  sector_level_2=%s,
-    	  sector_level_3=%s,
-    	  vista_id=%s,
-    	  is_active=true
-    where
-      id=%s;
-    """
-    cur.execute(sql,
-                (
-                    category,
-                    category_id,
-                    site_name,
-                    None,
-                    feature_type,
-                    feature.ExportToJson(),
-                    site_center_lon,
-                    site_center_lat,
-                    loperator,
-                    lsitename,
-                    lstate,
-                    laddress,
-                    lsector,
-                    lcity,
-                    site_center_lon,
-                    site_center_lat,
-                    geom_poly,
-                    geom_line,
-                    envelope_wkt,
-                    sector_level_1,
-                    sector_level_2,
-                    sector_level_3,
-                    vista_id,
-                    vista_db_id
-                )
-            )
     clear_shape_metadata_in_db(cur, vista_db_id)
-    insert_vista_metadata(cur, vista_db_id, layerDefinition, feature)
+    insert_vista_metadata(cur, vista_db_id, schema, feature)
 
 
-def insert_to_db(cur, category, category_id, site_name, feature_type, feature,
-                    site_center_lon, site_center_lat,
-                    loperator, lsitename, lstate, laddress, lsector, lcity,
-                    geom_poly, geom_line, envelope_wkt, sector_level_1, sector_level_2, sector_level_3, vista_id, layerDefinition, verbose=False):
 
-    if verbose:
-        print("     Inserting vista %s" % vista_id)
+VISTA_RECORD_FIELDS = ("Vista_ID", "VistaIPCC", "LOperator", "LState", "LAddress", "LCity")
 
-    sql = """
-        INSERT INTO vista
-        (
-    	  category,
-    	  category_id, 
-    	  name, 
-    	  description,
-    	  shape_type, 
-    	  geojson, 
-    	  longitude, 
-    	  latitude, 
-    	  operator, 
-    	  site_name, 
-    	  state, 
-    	  address, 
-    	  sector, 
-    	  city, 
-    	  facility_location,
-    	  facility_shape,
-    	  facility_shape_line,
-    	  facility_envelope,
-    	  sector_level_1,
-    	  sector_level_2,
-    	  sector_level_3,
-    	  vista_id,
-    	  is_active
-    	  ) VALUES (
-    	   %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s,
-    	   ST_GeomFromText('POINT(%s %s)', 4326),
-    	   ST_GeomFromText(%s, 4326),
-    	   ST_GeomFromText(%s, 4326),
-    	   ST_GeomFromText(%s, 4326),
-    	   %s, %s, %s, %s, true
-    	  );
-        """
-    cur.execute(sql,
-                (
-                    category,
-                    category_id,
-                    site_name,
-                    None,
-                    feature_type,
-                    feature.ExportToJson(),
-                    site_center_lon,
-                    site_center_lat,
-                    loperator,
-                    lsitename,
-                    lstate,
-                    laddress,
-                    lsector,
-                    lcity,
-                    site_center_lon,
-                    site_center_lat,
-                    geom_poly,
-                    geom_line,
-                    envelope_wkt,
-                    sector_level_1,
-                    sector_level_2,
-                    sector_level_3,
-                    vista_id
-                )
-            )
-
-    vista_db_id = get_vista_table_sequence_value(cur)
-
-    insert_vista_metadata(cur, vista_db_id, layerDefinition, feature)
-
-
-
-def process_shape(cur, feature, transform, layerDefinition, test_only=False, verbose=False):
+
+def build_vista_record(feature, transform, schema, verbose=False):
     geom = feature.GetGeometryRef()
     geom.Transform(transform)
 
     try:
-        site_name = get_definition_field_value(layerDefinition, feature, "VistaName")
+        site_name = schema.get(feature, "VistaName")
     except ValueError:
-        site_name = get_definition_field_value(layerDefinition, feature, "LSiteName")
+        site_name = schema.get(feature, "LSiteName")
 
     feature_type = geom.GetGeometryName().lower()
 
@@ -276,7 +110,7 @@ def process_shape(cur, feature, transform, layerDefinition, test_only=False, ver
 
     envelope = envelope_to_polygon(geom.GetEnvelope())
 
-    category = get_definition_field_value(layerDefinition, feature, "VistaSType")
+    category = schema.get(feature, "VistaSType")
 
     if category not in CATEGORY_MAP:
         raise Exception("Category '%s' not found."%category)
@@ -285,14 +119,9 @@ def process_shape(cur, feature, transform, layerDefinition, test_only=False, ver
 
     site_center_lat = centroid.GetY()
     site_center_lon = centroid.GetX()
-    vista_id = get_definition_field_value(layerDefinition, feature, "Vista_ID")
-    vista_ipcc = get_definition_field_value(layerDefinition, feature, "VistaIPCC")
-    loperator = get_definition_field_value(layerDefinition, feature, "LOperator")
+    vista_id, vista_ipcc, loperator, lstate, laddress, lcity = schema.values(feature, VISTA_RECORD_FIELDS)
     lsitename = site_name
-    lstate = get_definition_field_value(layerDefinition, feature, "LState")
-    laddress = get_definition_field_value(layerDefinition, feature, "LAddress")
-    lsector = get_definition_field_value(layerDefinition, feature, "VistaIPCC")
-    lcity = get_definition_field_value(layerDefinition, feature, "LCity")
+    lsector = vista_ipcc
     try:
         sector_level_3, sector_level_2, sector_level_1 = sectors.get_sectors_by_level_3(vista_ipcc)
     except:
@@ -310,25 +139,149 @@ def process_shape(cur, feature, transform, layerDefinition, test_only=False, ver
     else:
         geom_poly = geom.ExportToWkt()
 
-    does_exist = shape_exists_in_db(cur, vista_id)
-    if does_exist:
-        update_in_db(cur, category, category_id, site_name, feature_type, feature,
-                     site_center_lon, site_center_lat,
-                     loperator, lsitename, lstate, laddress, lsector, lcity,
-                     geom_poly, geom_line, envelope.ExportToWkt(), sector_level_1, sector_level_2, sector_level_3, vista_id,
-                     layerDefinition)
-    else:
-        insert_to_db(cur, category, category_id, site_name, feature_type, feature,
-                     site_center_lon, site_center_lat,
-                     loperator, lsitename, lstate, laddress, lsector, lcity,
-                     geom_poly, geom_line, envelope.ExportToWkt(), sector_level_1, sector_level_2, sector_level_3, vista_id,
-                     layerDefinition)
+    return {
+        "category": category,
+        "category_id": category_id,
+        "site_name": site_name,
+        "feature_type": feature_type,
+        "site_center_lon": site_center_lon,
+        "site_center_lat": site_center_lat,
+        "loperator": loperator,
+        "lsitename": lsitename,
+        "lstate": lstate,
+        "laddress": laddress,
+        "lsector": lsector,
+        "lcity": lcity,
+        "geom_poly": geom_poly,
+        "geom_line": geom_line,
+        "envelope_wkt": envelope.ExportToWkt(),
+        "sector_level_1": sector_level_1,
+        "sector_level_2": sector_level_2,
+        "sector_level_3": sector_level_3,
+        "vista_id": vista_id
+    }
 
 
+def process_shape(cur, feature, transform, schema, test_only=False, verbose=False):
+    r = build_vista_record(feature, transform, schema, verbose=verbose)
+    r["geojson"] = feature.ExportToJson()
+
+    upsert_in_db(cur, r, feature, schema, verbose)
+    return r["vista_id"]
+
+
+VISTA_BATCH_COLUMNS = [
+    "category",
+    "category_id",
+    "name",
+    "description",
+    "shape_type",
+    "geojson",
+    "longitude",
+    "latitude",
+    "operator",
+    "site_name",
+    "state",
+    "address",
+    "sector",
+    "city",
+    "facility_location",
+    "facility_shape",
+    "facility_shape_line",
+    "facility_envelope",
+    "sector_level_1",
+    "sector_level_2",
+    "sector_level_3",
+    "vista_id",
+    "is_active"
+]
+
+VISTA_BATCH_TEMPLATE = """(
+    %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s,
+    ST_SetSRID(ST_MakePoint(%s, %s), 4326),
+    ST_GeomFromText(%s, 4326),
+    ST_GeomFromText(%s, 4326),
+    ST_GeomFromText(%s, 4326),
+    %s, %s, %s, %s, true
+)"""
+
+# vista_id is unique (sql/005_loader_upsert_keys.sql): a feature that is
+# already loaded is updated and reactivated in the same statement that would
+# insert it. The values placeholder takes VISTA_BATCH_TEMPLATE for one row or
+# is left to execute_values for a batch.
+VISTA_UPSERT_SQL = """
+insert into vista (%s) values %%s
+on conflict (vista_id) do update set
+    %s
+""" % (", ".join(VISTA_BATCH_COLUMNS),
+       ",\n    ".join("%s = excluded.%s" % (c, c) for c in VISTA_BATCH_COLUMNS if c != "vista_id"))
+
+
+def vista_record_values(r):
+    return (
+        r["category"],
+        r["category_id"],
+        r["site_name"],
+        None,
+        r["feature_type"],
+        r["geojson"],
+        r["site_center_lon"],
+        r["site_center_lat"],
+        r["loperator"],
+        r["lsitename"],
+        r["lstate"],
+        r["laddress"],
+        r["lsector"],
+        r["lcity"],
+        r["site_center_lon"],
+        r["site_center_lat"],
+        r["geom_poly"],
+        r["geom_line"],
+        r["envelope_wkt"],
+        r["sector_level_1"],
+        r["sector_level_2"],
+        r["sector_level_3"],
+        r["vista_id"]
+    )
+
+
+def write_vista_batch(cur, records, verbose=False):
+    """
+    Upserts a batch of VISTA records and their metadata in a handful of
+    statements: one multi-row insert ... on conflict returning the row ids,
+    one metadata delete and one metadata COPY.
+    """
+    # A vista_id repeated within the batch would otherwise hit the same row
+    # twice in one statement, which on conflict rejects
+    by_vista_id = {}
+    for r in records:
+        by_vista_id[r["vista_id"]] = r
+
+    if verbose:
+        print("     Writing %d vista entries" % len(by_vista_id))
+
+    db_ids = {}
+    if len(by_vista_id) > 0:
+        written = psycopg2.extras.execute_values(cur, VISTA_UPSERT_SQL + " returning vista_id, id",
+                                                 [vista_record_values(r) for r in by_vista_id.values()],
+                                                 template=VISTA_BATCH_TEMPLATE, page_size=len(by_vista_id), fetch=True)
+        db_ids = dict(written)
+
+        cur.execute("delete from vista_metadata where vista_id = any(%s)", (list(db_ids.values()),))
 
+    metadata_rows = []
+    for r in by_vista_id.values():
+        vista_db_id = db_ids[r["vista_id"]]
+        for field_name, field_value in r["metadata"]:
+            metadata_rows.append((vista_db_id, field_name, field_value))
 
+    bulk.copy_rows(cur, "vista_metadata", ["vista_id", "property_name", "property_value"], metadata_rows)
 
-def insert_vista_metadata(cur, vista_id, layerDefinition, feature):
+
+
+
+
+def insert_vista_metadata(cur, vista_id, schema, feature):
     sql = """
     insert into vista_metadata
       (
@@ -339,32 +292,50 @@ def insert_vista_metadata(cur, vista_id, layerDefinition, feature):
         %s, %s, %s
       );
     """
-    for i in range(layerDefinition.GetFieldCount()):
-        field_name = layerDefinition.GetFieldDefn(i).GetName()
-        field_value = feature.GetField(field_name)
+    for field_name, field_value in schema.items(feature):
         cur.execute(sql,(vista_id, field_name, field_value))
 
 
-def set_categories_inactive(cur, categories_list, verbose=False):
+def set_categories_inactive(cur, categories_list, keep_vista_ids=None, verbose=False):
+    """
+    Deactivates every feature in the categories, except those in
+    keep_vista_ids.
+    """
     for category_id in categories_list:
         if verbose:
             print("Setting category id %s as inactive"%category_id)
-        sql = """
-        update vista set is_active=false where category_id = %s
-        """
-        cur.execute(sql, (category_id,))
+        if keep_vista_ids:
+            sql = """
+            update vista set is_active=false where category_id = %s and coalesce(vista_id::text <> all(%s), true)
+            """
+            cur.execute(sql, (category_id, list(keep_vista_ids)))
+        else:
+            sql = """
+            update vista set is_active=false where category_id = %s
+            """
+            cur.execute(sql, (category_id,))
+
+
+def vista_ids_loaded_by_others(manifest, input_path):
+    """
+    The vista_ids committed from the other shapefiles in the manifest. Several
+    shapefiles share a category id, and a sibling skipped as unchanged will
+    not load its features again, so they must stay active.
+    """
+    keep = set()
+    for other_path, outputs in manifest.outputs_at_stage(VISTA_JOB, STAGE_DB_COMMITTED).items():
+        if other_path != input_path and outputs is not None:
+            keep.update(outputs.get("vista_ids", []))
+    return keep
 
 
 def fetch_categories_for_load(file):
     categories = []
 
-    for layer_num in range(0, file.GetLayerCount()):
-        layer = file.GetLayer(layer_num)
-        layerDefinition = layer.GetLayerDefn()
-        for feature_num in range(0, layer.GetFeatureCount()):
-            feature = layer.GetFeature(feature_num)
-            category = get_definition_field_value(layerDefinition, feature, "VistaSType")
-
+    for layer in iter_layers(file):
+        if layer.GetLayerDefn().GetFieldIndex("VistaSType") < 0:
+            continue
+        for category in distinct_field_values(file, layer, "VistaSType"):
             if category in CATEGORY_MAP:
                 category_id = CATEGORY_MAP[category]
                 if category_id not in categories:
@@ -375,55 +346,81 @@ def fetch_categories_for_load(file):
 def fetch_ipcc_list(file):
     ipcc_list = []
 
-    for layer_num in range(0, file.GetLayerCount()):
-        layer = file.GetLayer(layer_num)
-        layerDefinition = layer.GetLayerDefn()
-        for feature_num in range(0, layer.GetFeatureCount()):
-            feature = layer.GetFeature(feature_num)
-            ipcc = get_definition_field_value(layerDefinition, feature, "VistaIPCC")
+    for layer in iter_layers(file):
+        if layer.GetLayerDefn().GetFieldIndex("VistaIPCC") < 0:
+            continue
+        for ipcc in distinct_field_values(file, layer, "VistaIPCC"):
             sector_level_3, sector_level_2, sector_level_1 = sectors.get_sectors_by_level_3(ipcc)
 
             if sector_level_1 not in ipcc_list:
                 ipcc_list.append(sector_level_1)
 
-    return ipcc
+    return ipcc_list
+
+VISTA_JOB = "vista"
 
-def process_vista_shapefile(input_path, noinactive=False, quickcheck=False, test_only=False, verbose=False):
+
+def shapefile_source_files(input_path):
+    base = os.path.splitext(input_path)[0]
+    return [input_path] + ["%s.%s" % (base, ext) for ext in ("dbf", "shx", "prj")]
+
+
+def process_vista_shapefile(input_path, noinactive=False, quickcheck=False, test_only=False, verbose=False, batch_size=0, manifest=None):
 
     if verbose is True:
         print "Processing input file:", input_path
 
-    conn = psycopg2.connect(dbname=DB_NAME, user=DB_USER, password=DB_PASSWD, host=DB_ENDPOINT, port=DB_PORT)
+    # Each shapefile is a single transaction, so it is either fully committed
+    # or not started; there is no partial state to resume.
+    record_in_manifest = manifest is not None and not test_only and not quickcheck
+    if record_in_manifest:
+        content_hash = manifest_content_hash(shapefile_source_files(input_path))
+        stage, outputs = manifest.get(VISTA_JOB, input_path, content_hash)
+        if stage_reached(stage, STAGE_DB_COMMITTED):
+            print("Skipping %s, unchanged since it was last committed" % input_path)
+            return
+
+    conn = db.connect()
     cur = conn.cursor()
 
     if verbose is True:
-        print "Loading file into memory..."
+        print "Opening file..."
 
     file = ogr.Open(input_path)
 
     categories_list = fetch_categories_for_load(file)
 
     if not noinactive:
-        set_categories_inactive(cur, categories_list, verbose=verbose)
+        keep_vista_ids = vista_ids_loaded_by_others(manifest, input_path) if manifest is not None else None
+        set_categories_inactive(cur, categories_list, keep_vista_ids, verbose=verbose)
 
     targetSpatialRef = osr.SpatialReference()
     targetSpatialRef.ImportFromEPSG(4326)
 
+    batch = []
+    vista_ids = []
     n = 0
-    for layer_num in range(0, file.GetLayerCount()):
-        layer = file.GetLayer(layer_num)
+    for layer in iter_layers(file):
 
-        layerDefinition = layer.GetLayerDefn()
+        schema = FieldSchema(layer.GetLayerDefn())
 
         spatialRef = layer.GetSpatialRef()
         transform = osr.CoordinateTransformation(spatialRef, targetSpatialRef)
 
-        for feature_num in range(0, layer.GetFeatureCount()):
-
-            feature = layer.GetFeature(feature_num)
+        for feature in iter_features(layer):
 
             #try:
-            process_shape(cur, feature, transform, layerDefinition, test_only=test_only, verbose=verbose)
+            if batch_size > 0:
+                record = build_vista_record(feature, transform, schema, verbose=verbose)
+                record["geojson"] = feature.ExportToJson()
+                record["metadata"] = schema.items(feature)
+                batch.append(record)
+                vista_ids.append(record["vista_id"])
+                if len(batch) >= batch_size:
+                    write_vista_batch(cur, batch, verbose=verbose)
+                    batch = []
+            else:
+                vista_ids.append(process_shape(cur, feature, transform, schema, test_only=test_only, verbose=verbose))
 
             n = n + 1
             if quickcheck is True and n >= 10:
@@ -433,6 +430,8 @@ def process_vista_shapefile(input_path, noinactive=False, quickcheck=False, test
             #break
         #break
 
+    if len(batch) > 0:
+        write_vista_batch(cur, batch, verbose=verbose)
 
     if test_only:
         if verbose:
@@ -442,8 +441,11 @@ def process_vista_shapefile(input_path, noinactive=False, quickcheck=False, test
         if verbose:
             print("Committing changes")
         conn.commit()
+        if record_in_manifest:
+            manifest.mark(VISTA_JOB, input_path, content_hash, STAGE_DB_COMMITTED,
+                          {"features": n, "vista_ids": [str(v) for v in vista_ids if v is not None]})
     cur.close()
-    conn.close()
+    db.release(conn)
 
 
 def gdal_error_handler(err_class, err_num, err_msg):
@@ -479,12 +481,21 @@ if __name__ == "__main__":
     parser.add_argument("-n", "--noinactive", help="Don't flag existing entries as inactive", required=False, action="store_true")
     parser.add_argument("-q", "--quick", help="Quick check. Only ingest ten entries then quit", required=False,
                         action="store_true")
+    parser.add_argument("-m", "--manifest", help="SQLite job manifest used to skip shapefiles already ingested unchanged", type=str, default=None, required=False)
+    parser.add_argument("-B", "--batch-size", help="Write features in batches of this many rows (0 writes one at a time)",
+                        type=int, default=0, required=False)
     args = parser.parse_args()
     input_files = args.data
     test_only = args.test
     verbose = args.verbose
     noinactive = args.noinactive
     quickcheck = args.quick
+    batch_size = args.batch_size
+    manifest = JobManifest(args.manifest) if args.manifest is not None else None
 
-    for input_file in input_files:
-        process_vista_shapefile(input_file, noinactive=noinactive, quickcheck=quickcheck, test_only=test_only, verbose=verbose)
\ No newline at end of file
+    try:
+        for input_file in input_files:
+            process_vista_shapefile(input_file, noinactive=noinactive, quickcheck=quickcheck, test_only=test_only, verbose=verbose, batch_size=batch_size, manifest=manifest)
+    finally:
+        if manifest is not None:
+            manifest.close()
\ No newline at end of file
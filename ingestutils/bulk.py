@@ -0,0 +1,76 @@
+try:
+    string_types = (str, unicode)
+except NameError:
+    string_types = (str,)
+
+
+def csv_field(value):
+    """
+    One CSV field for COPY. None is an unquoted empty field, which COPY reads
+    as NULL; everything else is quoted, so an empty string stays an empty
+    string.
+    """
+    if value is None:
+        return ""
+    if isinstance(value, float):
+        value = repr(value)
+    elif not isinstance(value, string_types):
+        value = str(value)
+    return '"' + value.replace('"', '""') + '"'
+
+
+class RowStream:
+    """
+    File-like wrapper that renders an iterable of row tuples as CSV on demand,
+    so COPY FROM STDIN can consume a large input without it being buffered in
+    full first. None values are written as unquoted empty fields, which COPY
+    reads as NULL, and all other values are quoted.
+    """
+
+    def __init__(self, rows):
+        self.rows = iter(rows)
+        self.pending = ""
+
+    def _fill(self, size):
+        lines = []
+        length = len(self.pending)
+        while size < 0 or length < size:
+            try:
+                row = next(self.rows)
+            except StopIteration:
+                break
+            line = ",".join([csv_field(v) for v in row]) + "\n"
+            lines.append(line)
+            length += len(line)
+        if len(lines) > 0:
+            self.pending += "".join(lines)
+
+    def read(self, size=-1):
+        self._fill(size)
+        if size < 0:
+            data, self.pending = self.pending, ""
+        else:
+            data, self.pending = self.pending[:size], self.pending[size:]
+        return data
+
+    def readline(self, size=-1):
+        return self.read(size)
+
+
+def create_staging_table(cur, table_name, column_defs):
+    """
+    Creates a temporary table that disappears at the end of the transaction.
+    column_defs is a list of (name, type) pairs.
+    """
+    sql = "create temp table %s (%s) on commit drop" % (table_name, ", ".join("%s %s" % (n, t) for n, t in column_defs))
+    cur.execute(sql)
+
+
+def copy_rows(cur, table_name, columns, rows):
+    """
+    Streams rows (tuples in the same order as columns) into table_name with
+    COPY ... FROM STDIN. Returns the number of rows copied.
+    """
+    sql = "copy %s (%s) from stdin with (format csv)" % (table_name, ", ".join(columns))
+    cur.copy_expert(sql, RowStream(rows))
+    return cur.rowcount
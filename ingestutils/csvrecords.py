@@ -0,0 +1,108 @@
+import re
+import csv
+from collections import namedtuple
+
+
+# Placeholders the plume and source spreadsheets use in numeric columns
+TBD_VALUE = -9999.0
+NULL_MARKERS = set(["", "#DIV/0!"])
+
+DEFAULT_CHUNK_SIZE = 5000
+
+
+def str_to_float(s, tbd=TBD_VALUE):
+    if s is None or s in NULL_MARKERS:
+        return None
+    if s == "TBD":
+        return tbd
+    return float(s)
+
+
+def column_to_floats(values, tbd=TBD_VALUE):
+    # A plain loop: parsing through NumPy object or string arrays was
+    # slower than this for chunk-sized columns
+    return [str_to_float(v, tbd) for v in values]
+
+
+def _field_name(header):
+    name = re.sub(r"[^0-9a-zA-Z]+", "_", header).strip("_").lower()
+    return name or "column"
+
+
+def record_type(columns, name="Record"):
+    """
+    A namedtuple class with one field per CSV column. Besides attribute and
+    positional access, fields can be looked up by their header string, so a
+    record can stand in for the header-keyed dicts the loaders used before.
+    """
+    base = namedtuple(name, [_field_name(c) for c in columns], rename=True)
+    index = dict((c, i) for i, c in enumerate(columns))
+
+    def __getitem__(self, key):
+        if key in index:
+            key = index[key]
+        return tuple.__getitem__(self, key)
+
+    return type(name, (base,), {"__slots__": (), "__getitem__": __getitem__, "columns": tuple(columns)})
+
+
+class CsvRecordReader:
+    """
+    Streams a CSV file as typed records without holding more than one chunk
+    of rows in memory. Only the given columns are kept. The header row is
+    mapped to column positions once, and columns listed in float_columns
+    are converted with str_to_float one whole column of a chunk at a time.
+    In the float columns also listed in null_tbd_columns, such as
+    coordinates, "TBD" reads as None rather than TBD_VALUE. Iterating
+    yields records; chunks() yields lists of them.
+    """
+
+    def __init__(self, input_file, columns, float_columns=(), chunk_size=DEFAULT_CHUNK_SIZE, name="Record", null_tbd_columns=()):
+        self.input_file = input_file
+        self.columns = []
+        for column in columns:
+            if column not in self.columns:
+                self.columns.append(column)
+        float_columns = set(float_columns)
+        self.is_float = [c in float_columns for c in self.columns]
+        null_tbd_columns = set(null_tbd_columns)
+        self.tbd = [None if c in null_tbd_columns else TBD_VALUE for c in self.columns]
+        self.chunk_size = chunk_size
+        self.record_class = record_type(self.columns, name)
+
+    def _positions(self, header_row):
+        headers = dict((h.strip(), i) for i, h in reversed(list(enumerate(header_row))))
+        missing = [c for c in self.columns if c not in headers]
+        if len(missing) > 0:
+            raise ValueError("%s is missing columns: %s" % (self.input_file, ", ".join(missing)))
+        return [headers[c] for c in self.columns]
+
+    def _build(self, rows, positions):
+        columns = []
+        for position, is_float, tbd in zip(positions, self.is_float, self.tbd):
+            values = [row[position] if position < len(row) else "" for row in rows]
+            columns.append(column_to_floats(values, tbd) if is_float else values)
+        return [self.record_class._make(values) for values in zip(*columns)]
+
+    def chunks(self):
+        with open(self.input_file) as csvfile:
+            data = csv.reader(csvfile, delimiter=',', quotechar='\"')
+            positions = None
+            rows = []
+            for row in data:
+                if positions is None:
+                    positions = self._positions(row)
+                    continue
+                if len(row) == 0:
+                    continue
+                rows.append(row)
+                if len(rows) >= self.chunk_size:
+                    yield self._build(rows, positions)
+                    rows = []
+            if len(rows) > 0:
+                yield self._build(rows, positions)
+
+    def __iter__(self):
+        for chunk in self.chunks():
+            for record in chunk:
+                yield record
@@ -0,0 +1,138 @@
+import os
+import re
+import weakref
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2 import pool
+
+
+# Defaults used when the matching MSF_DB_* environment variable is unset.
+# Empty values are left out so libpq can fall back to PGHOST, PGUSER,
+# ~/.pgpass and so on.
+DB_ENDPOINT = "localhost"
+DB_PORT = 5432
+DB_USER = ""
+DB_PASSWD = ""
+DB_NAME = ""
+
+CONNECTION_SETTINGS = [
+    ("host", "MSF_DB_HOST", DB_ENDPOINT),
+    ("port", "MSF_DB_PORT", DB_PORT),
+    ("dbname", "MSF_DB_NAME", DB_NAME),
+    ("user", "MSF_DB_USER", DB_USER),
+    ("password", "MSF_DB_PASSWORD", DB_PASSWD),
+    ("sslmode", "MSF_DB_SSLMODE", ""),
+    ("connect_timeout", "MSF_DB_CONNECT_TIMEOUT", "")
+]
+
+POOL_MIN_CONNECTIONS = int(os.environ.get("MSF_DB_POOL_MIN", 1))
+POOL_MAX_CONNECTIONS = int(os.environ.get("MSF_DB_POOL_MAX", 8))
+
+_pool = None
+_pool_pid = None
+_prepared = weakref.WeakKeyDictionary()
+
+
+def connection_params():
+    params = {}
+    for name, env_var, default in CONNECTION_SETTINGS:
+        value = os.environ.get(env_var, default)
+        if value not in ("", None):
+            params[name] = value
+    return params
+
+
+def get_pool():
+    """
+    The process-wide connection pool, created on first use. A forked pool
+    worker gets a pool of its own rather than sharing its parent's sockets.
+    """
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid != os.getpid():
+        _pool = pool.ThreadedConnectionPool(POOL_MIN_CONNECTIONS, POOL_MAX_CONNECTIONS, **connection_params())
+        _pool_pid = os.getpid()
+    return _pool
+
+
+def connect():
+    """
+    Takes a connection from the pool. Hand it back with release rather than
+    closing it, so the next file or item skips connection setup.
+    """
+    return get_pool().getconn()
+
+
+def release(conn):
+    # The pool rolls back anything left open and drops broken connections
+    if conn is not None:
+        get_pool().putconn(conn, close=bool(conn.closed))
+
+
+def close_all():
+    global _pool
+    if _pool is not None and _pool_pid == os.getpid():
+        _pool.closeall()
+    _pool = None
+
+
+@contextmanager
+def transaction(test_only=False):
+    """
+    Yields a pooled connection and commits when the block finishes, or rolls
+    back if it raises or test_only is set.
+    """
+    conn = connect()
+    try:
+        yield conn
+    except:
+        conn.rollback()
+        raise
+    else:
+        if test_only:
+            conn.rollback()
+        else:
+            conn.commit()
+    finally:
+        release(conn)
+
+
+def to_positional(sql):
+    """
+    Rewrites psycopg2 %s placeholders as $1, $2, ... for PREPARE. Statements
+    must not contain %s inside string literals.
+    """
+    counter = [0]
+
+    def number(match):
+        counter[0] += 1
+        return "$%d" % counter[0]
+
+    return re.sub(r"%s", number, sql), counter[0]
+
+
+def prepare(cur, name, sql):
+    """
+    PREPAREs sql (with %s placeholders) as name on the cursor's connection,
+    once per connection. Prepared statements outlive transactions, so a
+    pooled connection keeps them for every later file.
+    """
+    conn = cur.connection
+    statements = _prepared.setdefault(conn, {})
+    if name not in statements:
+        positional, count = to_positional(sql)
+        cur.execute("prepare %s as %s" % (name, positional))
+        statements[name] = count
+    return statements[name]
+
+
+def execute_prepared(cur, name, sql, params):
+    """
+    Executes the prepared statement name, preparing it from sql first if this
+    connection hasn't seen it. Only the parameters travel to the server.
+    """
+    count = prepare(cur, name, sql)
+    if count == 0:
+        cur.execute("execute %s" % name)
+    else:
+        cur.execute("execute %s (%s)" % (name, ", ".join(["%s"] * count)), params)
@@ -0,0 +1,189 @@
+import os
+
+
+# Fields with a fixed type in the ENVI header format. Anything else is kept
+# as a string, or a list of strings for {...} values.
+INT_FIELDS = set([
+    "samples",
+    "lines",
+    "bands",
+    "header offset",
+    "data type",
+    "byte order",
+    "x start",
+    "y start"
+])
+
+INT_LIST_FIELDS = set([
+    "bbl",
+    "default bands"
+])
+
+FLOAT_LIST_FIELDS = set([
+    "wavelength",
+    "fwhm",
+    "data gain values",
+    "data offset values",
+    "data ignore value"
+])
+
+STRING_FIELDS = set([
+    "description",
+    "file type",
+    "interleave",
+    "sensor type",
+    "wavelength units",
+    "coordinate system string"
+])
+
+_cache = {}
+
+
+def header_path(image_path):
+    """
+    The .hdr next to an image, e.g. ang20190922t192642_rdn_v2u1_img.hdr
+    for ang20190922t192642_rdn_v2u1_img. ENVI allows either the image name
+    with ".hdr" appended or with its extension replaced.
+    """
+    if image_path.endswith(".hdr"):
+        return image_path
+    appended = image_path + ".hdr"
+    if os.path.exists(appended):
+        return appended
+    return os.path.splitext(image_path)[0] + ".hdr"
+
+
+def iter_header_fields(f):
+    """
+    Yields (key, raw_value) pairs from an open ENVI header. Keys are
+    lower-cased. A value enclosed in braces may span any number of lines;
+    its raw value is the text between the braces. Lines that are not
+    key = value pairs (the leading "ENVI", blank lines, ; comments) are
+    skipped.
+    """
+    key = None
+    parts = None
+    for line in f:
+        if parts is not None:
+            end = line.find("}")
+            if end < 0:
+                parts.append(line)
+                continue
+            parts.append(line[:end])
+            yield key, " ".join(p.strip() for p in parts).strip()
+            parts = None
+            continue
+
+        equals = line.find("=")
+        if equals < 0 or line.lstrip().startswith(";"):
+            continue
+
+        key = line[:equals].strip().lower()
+        value = line[equals + 1:].strip()
+        if value.startswith("{"):
+            end = value.find("}")
+            if end >= 0:
+                yield key, value[1:end].strip()
+            else:
+                parts = [value[1:]]
+        else:
+            yield key, value
+
+    if parts is not None:
+        raise ValueError("Unterminated {...} value for %s" % key)
+
+
+def split_list(raw):
+    return [v.strip() for v in raw.split(",")] if raw.strip() else []
+
+
+def parse_map_info(raw):
+    """
+    Parses the "map info" field: projection name, reference pixel, its map
+    coordinates, pixel size and, for UTM, zone and hemisphere, followed by
+    the datum and optional key=value entries such as units and rotation.
+    """
+    values = split_list(raw)
+    options = {}
+    while values and "=" in values[-1]:
+        name, value = values.pop().split("=", 1)
+        options[name.strip().lower()] = value.strip()
+
+    map_info = {
+        "projection": values[0],
+        "reference_x": float(values[1]),
+        "reference_y": float(values[2]),
+        "easting": float(values[3]),
+        "northing": float(values[4]),
+        "easting_scale": float(values[5]),
+        "northing_scale": float(values[6]),
+        "units": options.get("units"),
+        "rotation": float(options.get("rotation", 0.0))
+    }
+
+    rest = values[7:]
+    if map_info["projection"].upper() == "UTM":
+        map_info["zone"] = int(rest[0])
+        map_info["northing_hemi"] = rest[1]
+        map_info["northern"] = rest[1].lower().startswith("n")
+        rest = rest[2:]
+    map_info["datum"] = rest[0] if rest else None
+    return map_info
+
+
+def parse_field(key, raw):
+    if key in INT_FIELDS:
+        return int(raw)
+    if key in FLOAT_LIST_FIELDS:
+        return [float(v) for v in split_list(raw)]
+    if key in INT_LIST_FIELDS:
+        return [int(float(v)) for v in split_list(raw)]
+    if key == "map info":
+        return parse_map_info(raw)
+    if key in STRING_FIELDS:
+        return raw
+    if "," in raw:
+        return split_list(raw)
+    return raw
+
+
+def read_header(image_path, keys=None):
+    """
+    Reads the ENVI header of image_path (or the .hdr itself) into a dict of
+    typed values keyed by lower-case field name. When keys are given,
+    reading stops as soon as they have all been seen, and only those are
+    returned. Results are cached per file until its modification time
+    changes.
+    """
+    path = header_path(image_path)
+    mtime = os.path.getmtime(path)
+    wanted = set(k.lower() for k in keys) if keys is not None else None
+
+    cached = _cache.get(path)
+    if cached is not None and cached[0] == mtime:
+        props, complete = cached[1], cached[2]
+        if complete or (wanted is not None and wanted.issubset(props)):
+            return _select(props, wanted)
+    else:
+        props, complete = {}, False
+
+    remaining = set(wanted) - set(props) if wanted is not None else None
+    with open(path, "r") as f:
+        for key, raw in iter_header_fields(f):
+            if key not in props:
+                props[key] = parse_field(key, raw)
+            if remaining is not None:
+                remaining.discard(key)
+                if len(remaining) == 0:
+                    break
+        else:
+            complete = True
+
+    _cache[path] = (mtime, props, complete)
+    return _select(props, wanted)
+
+
+def _select(props, wanted):
+    if wanted is None:
+        return dict(props)
+    return dict((k, props[k]) for k in wanted if k in props)
@@ -0,0 +1,267 @@
+import io
+import os
+import json
+import gzip
+import shutil
+import decimal
+import datetime
+
+try:
+    from urllib.parse import quote
+except ImportError:
+    from urllib import quote
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+
+DEFAULT_BATCH_SIZE = 10000
+
+# Directory name used for a null partition value, as Hive and pyarrow expect
+NULL_PARTITION = "__HIVE_DEFAULT_PARTITION__"
+
+GEOPARQUET_VERSION = "1.0.0"
+
+_cursor_count = [0]
+
+
+def open_output(output_file, compress=False):
+    """
+    Opens output_file for writing bytes, through gzip when compress is set.
+    """
+    if compress:
+        return gzip.open(output_file, "wb")
+    return io.open(output_file, "wb")
+
+
+def select_sql(table, columns, where=None):
+    """
+    A select of (name, expression) columns from table, each expression
+    aliased as its name.
+    """
+    sql = "select %s from %s" % (", ".join("%s as %s" % (expression, name) for name, expression in columns), table)
+    if where is not None:
+        sql += " where " + where
+    return sql
+
+
+def copy_csv(cur, sql, f, header=True, quote='"'):
+    """
+    Streams the result of sql into the binary file f as CSV with COPY ... TO
+    STDOUT, so rows go from the server to the file without being turned into
+    Python objects. Dates are written in ISO format whatever the server's
+    DateStyle.
+    """
+    cur.execute("set local datestyle to 'ISO'")
+    options = ["format csv", "quote '%s'" % quote.replace("'", "''")]
+    if header:
+        options.append("header true")
+    cur.copy_expert("copy (%s) to stdout with (%s)" % (sql, ", ".join(options)), f)
+
+
+def iter_batches(conn, sql, params=None, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Yields the rows of sql in lists of up to batch_size, read through a named
+    (server-side) cursor so only one batch is held in memory at a time.
+    """
+    _cursor_count[0] += 1
+    cur = conn.cursor(name="msf_export_%d" % _cursor_count[0])
+    cur.itersize = batch_size
+    try:
+        cur.execute(sql, params)
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if len(rows) == 0:
+                break
+            yield rows
+    finally:
+        cur.close()
+
+
+def json_value(value):
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    return value
+
+
+def write_geojson(f, names, batches, geometry_index):
+    """
+    Writes a GeoJSON FeatureCollection to the binary file f one feature at a
+    time. Each row's geometry_index value is a GeoJSON geometry string (as
+    from ST_AsGeoJSON); the other values become the properties, keyed by
+    names. Returns the number of features written.
+    """
+    count = 0
+    f.write(b'{"type": "FeatureCollection", "features": [\n')
+    for rows in batches:
+        for row in rows:
+            properties = {}
+            for i, name in enumerate(names):
+                if i != geometry_index:
+                    properties[name] = json_value(row[i])
+            geometry = row[geometry_index] if row[geometry_index] is not None else "null"
+            feature = '{"type": "Feature", "geometry": %s, "properties": %s}' % (geometry, json.dumps(properties))
+            f.write(((",\n" if count > 0 else "") + feature).encode("utf-8"))
+            count += 1
+    f.write(b"\n]}\n")
+    return count
+
+
+def arrow_type(type_name):
+    """
+    The pyarrow type for the short type names used in export column lists.
+    """
+    types = {
+        "string": pa.string(),
+        "int32": pa.int32(),
+        "int64": pa.int64(),
+        "float64": pa.float64(),
+        "bool": pa.bool_(),
+        "date32": pa.date32(),
+        "time64": pa.time64("us"),
+        "timestamp": pa.timestamp("us"),
+        "binary": pa.binary()
+    }
+    return types[type_name]
+
+
+def arrow_schema(columns):
+    """
+    A pyarrow schema from (name, type_name) pairs.
+    """
+    if pa is None:
+        raise Exception("Parquet output requires pyarrow")
+    return pa.schema([(name, arrow_type(type_name)) for name, type_name in columns])
+
+
+def geoparquet_schema(schema, geometry_column, geometry_types=()):
+    """
+    Adds the GeoParquet "geo" metadata to schema, declaring geometry_column
+    as its primary, WKB-encoded geometry. No CRS is given, which GeoParquet
+    reads as OGC:CRS84 (longitude/latitude on WGS 84, i.e. EPSG:4326 in
+    x/y order, as PostGIS stores it).
+    """
+    geo = {
+        "version": GEOPARQUET_VERSION,
+        "primary_column": geometry_column,
+        "columns": {
+            geometry_column: {
+                "encoding": "WKB",
+                "geometry_types": list(geometry_types)
+            }
+        }
+    }
+    return schema.with_metadata({b"geo": json.dumps(geo).encode("utf-8")})
+
+
+def record_batch(schema, rows):
+    columns = list(zip(*rows))
+    arrays = [pa.array(list(values), type=field.type) for values, field in zip(columns, schema)]
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def write_parquet(output_file, schema, batches, compression="snappy"):
+    """
+    Writes row batches to a Parquet file with the given pyarrow schema, one
+    row group per batch. Returns the number of rows written.
+    """
+    if pq is None:
+        raise Exception("Parquet output requires pyarrow")
+
+    count = 0
+    writer = pq.ParquetWriter(output_file, schema, compression=compression)
+    try:
+        for rows in batches:
+            writer.write_batch(record_batch(schema, rows))
+            count += len(rows)
+    finally:
+        writer.close()
+    return count
+
+
+def partition_path(names, values):
+    """
+    The Hive-style relative directory of a partition, e.g.
+    date=2019-09-22/sector_level_1=1%20Energy. Values are URI-encoded, as
+    pyarrow decodes them.
+    """
+    parts = []
+    for name, value in zip(names, values):
+        value = NULL_PARTITION if value is None else quote(str(value), safe="")
+        parts.append("%s=%s" % (name, value))
+    return os.path.join(*parts) if len(parts) > 0 else ""
+
+
+def write_partitioned_parquet(output_dir, schema, partition_names, batches, compression="snappy"):
+    """
+    Writes row batches to a Hive-partitioned Parquet dataset under
+    output_dir. Each row starts with its partition_names values, followed by
+    the values of the schema's columns. Rows should arrive ordered by their
+    partition values: then only one file is open at a time and each
+    partition gets a single file. A partition that shows up again gets
+    another part file rather than being overwritten.
+
+    The dataset is written to a sibling directory and swapped in for
+    output_dir when complete, so readers never see a half-written export.
+    Returns the number of rows and of files written.
+    """
+    if pq is None:
+        raise Exception("Parquet output requires pyarrow")
+
+    partial_dir = output_dir.rstrip(os.sep) + ".partial"
+    if os.path.exists(partial_dir):
+        shutil.rmtree(partial_dir)
+    os.makedirs(partial_dir)
+
+    key_count = len(partition_names)
+    parts = {}
+    writer = [None, None]
+    count = 0
+
+    def open_writer(key):
+        directory = os.path.join(partial_dir, partition_path(partition_names, key))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        part = parts.get(key, 0)
+        parts[key] = part + 1
+        writer[0] = key
+        writer[1] = pq.ParquetWriter(os.path.join(directory, "part-%d.parquet" % part), schema, compression=compression)
+
+    def flush(key, rows):
+        if writer[1] is None or writer[0] != key:
+            if writer[1] is not None:
+                writer[1].close()
+            open_writer(key)
+        writer[1].write_batch(record_batch(schema, [row[key_count:] for row in rows]))
+
+    try:
+        for rows in batches:
+            run = []
+            run_key = None
+            for row in rows:
+                key = tuple(row[:key_count])
+                if len(run) > 0 and key != run_key:
+                    flush(run_key, run)
+                    run = []
+                run_key = key
+                run.append(row)
+            if len(run) > 0:
+                flush(run_key, run)
+            count += len(rows)
+        if writer[1] is None:
+            # An empty table still gets a file, so the dataset has a schema
+            open_writer(())
+    finally:
+        if writer[1] is not None:
+            writer[1].close()
+
+    if os.path.exists(output_dir):
+        shutil.rmtree(output_dir)
+    os.rename(partial_dir, output_dir)
+    return count, sum(parts.values())
@@ -0,0 +1,65 @@
+
+def iter_layers(datasource):
+    for layer_num in range(0, datasource.GetLayerCount()):
+        yield datasource.GetLayer(layer_num)
+
+
+def iter_features(layer):
+    """
+    Yields every feature of an OGR layer in a single sequential pass.
+
+    GetFeature(fid) is random access and, on drivers without a fast FID
+    lookup (GeoJSON, some GPKG layers), scans from the start of the layer on
+    every call. GetNextFeature just reads forward.
+    """
+    layer.ResetReading()
+    feature = layer.GetNextFeature()
+    while feature is not None:
+        yield feature
+        feature = layer.GetNextFeature()
+
+
+def distinct_field_values(datasource, layer, field_name):
+    """
+    Returns the distinct values of one attribute using OGR SQL, without
+    materializing the features in Python.
+    """
+    sql = 'SELECT DISTINCT "%s" FROM "%s"' % (field_name, layer.GetName())
+    result = datasource.ExecuteSQL(sql)
+    if result is None:
+        return []
+    try:
+        return [feature.GetField(0) for feature in iter_features(result)]
+    finally:
+        datasource.ReleaseResultSet(result)
+
+
+class FieldSchema:
+    """
+    Field name to index map for one layer, built once from its layer
+    definition. Looking fields up by index avoids both the per-call name
+    search in OGR and re-walking the definition for every requested field.
+    """
+
+    def __init__(self, layerDefinition):
+        self.names = [layerDefinition.GetFieldDefn(i).GetName() for i in range(layerDefinition.GetFieldCount())]
+        self.index = dict((name, i) for i, name in enumerate(self.names))
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def get(self, feature, name):
+        i = self.index.get(name)
+        if i is None:
+            return None
+        return feature.GetField(i)
+
+    def values(self, feature, names):
+        """
+        Returns the values of the named fields, in order. Missing fields
+        come back as None.
+        """
+        return [self.get(feature, name) for name in names]
+
+    def items(self, feature):
+        return [(name, feature.GetField(i)) for i, name in enumerate(self.names)]
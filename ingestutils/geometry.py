@@ -0,0 +1,204 @@
+import utm
+import struct
+import numpy as np
+from osgeo import osr
+
+try:
+    import pyproj
+except ImportError:
+    pyproj = None
+
+
+_transformers = {}
+_geographic_wkts = {}
+
+
+def _srs_from_wkt(wkt):
+    srs = osr.SpatialReference()
+    srs.ImportFromWkt(wkt)
+    # GDAL 3 otherwise follows the authority axis order, which puts latitude
+    # first for geographic CRSs. Always work in x/easting/longitude first.
+    if hasattr(osr, "OAMS_TRADITIONAL_GIS_ORDER"):
+        srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return srs
+
+
+def geographic_wkt(wkt):
+    """
+    WKT of the geographic CRS underlying a projected one, as CloneGeogCS.
+    """
+    if wkt not in _geographic_wkts:
+        _geographic_wkts[wkt] = _srs_from_wkt(wkt).CloneGeogCS().ExportToWkt()
+    return _geographic_wkts[wkt]
+
+
+def get_transformer(src_wkt, dst_wkt):
+    """
+    Coordinate transformer between two CRSs, built once per (src_wkt,
+    dst_wkt) pair and reused. Uses pyproj when it is installed, otherwise
+    osr. Either way coordinates are (x, y), i.e. (lon, lat) when geographic.
+    """
+    key = (src_wkt, dst_wkt)
+    if key not in _transformers:
+        if pyproj is not None:
+            _transformers[key] = pyproj.Transformer.from_crs(pyproj.CRS.from_wkt(src_wkt), pyproj.CRS.from_wkt(dst_wkt), always_xy=True)
+        else:
+            _transformers[key] = osr.CoordinateTransformation(_srs_from_wkt(src_wkt), _srs_from_wkt(dst_wkt))
+    return _transformers[key]
+
+
+def transform_points(src_wkt, dst_wkt, points):
+    """
+    Transforms an (N, 2) array of x, y points in a single call. Returns an
+    (N, 2) float array.
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    if len(points) == 0:
+        return points.copy()
+
+    transformer = get_transformer(src_wkt, dst_wkt)
+    if pyproj is not None:
+        x, y = transformer.transform(points[:, 0], points[:, 1])
+        return np.column_stack((x, y))
+
+    transformed = transformer.TransformPoints(points.tolist())
+    return np.array(transformed, dtype=np.float64)[:, :2]
+
+
+def geotransform_corners(gts, cols, rows):
+    """
+    Corner coordinates of many rasters at once from their geotransforms:
+    gts is (N, 6), cols and rows are (N,). Returns (N, 4, 2), corners in the
+    order upper-left, lower-left, lower-right, upper-right (as GetExtent).
+    """
+    gts = np.asarray(gts, dtype=np.float64).reshape(-1, 6)
+    cols = np.asarray(cols, dtype=np.float64).reshape(-1)
+    rows = np.asarray(rows, dtype=np.float64).reshape(-1)
+
+    zeros = np.zeros_like(cols)
+    px = np.stack((zeros, zeros, cols, cols), axis=1)
+    py = np.stack((zeros, rows, rows, zeros), axis=1)
+
+    x = gts[:, 0:1] + px * gts[:, 1:2] + py * gts[:, 2:3]
+    y = gts[:, 3:4] + px * gts[:, 4:5] + py * gts[:, 5:6]
+    return np.stack((x, y), axis=2)
+
+
+def corners_to_footprints(geo_corners):
+    """
+    From (N, 4, 2) lon/lat corners, in geotransform_corners order, returns
+    for each raster its lon/lat bounding box as [ul, ll, lr, ur] (lon, lat)
+    tuples and the rotation of its left edge from north in degrees.
+    """
+    geo_corners = np.asarray(geo_corners, dtype=np.float64).reshape(-1, 4, 2)
+    lons = geo_corners[:, :, 0]
+    lats = geo_corners[:, :, 1]
+
+    d_lon = geo_corners[:, 0, 0] - geo_corners[:, 1, 0]
+    d_lat = geo_corners[:, 0, 1] - geo_corners[:, 1, 1]
+    safe_d_lat = np.where(d_lat == 0, 1.0, d_lat)
+    slope = np.where(d_lat == 0, 0.0, d_lon / safe_d_lat)
+    rotation = np.degrees(np.arctan(slope))
+    rotation = np.where(d_lon < 0.0, -rotation, rotation)
+
+    lx, rx = lons.min(axis=1), lons.max(axis=1)
+    ly, uy = lats.min(axis=1), lats.max(axis=1)
+
+    footprints = []
+    for i in range(len(geo_corners)):
+        ul = (float(lx[i]), float(uy[i]))
+        ll = (float(lx[i]), float(ly[i]))
+        lr = (float(rx[i]), float(ly[i]))
+        ur = (float(rx[i]), float(uy[i]))
+        shape_extents = [ul, ll, lr, ur]
+        footprints.append((shape_extents, float(rotation[i])))
+    return footprints
+
+
+def raster_footprints(rasters):
+    """
+    Lon/lat footprints of many rasters, each given as (geotransform, cols,
+    rows, projection_wkt). Corners are reprojected in one call per distinct
+    projection. Returns a list of (shape_extents, rotation_degrees) in input
+    order; see corners_to_footprints.
+    """
+    if len(rasters) == 0:
+        return []
+
+    corners = geotransform_corners([r[0] for r in rasters], [r[1] for r in rasters], [r[2] for r in rasters])
+    geo_corners = np.empty_like(corners)
+
+    by_wkt = {}
+    for i, r in enumerate(rasters):
+        by_wkt.setdefault(r[3], []).append(i)
+
+    for wkt, indices in by_wkt.items():
+        indices = np.array(indices)
+        points = corners[indices].reshape(-1, 2)
+        geo_corners[indices] = transform_points(wkt, geographic_wkt(wkt), points).reshape(-1, 4, 2)
+
+    return corners_to_footprints(geo_corners)
+
+
+def dataset_footprint(ds):
+    return raster_footprints([(ds.GetGeoTransform(), ds.RasterXSize, ds.RasterYSize, ds.GetProjection())])[0]
+
+
+def rotated_grid_corners(easting, northing, samples, lines, easting_scale, northing_scale, rotation):
+    """
+    Map corners of many north-up grids rotated about their upper-left pixel,
+    as described by ENVI "map info". All arguments are (N,) arrays, rotation
+    in degrees counter-clockwise. Returns (N, 4, 2) easting/northing corners
+    in the order upper-left, upper-right, lower-left, lower-right.
+    """
+    easting = np.asarray(easting, dtype=np.float64).reshape(-1)
+    northing = np.asarray(northing, dtype=np.float64).reshape(-1)
+    width = np.asarray(samples, dtype=np.float64).reshape(-1) * np.asarray(easting_scale, dtype=np.float64).reshape(-1)
+    height = np.asarray(lines, dtype=np.float64).reshape(-1) * np.asarray(northing_scale, dtype=np.float64).reshape(-1)
+
+    zeros = np.zeros_like(width)
+    dx = np.stack((zeros, width, zeros, width), axis=1)
+    dy = np.stack((zeros, zeros, -height, -height), axis=1)
+
+    theta = np.radians(np.asarray(rotation, dtype=np.float64).reshape(-1, 1))
+    cos, sin = np.cos(theta), np.sin(theta)
+    x = easting[:, np.newaxis] + dx * cos - dy * sin
+    y = northing[:, np.newaxis] + dx * sin + dy * cos
+    return np.stack((x, y), axis=2)
+
+
+def utm_to_lonlat(points, zones, northern):
+    """
+    Converts (N, K, 2) UTM easting/northing points to lon/lat, where row i
+    is in UTM zone zones[i] of the northern (or, when False, southern)
+    hemisphere. One conversion per distinct zone and hemisphere.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    zones = np.asarray(zones).reshape(-1)
+    northern = np.asarray(northern, dtype=bool).reshape(-1)
+
+    lonlat = np.empty_like(points)
+    for zone, north in set(zip(zones.tolist(), northern.tolist())):
+        rows = (zones == zone) & (northern == north)
+        group = points[rows]
+        lat, lon = utm.to_latlon(group[..., 0], group[..., 1], zone, northern=north)
+        lonlat[rows] = np.stack((lon, lat), axis=-1)
+    return lonlat
+
+
+def polygon_wkt(ring):
+    """
+    WKT POLYGON from a sequence of (x, y) vertices; the ring is closed here.
+    """
+    ring = list(ring) + [ring[0]]
+    return "POLYGON((" + ",".join(" ".join(map(repr, (float(x), float(y)))) for x, y in ring) + "))"
+
+
+def polygon_wkb(ring):
+    """
+    Little-endian WKB POLYGON from a sequence of (x, y) vertices; the ring
+    is closed here. Lets the database skip parsing WKT text.
+    """
+    ring = np.asarray(ring, dtype="<f8").reshape(-1, 2)
+    ring = np.concatenate((ring, ring[:1]))
+    return struct.pack("<BIII", 1, 3, 1, len(ring)) + ring.tobytes()
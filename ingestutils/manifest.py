@@ -0,0 +1,95 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+
+
+STAGE_UPLOADED = "uploaded"
+STAGE_DB_COMMITTED = "db-committed"
+
+STAGES = [STAGE_UPLOADED, STAGE_DB_COMMITTED]
+
+
+def content_hash(paths, block_size=1024 * 1024):
+    """
+    SHA-1 over the contents of one or more files, in the order given. Missing
+    files contribute nothing, so a sidecar appearing later changes the hash.
+    """
+    h = hashlib.sha1()
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        with open(path, "rb") as f:
+            block = f.read(block_size)
+            while block:
+                h.update(block)
+                block = f.read(block_size)
+    return h.hexdigest()
+
+
+def stage_reached(stage, required_stage):
+    if stage is None:
+        return False
+    return STAGES.index(stage) >= STAGES.index(required_stage)
+
+
+class JobManifest:
+    """
+    Persistent record, in a local SQLite file, of how far each input of an
+    ingest job got: its content hash, the last stage completed and whatever
+    outputs are needed to resume from there. Inputs whose hash has changed
+    since they were recorded are treated as new.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("""
+            create table if not exists job_manifest (
+                job text not null,
+                input text not null,
+                content_hash text not null,
+                stage text not null,
+                outputs text,
+                updated_at real not null,
+                primary key (job, input)
+            )
+        """)
+        self.conn.commit()
+
+    def get(self, job, input_path, content_hash):
+        """
+        Returns (stage, outputs) for the input, or (None, None) if it hasn't
+        been recorded or its content has changed.
+        """
+        row = self.conn.execute("select content_hash, stage, outputs from job_manifest where job = ? and input = ?",
+                                (job, input_path)).fetchone()
+        if row is None or row[0] != content_hash:
+            return None, None
+        outputs = json.loads(row[2]) if row[2] is not None else None
+        return row[1], outputs
+
+    def mark(self, job, input_path, content_hash, stage, outputs=None):
+        """
+        Records that the input reached stage. Outputs left as None keep
+        whatever was recorded by an earlier stage for the same content.
+        """
+        previous_stage, previous_outputs = self.get(job, input_path, content_hash)
+        if outputs is None:
+            outputs = previous_outputs
+        self.conn.execute("insert or replace into job_manifest (job, input, content_hash, stage, outputs, updated_at) values (?, ?, ?, ?, ?, ?)",
+                          (job, input_path, content_hash, stage, json.dumps(outputs) if outputs is not None else None, time.time()))
+        self.conn.commit()
+
+    def outputs_at_stage(self, job, stage):
+        """
+        Returns {input: outputs} for every input of the job recorded at or
+        past stage, whatever its current content.
+        """
+        rows = self.conn.execute("select input, stage, outputs from job_manifest where job = ?", (job,)).fetchall()
+        return dict((row[0], json.loads(row[2]) if row[2] is not None else None)
+                    for row in rows if stage_reached(row[1], stage))
+
+    def close(self):
+        self.conn.close()
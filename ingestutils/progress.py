@@ -1,4 +1,6 @@
 import sys
+import time
+from contextlib import contextmanager
 
 """
 I stole this from someone on stackexchange.
@@ -22,3 +24,47 @@ def printProgress (iteration, total, prefix = '', suffix = '', decimals = 1, bar
     if iteration == total:
         sys.stdout.write('\n')
     sys.stdout.flush()
+
+
+class StageTimer:
+    """
+    Accumulates wall time and item counts per named stage across a batch run
+    and prints a throughput summary at the end.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.order = []
+        self.started = time.time()
+
+    def add(self, stage, elapsed, count=1):
+        if stage not in self.stages:
+            self.stages[stage] = [0.0, 0]
+            self.order.append(stage)
+        self.stages[stage][0] += elapsed
+        self.stages[stage][1] += count
+
+    def summary(self):
+        return [(stage, self.stages[stage][0], self.stages[stage][1]) for stage in self.order]
+
+    def merge(self, summary):
+        for stage, elapsed, count in summary:
+            self.add(stage, elapsed, count)
+
+    @contextmanager
+    def stage(self, stage, count=1):
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            self.add(stage, time.time() - t0, count)
+
+    def report(self, title="Stage throughput", out=sys.stdout):
+        wall = time.time() - self.started
+        out.write("%s (wall time %.1fs)\n" % (title, wall))
+        for stage in self.order:
+            elapsed, count = self.stages[stage]
+            rate = count / elapsed if elapsed > 0 else 0.0
+            per_item = elapsed / count if count > 0 else 0.0
+            out.write("    %-20s %6d items  %9.2fs  %8.2f items/s  %7.3fs/item\n" % (stage, count, elapsed, rate, per_item))
+        out.flush()
@@ -0,0 +1,303 @@
+import uuid
+import numpy as np
+from osgeo import gdal
+from PIL import Image
+from io import BytesIO
+
+
+# Cloud-Optimized GeoTIFF: 512 px tiles, lossless compression and internal
+# overviews, so clients can fetch just the tiles and zoom level they show
+# with HTTP range requests.
+COG_CREATION_OPTIONS = [
+    "COMPRESS=DEFLATE",
+    "PREDICTOR=YES",
+    "BLOCKSIZE=512",
+    "OVERVIEWS=AUTO"
+]
+
+# Threads GDAL compresses each COG with. A process that runs alongside
+# others doing the same (the plume loader's -w workers) sets its share of
+# the cores, so the pool doesn't start workers x cores threads.
+COG_NUM_THREADS = "ALL_CPUS"
+
+
+def cog_creation_options():
+    return COG_CREATION_OPTIONS + ["NUM_THREADS=%s" % COG_NUM_THREADS]
+
+
+def vsimem_path(filename):
+    """
+    Returns a /vsimem/ path for filename that is unique to this call, so
+    concurrent runs and pool workers never share an in-memory file.
+    """
+    return "/vsimem/%s/%s" % (uuid.uuid4().hex, filename)
+
+
+def warp_to_memory(src_path, filename, dst_srs="EPSG:3857", cog=False, **warp_options):
+    """
+    Warps src_path into an in-memory GeoTIFF named filename, or with cog a
+    Cloud-Optimized GeoTIFF written in the same pass (GDAL >= 3.1). Returns
+    the open dataset and its /vsimem/ path; release the path with
+    free_memory_file once the bytes are no longer needed.
+    """
+    path = vsimem_path(filename)
+    if cog:
+        warp_options.setdefault("format", "COG")
+        warp_options.setdefault("creationOptions", cog_creation_options())
+    ds = gdal.Warp(path, src_path, dstSRS=dst_srs, **warp_options)
+    if ds is None:
+        raise Exception("Failed to warp %s" % src_path)
+    if cog:
+        # The COG driver assembles the file on close; reopen the result
+        ds = None
+        ds = gdal.Open(path)
+    return ds, path
+
+
+def read_memory_file(path):
+    """
+    Returns the contents of a /vsimem/ file as bytes. Datasets writing to it
+    must have been flushed or closed first.
+    """
+    size = gdal.VSIStatL(path).size
+    f = gdal.VSIFOpenL(path, "rb")
+    try:
+        return bytes(gdal.VSIFReadL(1, size, f))
+    finally:
+        gdal.VSIFCloseL(f)
+
+
+def free_memory_file(path):
+    gdal.Unlink(path)
+
+
+def dataset_to_array(ds):
+    """
+    Reads every band of the dataset into a (rows, cols, bands) array, the
+    layout PIL and the compositing code work in.
+    """
+    data = ds.ReadAsArray()
+    if data.ndim == 2:
+        return data[:, :, np.newaxis]
+    return np.transpose(data, (1, 2, 0))
+
+
+def array_to_image(array):
+    # PIL picks L/LA/RGB/RGBA from the band count
+    if array.ndim == 3 and array.shape[2] == 1:
+        array = array[:, :, 0]
+    return Image.fromarray(np.ascontiguousarray(array))
+
+
+def encode_image(image, format="PNG", **save_options):
+    buf = BytesIO()
+    image.save(buf, format=format, **save_options)
+    return buf.getvalue()
+
+
+def build_colormap(anchors):
+    """
+    Builds a 256-entry RGB lookup table by linear interpolation between
+    evenly spaced anchor colours.
+    """
+    anchors = np.asarray(anchors, dtype=np.float32)
+    positions = np.linspace(0, 255, len(anchors))
+    levels = np.arange(256)
+    lut = np.empty((256, 3), dtype=np.uint8)
+    for c in range(3):
+        lut[:, c] = np.round(np.interp(levels, positions, anchors[:, c]))
+    return lut
+
+
+# Pale yellow through orange to dark red for increasing CH4 enhancement
+CH4_COLORMAP = build_colormap([
+    (255, 255, 178),
+    (254, 204, 92),
+    (253, 141, 60),
+    (240, 59, 32),
+    (189, 0, 38)
+])
+
+
+def nonzero_bounds(mask):
+    """
+    Bounding box (row0, row1, col0, col1) of the true cells of a 2-D mask,
+    or None if there are none.
+    """
+    rows = np.flatnonzero(mask.any(axis=1))
+    if len(rows) == 0:
+        return None
+    cols = np.flatnonzero(mask.any(axis=0))
+    return rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+
+
+def colorize(band, colormap=CH4_COLORMAP, vmin=None, vmax=None, nodata=None):
+    """
+    Maps a single enhancement band onto an RGBA array. Values at or below
+    vmin, NaNs and nodata are transparent. vmin and vmax default to 0 and the
+    99th percentile of the remaining values.
+    """
+    band = np.asarray(band, dtype=np.float32)
+    if vmin is None:
+        vmin = 0.0
+
+    with np.errstate(invalid="ignore"):
+        valid = band > vmin
+    if nodata is not None:
+        valid &= band != nodata
+
+    # Enhancement is zero over most of a crop, so only the box around the
+    # plume is coloured; the rest stays transparent.
+    rgba = np.zeros(band.shape + (4,), dtype=np.uint8)
+    bounds = nonzero_bounds(valid)
+    if bounds is None:
+        return rgba
+    row0, row1, col0, col1 = bounds
+    band = band[row0:row1, col0:col1]
+    valid = valid[row0:row1, col0:col1]
+
+    if vmax is None:
+        vmax = float(np.percentile(band[valid], 99))
+    if vmax <= vmin:
+        vmax = vmin + 1.0
+
+    levels = np.where(valid, band - vmin, 0) * (255.0 / (vmax - vmin))
+    levels = np.clip(levels, 0, 255).astype(np.uint8)
+
+    # One flat lookup per band is much cheaper than indexing the (256, 3)
+    # table into the interleaved bands at once
+    box = rgba[row0:row1, col0:col1]
+    for c in range(3):
+        box[:, :, c] = colormap[:, c].take(levels)
+    box[:, :, 3] = valid * np.uint8(255)
+    return rgba
+
+
+def to_rgba(array, colormap=None, nodata=None, transparent_background=False):
+    """
+    Brings a (rows, cols, bands) raster to RGBA: a single band is colorized
+    if a colormap is given and otherwise drawn as opaque grey, as PIL's
+    convert("RGBA") does; grey+alpha and RGB are expanded and RGBA is
+    returned unchanged. With transparent_background, a grey band is only
+    opaque where it holds a positive enhancement, as colorize does, so
+    NaN, nodata and zero pixels are left out.
+    """
+    bands = array.shape[2]
+    if bands == 1 and colormap is not None:
+        return colorize(array[:, :, 0], colormap, nodata=nodata)
+    if bands == 4:
+        return array
+    rgba = np.empty(array.shape[:2] + (4,), dtype=np.uint8)
+    if bands == 1:
+        rgba[:, :, :3] = np.clip(array[:, :, :1], 0, 255)
+        if transparent_background:
+            with np.errstate(invalid="ignore"):
+                visible = array[:, :, 0] > 0
+            if nodata is not None:
+                visible &= array[:, :, 0] != nodata
+            rgba[:, :, 3] = visible * np.uint8(255)
+        else:
+            rgba[:, :, 3] = 255
+    elif bands == 2:
+        rgba[:, :, :3] = array[:, :, :1]
+        rgba[:, :, 3] = array[:, :, 1]
+    else:
+        rgba[:, :, :3] = array[:, :, :3]
+        rgba[:, :, 3] = 255
+    return rgba
+
+
+def grid_window(base_gt, base_shape, top_gt, top_shape):
+    """
+    Places the top raster on the base grid using the two geotransforms. Both
+    are expected to be north-up, as gdal.Warp produces. Returns the base
+    window the top raster covers as (row0, row1, col0, col1) and, for each
+    row and column of that window, the nearest row and column of the top
+    raster. Returns None if they don't overlap.
+    """
+    row_centers = base_gt[3] + (np.arange(base_shape[0]) + 0.5) * base_gt[5]
+    col_centers = base_gt[0] + (np.arange(base_shape[1]) + 0.5) * base_gt[1]
+
+    rows = np.floor((row_centers - top_gt[3]) / top_gt[5]).astype(np.int64)
+    cols = np.floor((col_centers - top_gt[0]) / top_gt[1]).astype(np.int64)
+
+    row_hits = np.nonzero((rows >= 0) & (rows < top_shape[0]))[0]
+    col_hits = np.nonzero((cols >= 0) & (cols < top_shape[1]))[0]
+    if len(row_hits) == 0 or len(col_hits) == 0:
+        return None
+
+    row0, row1 = row_hits[0], row_hits[-1] + 1
+    col0, col1 = col_hits[0], col_hits[-1] + 1
+    return (row0, row1, col0, col1), rows[row0:row1], cols[col0:col1]
+
+
+def take_grid(top, rows, cols):
+    # Same pixel size at a whole-pixel offset is a plain slice, which avoids
+    # the copy fancy indexing makes
+    if np.all(np.diff(rows) == 1) and np.all(np.diff(cols) == 1):
+        return top[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+    return top[rows[:, np.newaxis], cols[np.newaxis, :]]
+
+
+def composite_over(base, base_gt, top, top_gt, colormap=None, nodata=None, opacity=1.0):
+    """
+    Alpha-blends top over base on base's grid and returns an array the size
+    and band layout of base (grey is expanded to RGB). The top raster is
+    placed by geotransform, resampled to the base pixel size by nearest
+    neighbour, and brought to RGBA by to_rgba first, so a single enhancement
+    band is only colorized when a colormap is given. Only the box around its
+    non-transparent pixels is blended.
+    """
+    if base.shape[2] < 3:
+        out = np.concatenate([base[:, :, :1]] * 3 + [base[:, :, 1:]], axis=2)
+    else:
+        out = base.copy()
+
+    # Grey or RGB without a colormap has no alpha, so at full opacity it
+    # covers base outright and is copied rather than blended
+    opaque = opacity >= 1.0 and (top.shape[2] == 3 or (top.shape[2] == 1 and colormap is None))
+    if not opaque:
+        top = to_rgba(top, colormap, nodata=nodata)
+
+    placement = grid_window(base_gt, out.shape, top_gt, top.shape)
+    if placement is None:
+        return out
+    (row0, row1, col0, col1), rows, cols = placement
+
+    aligned = take_grid(top, rows, cols)
+    if opaque:
+        region = out[row0:row1, col0:col1]
+        if aligned.dtype != np.uint8:
+            aligned = np.clip(aligned, 0, 255).astype(np.uint8)
+        # Band by band: broadcasting grey into the interleaved bands in one
+        # assignment is several times slower
+        for c in range(3):
+            region[:, :, c] = aligned[:, :, c % aligned.shape[2]]
+        if region.shape[2] == 4:
+            region[:, :, 3] = 255
+        return out
+
+    alpha = aligned[:, :, 3]
+    bounds = nonzero_bounds(alpha)
+    if bounds is None:
+        return out
+    r0, r1, c0, c1 = bounds
+
+    aligned = aligned[r0:r1, c0:c1]
+    region = out[row0 + r0:row0 + r1, col0 + c0:col0 + c1]
+
+    # Integer "over" with 8-bit alpha: out = top * a + base * (1 - a), a
+    # band at a time in place to keep the uint16 temporaries small
+    a = aligned[:, :, 3].astype(np.uint16)
+    if opacity < 1.0:
+        a = (a * opacity).astype(np.uint16)
+    inv = 255 - a
+    for c in range(3):
+        blended = aligned[:, :, c] * a
+        blended += region[:, :, c] * inv
+        blended += 127
+        blended //= 255
+        region[:, :, c] = blended
+    if region.shape[2] == 4:
+        region[:, :, 3] = a + (region[:, :, 3] * inv + 127) // 255
+    return out
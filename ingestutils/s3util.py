@@ -8,40 +8,134 @@ import requests
 import json
 from lxml import etree
 import boto3
-from boto.s3.key import Key
-from osgeo import gdal,ogr,osr
 import glob
 import argparse
 from PIL import Image
 import tempfile
+import threading
+import base64
+import hashlib
 from io import BytesIO
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor, Future
 
 
 S3_BUCKET = "bucket"
+S3_KEY_PREFIX = "AVIRIS"
+S3_PUBLIC_URL = "https://s3-us-gov-west-1.amazonaws.com/%s/%s"
+S3_ACL = "public-read"
 
+# Point this at a local S3 stand-in (moto server, MinIO) for testing.
+S3_ENDPOINT_URL = os.environ.get("S3_ENDPOINT_URL")
 
-def upload_data_to_s3(filename, data, s3_bucket=S3_BUCKET, test_only=False):
-    key = "AVIRIS/%s" % os.path.basename(filename)
+# Skip puts whose bytes already match what is stored under the key. Read at
+# upload time, so a script can switch it off before starting work.
+S3_SKIP_UNCHANGED = True
 
-    if not test_only:
-        s3 = boto3.resource('s3')
+# Thumbnail sizes (longest side, in pixels) built for each portal image.
+# The smallest is also stored under the original "_thumbnail.jpg" name.
+THUMBNAIL_SIZES = [100, 256, 1024]
+DEFAULT_THUMBNAIL_SIZE = 100
 
-        print "Uploading as", key
-        s3.Bucket(s3_bucket).put_object(Key=key, Body=data)
-        s3.Object(s3_bucket, key).Acl().put(ACL='public-read')
+_s3_client = None
+
+# MD5 of the last bytes this process stored or found under each
+# (bucket, key), so repeat uploads within a run don't need a HEAD request.
+_known_hashes = {}
+
+
+def get_s3_client():
+    # boto3 clients are expensive to build (credential lookup, endpoint
+    # resolution) but thread-safe, so keep one per process and share it
+    # between the upload threads.
+    global _s3_client
+    if _s3_client is None:
+        _s3_client = boto3.client('s3', endpoint_url=S3_ENDPOINT_URL)
+    return _s3_client
+
+
+def get_s3_key(filename):
+    return "%s/%s" % (S3_KEY_PREFIX, os.path.basename(filename))
+
+
+def get_s3_url(s3_bucket, key):
+    return S3_PUBLIC_URL % (s3_bucket, key)
+
+
+def get_remote_md5(client, s3_bucket, key):
+    """
+    Returns the MD5 hex digest of the stored object, taken from its ETag, or
+    None if there is no such object. ETags of multipart uploads are not plain
+    MD5s; they never match a digest and so are always treated as changed.
+    """
+    try:
+        response = client.head_object(Bucket=s3_bucket, Key=key)
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+            return None
+        raise
+    return response["ETag"].strip('"')
+
+
+def is_unchanged_in_s3(client, s3_bucket, key, md5):
+    known = _known_hashes.get((s3_bucket, key))
+    if known is None:
+        known = get_remote_md5(client, s3_bucket, key)
+        if known is None:
+            return False
+        _known_hashes[(s3_bucket, key)] = known
+    return known == md5
+
+
+def put_data_to_s3(client, filename, data, s3_bucket=S3_BUCKET, test_only=False, acl=S3_ACL, skip_unchanged=None, key=None):
+    if key is None:
+        key = get_s3_key(filename)
+
+    if test_only:
+        print("Test upload as %s" % key)
+        return get_s3_url(s3_bucket, key)
+
+    if hasattr(data, "read"):
+        data = data.read()
+    if skip_unchanged is None:
+        skip_unchanged = S3_SKIP_UNCHANGED
+
+    digest = hashlib.md5(data)
+    md5 = digest.hexdigest()
+
+    if skip_unchanged and is_unchanged_in_s3(client, s3_bucket, key, md5):
+        print("Unchanged, skipping upload of %s" % key)
     else:
-        print "Test upload as", key
+        print("Uploading as %s" % key)
+        # Setting the ACL on the put saves the separate Acl().put round-trip.
+        # ContentMD5 has S3 reject the put if the bytes arrive corrupted.
+        client.put_object(Bucket=s3_bucket, Key=key, Body=data, ACL=acl,
+                          ContentMD5=base64.b64encode(digest.digest()).decode("ascii"))
+        _known_hashes[(s3_bucket, key)] = md5
+
+    return get_s3_url(s3_bucket, key)
 
-    return "https://s3-us-gov-west-1.amazonaws.com/%s/%s"%(s3_bucket, key)
 
+def upload_data_to_s3(filename, data, s3_bucket=S3_BUCKET, test_only=False, skip_unchanged=None):
+    client = None if test_only else get_s3_client()
+    return put_data_to_s3(client, filename, data, s3_bucket=s3_bucket, test_only=test_only, skip_unchanged=skip_unchanged)
 
-def upload_file_to_s3(file, s3_bucket=S3_BUCKET, test_only=False):
-    data = open(file, 'rb')
-    return upload_data_to_s3(file, data, s3_bucket=s3_bucket, test_only=test_only)
+
+def upload_file_to_s3(file, s3_bucket=S3_BUCKET, test_only=False, skip_unchanged=None):
+    with open(file, 'rb') as f:
+        data = f.read()
+    return upload_data_to_s3(file, data, s3_bucket=s3_bucket, test_only=test_only, skip_unchanged=skip_unchanged)
 
 
 def create_thumbnail(file, thumbnail_size=(100, 100)):
     im = Image.open(file)
+    return encode_thumbnail(im, thumbnail_size)
+
+
+def encode_thumbnail(im, thumbnail_size=(100, 100)):
+    # thumbnail() resizes in place, so work on a copy of an image the caller
+    # may still be using
+    im = im.copy()
     im.thumbnail(thumbnail_size)
     img_bytes = BytesIO()
     im = im.convert("RGB")
@@ -65,6 +159,205 @@ def upload_image_to_s3(file, s3_bucket=S3_BUCKET, test_only=False, thumbnail_siz
     return image_url, thumbnail_url
 
 
+def get_thumbnail_name(file, size=None):
+    if size is None or size == DEFAULT_THUMBNAIL_SIZE:
+        return os.path.basename(file).replace(".png", "_thumbnail.jpg")
+    return os.path.basename(file).replace(".png", "_thumbnail_%d.jpg" % size)
+
+
+def thumbnail_dimensions(width, height, size):
+    # Same rule as Image.thumbnail: fit within size x size, never enlarge
+    scale = min(float(size) / width, float(size) / height, 1.0)
+    return max(1, int(round(width * scale))), max(1, int(round(height * scale)))
+
+
+def build_thumbnail_pyramid(im, sizes=THUMBNAIL_SIZES):
+    """
+    Returns {size: image} for every size, from a single decoded image. Sizes
+    are made largest first, each from the one before, so only the first step
+    touches the full-resolution pixels; where Pillow has it, reduce() does
+    the bulk of each step with a cheap box filter before the final resample.
+    """
+    # Lets a JPEG that hasn't been loaded yet decode at a reduced scale;
+    # no effect on anything else
+    im.draft("RGB", (max(sizes), max(sizes)))
+    im = im.convert("RGB")
+
+    pyramid = {}
+    current = im
+    for size in sorted(sizes, reverse=True):
+        target = thumbnail_dimensions(current.width, current.height, size)
+        if target != current.size:
+            factor = min(current.width // target[0], current.height // target[1])
+            if factor >= 2 and hasattr(current, "reduce"):
+                current = current.reduce(factor)
+            if target != current.size:
+                current = current.resize(target, Image.LANCZOS)
+        pyramid[size] = current
+    return pyramid
+
+
+def encode_jpeg(im):
+    img_bytes = BytesIO()
+    im.save(img_bytes, "JPEG")
+    return img_bytes.getvalue()
+
+
+class S3Uploader:
+    """
+    Uploads objects on a bounded thread pool using one shared S3 client.
+
+    The upload_* methods return futures that resolve to the object's public
+    URL, so callers can carry on with raster work while the puts are in
+    flight. Data is read into memory at submit time, so the source files can
+    be removed as soon as the call returns. Unless skip_unchanged is off,
+    objects whose bytes are already stored under the same key are not
+    uploaded again; the URL is returned all the same.
+    """
+
+    def __init__(self, s3_bucket=S3_BUCKET, max_workers=8, test_only=False, acl=S3_ACL, client=None, skip_unchanged=None):
+        self.s3_bucket = s3_bucket
+        self.test_only = test_only
+        self.acl = acl
+        self.skip_unchanged = skip_unchanged
+        if client is None and not test_only:
+            client = get_s3_client()
+        self.client = client
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def _put(self, filename, data, key=None):
+        return put_data_to_s3(self.client, filename, data, s3_bucket=self.s3_bucket, test_only=self.test_only, acl=self.acl,
+                              skip_unchanged=self.skip_unchanged, key=key)
+
+    def _put_encoded(self, key, encoder, value):
+        return self._put(key, encoder(value), key=key)
+
+    def _put_thumbnail(self, filename, data, thumbnail_size, image=None):
+        if image is not None:
+            thumbnail_data = encode_thumbnail(image, thumbnail_size)
+        else:
+            thumbnail_data = create_thumbnail(BytesIO(data), thumbnail_size)
+        return self._put(get_thumbnail_name(filename), thumbnail_data)
+
+    def upload_data(self, filename, data):
+        return self.executor.submit(self._put, filename, data)
+
+    def upload_encoded(self, key, encoder, value):
+        """
+        Encodes value with encoder on a pool thread and uploads the result
+        under key as given, rather than under S3_KEY_PREFIX.
+        """
+        return self.executor.submit(self._put_encoded, key, encoder, value)
+
+    def upload_file(self, file):
+        with open(file, 'rb') as f:
+            data = f.read()
+        return self.upload_data(file, data)
+
+    def upload_image(self, file, thumbnail_size=(100, 100), upload_thumbnail=True):
+        with open(file, 'rb') as f:
+            data = f.read()
+        return self.upload_image_data(file, data, thumbnail_size=thumbnail_size, upload_thumbnail=upload_thumbnail)
+
+    def upload_image_data(self, filename, data, thumbnail_size=(100, 100), upload_thumbnail=True, image=None):
+        """
+        Uploads encoded image bytes under filename's basename. Pass the
+        decoded PIL image as well, if the caller has it, to save the
+        thumbnail thread from decoding the bytes again.
+        """
+        image_future = self.upload_data(filename, data)
+        if upload_thumbnail:
+            thumbnail_future = self.executor.submit(self._put_thumbnail, filename, data, thumbnail_size, image)
+        else:
+            thumbnail_future = None
+
+        return image_future, thumbnail_future
+
+    def _put_encoded_thumbnail(self, filename, size, im):
+        return self._put(get_thumbnail_name(filename, size), encode_jpeg(im))
+
+    def upload_thumbnails(self, filename, data=None, image=None, sizes=THUMBNAIL_SIZES):
+        """
+        Builds every thumbnail size from one decode of the image (pass the
+        decoded image if the caller has it, otherwise the encoded bytes) and
+        uploads each on the thread pool, where it is JPEG-encoded. Returns a
+        dict of str(size) -> URL future.
+        """
+        if image is None:
+            image = Image.open(BytesIO(data))
+        pyramid = build_thumbnail_pyramid(image, sizes)
+
+        futures = {}
+        for size in sizes:
+            futures[str(size)] = self.executor.submit(self._put_encoded_thumbnail, filename, size, pyramid[size])
+        return futures
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.shutdown(wait=True)
+
+
+def gather_futures(futures, result):
+    """
+    Returns a future that resolves to result once all of futures have
+    completed, or fails with the first of their errors. Nothing blocks
+    while waiting.
+    """
+    gathered = Future()
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def done(future):
+        # Callbacks run on whichever upload thread finished the future
+        with lock:
+            if gathered.done():
+                return
+            if future.exception() is not None:
+                gathered.set_exception(future.exception())
+                return
+            remaining[0] -= 1
+            if remaining[0] == 0:
+                gathered.set_result(result)
+
+    if len(futures) == 0:
+        gathered.set_result(result)
+    for future in futures:
+        future.add_done_callback(done)
+    return gathered
+
+
+def has_futures(values):
+    for key in values:
+        value = values[key]
+        if isinstance(value, Future):
+            return True
+        if isinstance(value, dict) and has_futures(value):
+            return True
+    return False
+
+
+def resolve_futures(values):
+    """
+    Returns a copy of the dict, and of any dicts nested in it, with upload
+    futures replaced by their results. Blocks until they complete and
+    re-raises upload failures.
+    """
+    resolved = {}
+    for key in values:
+        value = values[key]
+        if isinstance(value, Future):
+            value = value.result()
+        elif isinstance(value, dict):
+            value = resolve_futures(value)
+        resolved[key] = value
+    return resolved
+
+
 
 if __name__ == "__main__":
     pass
\ No newline at end of file
@@ -0,0 +1,167 @@
+import math
+import numpy as np
+from ingestutils import raster
+from ingestutils import s3util
+
+
+TILE_SIZE = 256
+MAX_ZOOM = 22
+
+# Half the width of the EPSG:3857 world, in metres
+WEB_MERCATOR_HALF = 20037508.342789244
+
+
+def tile_resolution(zoom):
+    return 2 * WEB_MERCATOR_HALF / (TILE_SIZE * 2 ** zoom)
+
+
+def native_zoom(pixel_size):
+    """
+    The lowest zoom whose tiles are at least as fine as pixel_size metres.
+    """
+    zoom = int(math.ceil(math.log(2 * WEB_MERCATOR_HALF / (TILE_SIZE * pixel_size), 2)))
+    return max(0, min(MAX_ZOOM, zoom))
+
+
+def tile_geotransform(zoom, x, y):
+    res = tile_resolution(zoom)
+    span = TILE_SIZE * res
+    return (-WEB_MERCATOR_HALF + x * span, res, 0.0, WEB_MERCATOR_HALF - y * span, 0.0, -res)
+
+
+def tile_range(gt, shape, zoom):
+    """
+    The (x0, x1, y0, y1) range of tiles, inclusive, that a north-up EPSG:3857
+    raster with geotransform gt and (rows, cols, ...) shape touches.
+    """
+    span = TILE_SIZE * tile_resolution(zoom)
+    last = 2 ** zoom - 1
+    minx, maxx = gt[0], gt[0] + shape[1] * gt[1]
+    maxy, miny = gt[3], gt[3] + shape[0] * gt[5]
+
+    def clamp(v):
+        return max(0, min(last, int(math.floor(v))))
+
+    # The small offsets keep an edge that falls exactly on a tile boundary
+    # from pulling in the next tile
+    return (clamp((minx + WEB_MERCATOR_HALF) / span), clamp((maxx + WEB_MERCATOR_HALF) / span - 1e-9),
+            clamp((WEB_MERCATOR_HALF - maxy) / span), clamp((WEB_MERCATOR_HALF - miny) / span - 1e-9))
+
+
+def single_tile_zoom(gt, shape, max_zoom):
+    """
+    The highest zoom, up to max_zoom, at which the raster fits in one tile.
+    """
+    zoom = max_zoom
+    while zoom > 0:
+        x0, x1, y0, y1 = tile_range(gt, shape, zoom)
+        if x0 == x1 and y0 == y1:
+            break
+        zoom -= 1
+    return zoom
+
+
+def render_tile(rgba, gt, zoom, x, y):
+    """
+    Samples the RGBA raster onto one tile by nearest neighbour. Everything
+    the raster doesn't cover is transparent.
+    """
+    tile = np.zeros((TILE_SIZE, TILE_SIZE, 4), dtype=np.uint8)
+    placement = raster.grid_window(tile_geotransform(zoom, x, y), tile.shape, gt, rgba.shape)
+    if placement is not None:
+        (row0, row1, col0, col1), rows, cols = placement
+        tile[row0:row1, col0:col1] = raster.take_grid(rgba, rows, cols)
+    return tile
+
+
+def merge_children(children):
+    """
+    Builds a parent tile from its four children, keyed by (dx, dy), by 2x2
+    averaging with premultiplied alpha so transparent pixels don't darken
+    the edges. Missing children are transparent.
+    """
+    mosaic = np.zeros((TILE_SIZE * 2, TILE_SIZE * 2, 4), dtype=np.uint32)
+    for (dx, dy), child in children.items():
+        mosaic[dy * TILE_SIZE:(dy + 1) * TILE_SIZE, dx * TILE_SIZE:(dx + 1) * TILE_SIZE] = child
+
+    blocks = mosaic.reshape(TILE_SIZE, 2, TILE_SIZE, 2, 4)
+    alpha = blocks[:, :, :, :, 3]
+    alpha_sum = alpha.sum(axis=(1, 3))
+    color = (blocks[:, :, :, :, :3] * alpha[:, :, :, :, np.newaxis]).sum(axis=(1, 3))
+
+    tile = np.empty((TILE_SIZE, TILE_SIZE, 4), dtype=np.uint8)
+    tile[:, :, :3] = color // np.maximum(alpha_sum, 1)[:, :, np.newaxis]
+    tile[:, :, 3] = (alpha_sum + 2) // 4
+    return tile
+
+
+def is_empty(tile):
+    return not tile[:, :, 3].any()
+
+
+def iter_tile_pyramid(rgba, gt, min_zoom, max_zoom):
+    """
+    Yields (zoom, x, y, tile) for every tile from max_zoom down to min_zoom
+    that has at least one visible pixel. The deepest level is sampled from
+    the raster; each level above is merged from the one below it.
+    """
+    level = {}
+    x0, x1, y0, y1 = tile_range(gt, rgba.shape, max_zoom)
+    for y in range(y0, y1 + 1):
+        for x in range(x0, x1 + 1):
+            tile = render_tile(rgba, gt, max_zoom, x, y)
+            if not is_empty(tile):
+                level[(x, y)] = tile
+
+    zoom = max_zoom
+    while True:
+        for (x, y), tile in level.items():
+            yield zoom, x, y, tile
+        if zoom == min_zoom:
+            break
+
+        parents = {}
+        for (x, y), tile in level.items():
+            parents.setdefault((x // 2, y // 2), {})[(x % 2, y % 2)] = tile
+        level = {}
+        for key, children in parents.items():
+            tile = merge_children(children)
+            if not is_empty(tile):
+                level[key] = tile
+        zoom -= 1
+
+
+def encode_tile(tile):
+    return raster.encode_image(raster.array_to_image(tile))
+
+
+def get_tiles_prefix(name):
+    return "%s/tiles/%s" % (s3util.S3_KEY_PREFIX, name)
+
+
+def upload_tile_pyramid(uploader, rgba, gt, name, min_zoom=None, max_zoom=None):
+    """
+    Cuts the RGBA raster (north-up, EPSG:3857) into a z/x/y PNG tile
+    pyramid and uploads it under S3_KEY_PREFIX/tiles/<name>/, encoding and
+    uploading tiles on the uploader's threads. Empty tiles are skipped.
+    max_zoom defaults to the raster's native resolution and min_zoom to the
+    zoom at which it fits in one tile.
+
+    Returns (url_future, min_zoom, max_zoom); the future resolves to the
+    {z}/{x}/{y} URL template once every tile is uploaded, or to None if
+    there were no visible tiles.
+    """
+    if max_zoom is None:
+        max_zoom = native_zoom(abs(gt[1]))
+    if min_zoom is None:
+        min_zoom = single_tile_zoom(gt, rgba.shape, max_zoom)
+    min_zoom = min(min_zoom, max_zoom)
+
+    prefix = get_tiles_prefix(name)
+    futures = []
+    for zoom, x, y, tile in iter_tile_pyramid(rgba, gt, min_zoom, max_zoom):
+        key = "%s/%d/%d/%d.png" % (prefix, zoom, x, y)
+        futures.append(uploader.upload_encoded(key, encode_tile, tile))
+
+    url = s3util.get_s3_url(uploader.s3_bucket, prefix) + "/{z}/{x}/{y}.png" if len(futures) > 0 else None
+    return s3util.gather_futures(futures, url), min_zoom, max_zoom
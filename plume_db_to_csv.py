@@ -1,40 +1,147 @@
+import os
 import argparse
-import psycopg2
-import csv
-import traceback
-
-DB_ENDPOINT = "localhost"
-DB_PORT = 5432
-DB_USER = ""
-DB_PASSWD = ""
-DB_NAME = ""
-
-def get_plumes(cur):
-    sql = """
-    select * from plumes
+from ingestutils import db
+from ingestutils import export
+
+# (name, CSV header, position, expression, Parquet type) for each exported
+# column, in output order. position is the column's index in
+# "select * from plumes", the order the export has always read them in; the
+# name at that position is looked up from the table when exporting, and
+# substituted into expression. Only these columns are selected.
+PLUME_EXPORT_COLUMNS = [
+    ("source_id", "Source identifier", 10, "%s", "string"),
+    ("plume_latitude_deg", "Plume latitude (deg)", 7, "%s", "float64"),
+    ("plume_longitude_deg", "Plume longitude (deg)", 8, "%s", "float64"),
+    ("candidate_id", "Candidate identifier", 15, "%s", "string"),
+    ("date_of_detection", "Date of detection", 47, "%s::date", "date32"),
+    ("time_of_detection", "Time of detection (UTC)", 47, "%s::time", "time64"),
+    ("source_type", "Source type (best estimate)", 16, "%s", "string"),
+    ("ipcc", "Sectors (IPCC)", 18, "%s", "string"),
+    ("flux", "Qplume (kg/hr): Plume emissions", 48, "%s", "float64"),
+    ("flux_uncertainty", "Sigma Qplume (kg/hr): Uncertainty for plume emissions", 49, "%s", "float64")
+]
+
+# CSV and GeoJSON get the values as stored; Parquet needs them cast to the
+# column's type
+PARQUET_CASTS = {
+    "string": "text",
+    "float64": "double precision"
+}
+
+# Positions of the plume longitude and latitude, for the GeoJSON point
+PLUME_GEOMETRY_POSITIONS = (8, 7)
+PLUME_GEOMETRY_EXPRESSION = "ST_AsGeoJSON(ST_SetSRID(ST_MakePoint(%s::double precision, %s::double precision), 4326))"
+
+OUTPUT_FORMATS = ["csv", "geojson", "parquet"]
+
+
+def quote_ident(name):
+    return '"%s"' % name.replace('"', '""')
+
+
+def plume_column_names(cur):
+    """
+    The names of the plumes columns in "select *" order, dropped columns
+    left out.
     """
-    cur.execute(sql)
-    rows = cur.fetchall()
-    return rows
+    cur.execute("""
+        select attname from pg_attribute
+        where attrelid = 'plumes'::regclass and attnum > 0 and not attisdropped
+        order by attnum
+    """)
+    return [row[0] for row in cur.fetchall()]
+
+
+def export_columns(column_names, typed=False):
+    """
+    (name, CSV header, expression, Parquet type) for each exported column,
+    with the plumes column at each position filled in. typed adds the casts
+    Parquet needs.
+    """
+    columns = []
+    for name, header, position, expression, arrow_type in PLUME_EXPORT_COLUMNS:
+        if position >= len(column_names):
+            raise Exception("plumes has %d columns, no column at position %d for '%s'" % (len(column_names), position, header))
+        expression = expression % quote_ident(column_names[position])
+        if typed and arrow_type in PARQUET_CASTS:
+            expression = "%s::%s" % (expression, PARQUET_CASTS[arrow_type])
+        columns.append((name, header, expression, arrow_type))
+    return columns
+
 
-def build_csv(output_file):
-    conn = psycopg2.connect(dbname=DB_NAME, user=DB_USER, password=DB_PASSWD, host=DB_ENDPOINT, port=DB_PORT)
+def geometry_expression(column_names):
+    return PLUME_GEOMETRY_EXPRESSION % tuple(quote_ident(column_names[p]) for p in PLUME_GEOMETRY_POSITIONS)
+
+
+def plume_select_sql(columns):
+    return export.select_sql("plumes", columns)
+
+
+def parquet_schema(columns):
+    return export.arrow_schema([(name, arrow_type) for name, _, _, arrow_type in columns])
+
+
+def build_csv(cur, columns, output_file, compress=False):
+    # Aliased to the CSV headers so COPY writes the header row itself
+    select_columns = [('"%s"' % header, expression) for _, header, expression, _ in columns]
+    with export.open_output(output_file, compress) as f:
+        export.copy_csv(cur, plume_select_sql(select_columns), f, quote="|")
+    return cur.rowcount
+
+
+def build_geojson(conn, columns, geometry, output_file, compress=False, batch_size=export.DEFAULT_BATCH_SIZE):
+    select_columns = [(name, expression) for name, _, expression, _ in columns]
+    select_columns.append(("geometry", geometry))
+    batches = export.iter_batches(conn, plume_select_sql(select_columns), batch_size=batch_size)
+    with export.open_output(output_file, compress) as f:
+        return export.write_geojson(f, [name for name, _ in select_columns], batches, len(select_columns) - 1)
+
+
+def build_parquet(conn, columns, output_file, compress=False, batch_size=export.DEFAULT_BATCH_SIZE):
+    select_columns = [(name, expression) for name, _, expression, _ in columns]
+    batches = export.iter_batches(conn, plume_select_sql(select_columns), batch_size=batch_size)
+    return export.write_parquet(output_file, parquet_schema(columns), batches, compression="gzip" if compress else "snappy")
+
+
+def export_plumes(output_file, output_format="csv", compress=False, batch_size=export.DEFAULT_BATCH_SIZE, verbose=False):
+    conn = db.connect()
     cur = conn.cursor()
-    with open(output_file, 'w', newline='') as csvfile:
-        rowWriter = csv.writer(csvfile, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
-        rowWriter.writerow(['Source identifier', 'Plume latitude (deg)', 'Plume longitude (deg)', 'Candidate identifier', 'Date of detection', 'Time of detection (UTC)', 'Source type (best estimate)', 'Sectors (IPCC)', 'Qplume (kg/hr): Plume emissions', 'Sigma Qplume (kg/hr): Uncertainty for plume emissions'])
-        plumes = get_plumes(cur)
-        for row in plumes:
-            rowWriter.writerow([row[10], row[7], row[8], row[15], row[47].date(), row[47].time(), row[16], row[18], row[48], row[49]])
+    try:
+        column_names = plume_column_names(cur)
+        columns = export_columns(column_names, typed=output_format == "parquet")
+        if output_format == "csv":
+            count = build_csv(cur, columns, output_file, compress)
+        elif output_format == "geojson":
+            count = build_geojson(conn, columns, geometry_expression(column_names), output_file, compress, batch_size)
+        else:
+            count = build_parquet(conn, columns, output_file, compress, batch_size)
+    finally:
+        # Nothing is written, so the read transaction is just ended
+        conn.rollback()
+        cur.close()
+        db.release(conn)
+
+    if verbose:
+        print("Exported %s plumes to %s" % (count, output_file))
+    return count
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("-d", "--data", help="Output Plumes CSV (csv)", required=True, type=str)
-    parser.add_argument("-e", "--endpoint", help="Target PostgreSQL endpoint", type=str, default="localhost", required=False)
-    parser.add_argument("-p", "--port", help="Target PostgreSQL port", type=str, default="5432", required=False)
+    parser.add_argument("-d", "--data", help="Output Plumes file (csv, geojson or parquet)", required=True, type=str)
+    parser.add_argument("-f", "--format", help="Output format", choices=OUTPUT_FORMATS, default="csv", required=False)
+    parser.add_argument("-z", "--gzip", help="Gzip the CSV or GeoJSON output (gzip-compressed column chunks for Parquet)", action="store_true")
+    parser.add_argument("-b", "--batch", help="Rows fetched per batch for GeoJSON and Parquet output", type=int, default=export.DEFAULT_BATCH_SIZE, required=False)
+    parser.add_argument("-e", "--endpoint", help="Target PostgreSQL endpoint (overrides MSF_DB_HOST)", type=str, default=None, required=False)
+    parser.add_argument("-p", "--port", help="Target PostgreSQL port (overrides MSF_DB_PORT)", type=str, default=None, required=False)
+    parser.add_argument("-v", "--verbose", help="Verbose output", action="store_true")
 
     args = parser.parse_args()
     output_file = args.data
 
-    build_csv(output_file)
+    if args.endpoint is not None:
+        os.environ["MSF_DB_HOST"] = args.endpoint
+    if args.port is not None:
+        os.environ["MSF_DB_PORT"] = args.port
+
+    export_plumes(output_file, args.format, args.gzip, args.batch, args.verbose)
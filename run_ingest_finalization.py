@@ -1,6 +1,11 @@
 
+import sys
+import time
 import argparse
+import traceback
 import psycopg2
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from ingestutils.progress import StageTimer
 
 DB_ENDPOINT = "localhost"
 DB_PORT = 5432
@@ -11,46 +16,129 @@ DB_NAME = ""
 
 def execute_procedure(stmt, cur, verbose=False):
     if verbose is True:
-        print "Running procedure:", stmt, "...."
+        print("Running procedure: %s ...." % stmt)
     sql = """
     begin;
     select {statement}();
     """.format(statement=stmt)
     cur.execute(sql)
     if verbose is True:
-        print "        Done"
-
-
-def msf_purge_joins_and_clean_inactive_entries(cur, verbose=False):
-    execute_procedure("msf_purge_joins_and_clean_inactive_entries", cur, verbose)
-
-
-def msf_build_vista_sources_relationship(cur, verbose=False):
-    execute_procedure("msf_build_vista_sources_relationship", cur, verbose)
-
-
-def msf_build_vista_aviris_plumes_relationship(cur, verbose=False):
-    execute_procedure("msf_build_vista_aviris_plumes_relationship", cur, verbose)
-
-
-def msf_build_vista_flightlines_relationship(cur, verbose=False):
-    execute_procedure("msf_build_vista_flightlines_relationship", cur, verbose)
-
-
-def msf_build_vista_oil_wells_field_boundary_relationship(cur, verbose=False):
-    execute_procedure("msf_build_vista_oil_wells_field_boundary_relationship", cur, verbose)
-
-
-def msf_build_vista_counties_relationship(cur, verbose=False):
-    execute_procedure("msf_build_vista_counties_relationship", cur, verbose)
+        print("        Done")
+
+
+# Each procedure with the procedures that must finish before it starts. The
+# purge clears every join table, so all builds wait for it. The builds are
+# assumed to each fill only their own relationship table and so to run side
+# by side: the procedures are defined in the database, not in this
+# repository, so add a dependency here if one turns out to read another's
+# table, or run with -a.
+FINALIZATION_PROCEDURES = [
+    ("msf_purge_joins_and_clean_inactive_entries", []),
+    ("msf_build_vista_sources_relationship", ["msf_purge_joins_and_clean_inactive_entries"]),
+    ("msf_build_vista_aviris_plumes_relationship", ["msf_purge_joins_and_clean_inactive_entries"]),
+    ("msf_build_vista_flightlines_relationship", ["msf_purge_joins_and_clean_inactive_entries"]),
+    ("msf_build_vista_oil_wells_field_boundary_relationship", ["msf_purge_joins_and_clean_inactive_entries"]),
+    ("msf_build_vista_counties_relationship", ["msf_purge_joins_and_clean_inactive_entries"]),
+    ("msf_build_sources_flightlines_relationship", ["msf_purge_joins_and_clean_inactive_entries"]),
+    ("msf_build_sources_counties_relationship", ["msf_purge_joins_and_clean_inactive_entries"]),
+]
+
+def connect_to_db(db_endpoint=DB_ENDPOINT, db_port=DB_PORT):
+    # TODO: Use correct credentials
+    return psycopg2.connect(dbname=DB_NAME, user=DB_USER, password=DB_PASSWD, host=db_endpoint, port=db_port)
 
 
-def msf_build_sources_flightlines_relationship(cur, verbose=False):
-    execute_procedure("msf_build_sources_flightlines_relationship", cur, verbose)
+def finish_transaction(conn, test_only=False):
+    if test_only:
+        conn.rollback()
+    else:
+        conn.commit()
 
 
-def msf_build_sources_counties_relationship(cur, verbose=False):
-    execute_procedure("msf_build_sources_counties_relationship", cur, verbose)
+def run_finalization_atomic(conn, procedures=FINALIZATION_PROCEDURES, test_only=False, verbose=False, timer=None):
+    """
+    Runs every procedure in declaration order in a single transaction, which
+    is committed only if all of them succeed.
+    """
+    cur = conn.cursor()
+    try:
+        for name, deps in procedures:
+            t0 = time.time()
+            execute_procedure(name, cur, verbose)
+            if timer is not None:
+                timer.add(name, time.time() - t0)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+
+    if verbose:
+        print("Testing only, rolling back changes" if test_only else "Committing changes")
+    finish_transaction(conn, test_only)
+
+
+def _run_procedure_on_own_connection(name, connect, test_only, verbose):
+    conn = connect()
+    try:
+        cur = conn.cursor()
+        t0 = time.time()
+        execute_procedure(name, cur, verbose)
+        finish_transaction(conn, test_only)
+        cur.close()
+        return time.time() - t0
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def run_finalization_concurrent(connect, procedures=FINALIZATION_PROCEDURES, workers=4, test_only=False, verbose=False, timer=None):
+    """
+    Runs each procedure on its own connection and in its own transaction as
+    soon as everything it depends on has committed, with at most workers
+    running at once. A failed procedure's dependents are not run. Returns
+    the names of the procedures that failed or were skipped.
+    """
+    deps_of = dict((name, set(deps)) for name, deps in procedures)
+    pending = [name for name, deps in procedures]
+    done = set()
+    failed = []
+    running = {}
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        while pending or running:
+            for name in list(pending):
+                if deps_of[name] & set(failed):
+                    print("Skipping %s, a procedure it depends on failed" % name)
+                    pending.remove(name)
+                    failed.append(name)
+                elif deps_of[name] <= done:
+                    pending.remove(name)
+                    running[executor.submit(_run_procedure_on_own_connection, name, connect, test_only, verbose)] = name
+
+            if not running:
+                break
+
+            finished, not_finished = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    elapsed = future.result()
+                except Exception:
+                    print("Procedure %s failed:" % name)
+                    traceback.print_exc()
+                    failed.append(name)
+                    continue
+                done.add(name)
+                if timer is not None:
+                    timer.add(name, elapsed)
+    finally:
+        executor.shutdown(wait=True)
+
+    return failed
 
 
 if __name__ == "__main__":
@@ -64,32 +152,36 @@ if __name__ == "__main__":
     parser.add_argument("-t", "--test",
                         help="Test by parsing and assembling upload document. Don't actually upload to PostgreSQL.",
                         required=False, action="store_true")
+    parser.add_argument("-w", "--workers", help="Number of procedures to run at once on separate connections", type=int, default=4, required=False)
+    parser.add_argument("-a", "--atomic",
+                        help="Run the procedures one after another in a single transaction, committing only if all succeed",
+                        required=False, action="store_true")
     args = parser.parse_args()
     test_only = args.test
     verbose = args.verbose
     db_endpoint = args.endpoint
     db_port = args.port
-
-    # TODO: Use correct credentials
-    conn = psycopg2.connect(dbname=DB_NAME, user=DB_USER, password=DB_PASSWD, host=db_endpoint, port=db_port)
-    cur = conn.cursor()
-
-    msf_purge_joins_and_clean_inactive_entries(cur, verbose)
-    msf_build_vista_sources_relationship(cur, verbose)
-    msf_build_vista_aviris_plumes_relationship(cur, verbose)
-    msf_build_vista_flightlines_relationship(cur, verbose)
-    msf_build_vista_oil_wells_field_boundary_relationship(cur, verbose)
-    msf_build_vista_counties_relationship(cur, verbose)
-    msf_build_sources_flightlines_relationship(cur, verbose)
-    msf_build_sources_counties_relationship(cur, verbose)
-
-    if test_only:
-        if verbose:
-            print("Testing only, rolling back changes")
-        conn.rollback()
+    workers = args.workers
+    atomic = args.atomic
+
+    connect = lambda: connect_to_db(db_endpoint, db_port)
+    procedures = FINALIZATION_PROCEDURES
+
+    timer = StageTimer()
+    if atomic or test_only:
+        # A test run has to see the purge's uncommitted changes, so it always
+        # goes through the single rolled-back transaction.
+        conn = connect()
+        try:
+            run_finalization_atomic(conn, procedures, test_only=test_only, verbose=verbose, timer=timer)
+        finally:
+            conn.close()
+        failed = []
     else:
-        if verbose:
-            print("Committing changes")
-        conn.commit()
-    cur.close()
-    conn.close()
+        failed = run_finalization_concurrent(connect, procedures, workers=workers,
+                                             test_only=test_only, verbose=verbose, timer=timer)
+
+    timer.report(title="Finalization procedures")
+    if failed:
+        print("Failed or skipped: %s" % ", ".join(failed))
+        sys.exit(1)
@@ -0,0 +1,9 @@
+-- Unique keys used as the ON CONFLICT targets of the bulk (-B) CSV loaders
+-- in ingest_permian_plume_csv_to_sql.py and ingest_permian_source_csv_to_sql.py.
+--
+-- Existing duplicates must be removed before these can be created:
+--   select candidate_id, count(*) from plumes group by candidate_id having count(*) > 1;
+--   select source_id, count(*) from sources group by source_id having count(*) > 1;
+
+create unique index if not exists plumes_candidate_id_key on plumes (candidate_id);
+create unique index if not exists sources_source_id_key on sources (source_id);
@@ -0,0 +1,8 @@
+-- Thumbnail URLs for each plume image, by image and size (longest side in
+-- pixels), e.g.
+--   {"rgb_png": {"100": "https://...", "256": "...", "1024": "..."},
+--    "plume_png": {...}, "rgbqlctr_png": {...}}
+-- The 100 px URLs are also kept in the *_thumb columns.
+-- Written by ingest_plumes_to_sql_permian.py and build_plume_thumbnails.py.
+
+alter table aviris_plumes add column if not exists thumbnails jsonb;
@@ -0,0 +1,8 @@
+-- XYZ tile pyramid of each plume overlay, written by the plume ingest when
+-- run with -T. tiles_url is a {z}/{x}/{y}.png URL template; tiles exist
+-- between tiles_min_zoom and tiles_max_zoom, except fully transparent ones,
+-- which are not uploaded.
+
+alter table aviris_plumes add column if not exists tiles_url text;
+alter table aviris_plumes add column if not exists tiles_min_zoom integer;
+alter table aviris_plumes add column if not exists tiles_max_zoom integer;
@@ -0,0 +1,15 @@
+-- Unique keys used as the ON CONFLICT targets of the single-statement
+-- upserts in the plume image, flightline and VISTA loaders. Together with
+-- the plumes/sources keys in 001_plumes_sources_natural_keys.sql (which the
+-- CSV loaders' row-by-row path now relies on too) these make concurrent
+-- loader runs safe: a second writer updates the row instead of inserting a
+-- duplicate.
+--
+-- Existing duplicates must be removed before these can be created:
+--   select candidate_id, count(*) from aviris_plumes group by candidate_id having count(*) > 1;
+--   select flight_name, count(*) from flightlines group by flight_name having count(*) > 1;
+--   select vista_id, count(*) from vista group by vista_id having count(*) > 1;
+
+create unique index if not exists aviris_plumes_candidate_id_key on aviris_plumes (candidate_id);
+create unique index if not exists flightlines_flight_name_key on flightlines (flight_name);
+create unique index if not exists vista_vista_id_key on vista (vista_id);
@@ -0,0 +1,122 @@
+import os
+import sys
+import base64
+import hashlib
+import boto3
+import pytest
+
+try:
+    from moto import mock_aws
+except ImportError:
+    from moto import mock_s3 as mock_aws
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from ingestutils import s3util
+
+TEST_BUCKET = "msf-test"
+
+
+@pytest.fixture
+def s3():
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+    with mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket=TEST_BUCKET)
+        s3util._known_hashes.clear()
+        yield client
+
+
+def record_puts(client):
+    """
+    Collects the parameters of every put_object the client sends.
+    """
+    puts = []
+    client.meta.events.register("provide-client-params.s3.PutObject", lambda params, **kwargs: puts.append(dict(params)))
+    return puts
+
+
+def is_public_read(client, key):
+    grants = client.get_object_acl(Bucket=TEST_BUCKET, Key=key)["Grants"]
+    return any(grant["Permission"] == "READ" and grant["Grantee"].get("URI", "").endswith("/global/AllUsers")
+               for grant in grants)
+
+
+def test_upload_data_puts_object_with_acl(s3):
+    uploader = s3util.S3Uploader(s3_bucket=TEST_BUCKET, client=s3)
+    try:
+        futures = [uploader.upload_data("/tmp/plume_%d.png" % i, b"plume %d" % i) for i in range(4)]
+        urls = [future.result(timeout=30) for future in futures]
+    finally:
+        uploader.shutdown()
+
+    for i, url in enumerate(urls):
+        key = "%s/plume_%d.png" % (s3util.S3_KEY_PREFIX, i)
+        assert url == s3util.get_s3_url(TEST_BUCKET, key)
+        assert s3.get_object(Bucket=TEST_BUCKET, Key=key)["Body"].read() == b"plume %d" % i
+        assert is_public_read(s3, key)
+
+
+def test_upload_encoded_uses_key_as_given(s3):
+    uploader = s3util.S3Uploader(s3_bucket=TEST_BUCKET, client=s3)
+    try:
+        url = uploader.upload_encoded("tiles/1/0/0.png", lambda value: value.encode("utf-8"), "tile").result(timeout=30)
+    finally:
+        uploader.shutdown()
+
+    assert url == s3util.get_s3_url(TEST_BUCKET, "tiles/1/0/0.png")
+    assert s3.get_object(Bucket=TEST_BUCKET, Key="tiles/1/0/0.png")["Body"].read() == b"tile"
+    assert is_public_read(s3, "tiles/1/0/0.png")
+
+
+def test_unchanged_bytes_are_not_uploaded_again(s3):
+    puts = record_puts(s3)
+    uploader = s3util.S3Uploader(s3_bucket=TEST_BUCKET, client=s3, skip_unchanged=True)
+    try:
+        first = uploader.upload_data("plume.png", b"plume").result(timeout=30)
+        second = uploader.upload_data("plume.png", b"plume").result(timeout=30)
+    finally:
+        uploader.shutdown()
+
+    assert len(puts) == 1
+    assert first == second == s3util.get_s3_url(TEST_BUCKET, "AVIRIS/plume.png")
+
+
+def test_unchanged_check_uses_stored_etag(s3):
+    s3util.S3Uploader(s3_bucket=TEST_BUCKET, client=s3).upload_data("plume.png", b"plume").result(timeout=30)
+    # A new run starts without the hashes this process has seen
+    s3util._known_hashes.clear()
+    puts = record_puts(s3)
+
+    uploader = s3util.S3Uploader(s3_bucket=TEST_BUCKET, client=s3, skip_unchanged=True)
+    try:
+        uploader.upload_data("plume.png", b"plume").result(timeout=30)
+    finally:
+        uploader.shutdown()
+
+    assert len(puts) == 0
+
+
+def test_changed_bytes_are_uploaded_again(s3):
+    puts = record_puts(s3)
+    uploader = s3util.S3Uploader(s3_bucket=TEST_BUCKET, client=s3, skip_unchanged=True)
+    try:
+        uploader.upload_data("plume.png", b"first").result(timeout=30)
+        uploader.upload_data("plume.png", b"second").result(timeout=30)
+    finally:
+        uploader.shutdown()
+
+    assert len(puts) == 2
+    assert s3.get_object(Bucket=TEST_BUCKET, Key="AVIRIS/plume.png")["Body"].read() == b"second"
+
+
+def test_put_carries_content_md5(s3):
+    puts = record_puts(s3)
+    uploader = s3util.S3Uploader(s3_bucket=TEST_BUCKET, client=s3)
+    try:
+        uploader.upload_data("plume.png", b"plume").result(timeout=30)
+    finally:
+        uploader.shutdown()
+
+    assert puts[0]["ContentMD5"] == base64.b64encode(hashlib.md5(b"plume").digest()).decode("ascii")